@@ -1,37 +1,126 @@
+import importlib
+import json
+import os
 import subprocess
+import sys
+import threading
+import time
 import warnings
 
 
-def check_newer_version(package_name, current_version):
+__version__ = '0.1.0'
+
+# Where the result of the last version check is kept, and how many seconds it stays fresh
+VERSION_CHECK_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'ForestOps', 'version_check.json')
+VERSION_CHECK_TTL = 24 * 60 * 60
+
+
+def check_newer_version(package_name, current_version, timeout=30):
     try:
-        output = subprocess.check_output(['pip', 'list', '--outdated'])
+        output = subprocess.check_output([sys.executable, '-m', 'pip', 'list', '--outdated',
+                                          '--disable-pip-version-check'], stderr=subprocess.DEVNULL, timeout=timeout)
         packages = output.decode().strip().split('\n')[2:]
         for package in packages:
             name, *other_info = package.split()
             version = other_info[0]
             if name.lower() == package_name.lower() and version > current_version:
                 return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
         pass
 
     return False
 
 
-def _warn_if_newer_version_available():
+def _read_version_check(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _refresh_version_check(package_name, current_version, cache_file):
+    newer = check_newer_version(package_name, current_version)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Write to a temporary file first, so other processes never read a partial result
+        partial_file = f"{cache_file}.{os.getpid()}"
+        with open(partial_file, 'w') as f:
+            json.dump({'checked': time.time(), 'version': current_version, 'newer': newer}, f)
+        os.replace(partial_file, cache_file)
+    except OSError:
+        pass
+
+
+def check_for_updates(ttl=VERSION_CHECK_TTL, cache_file=None, wait=False):
+    """
+    Warn if a newer version of ForestOps is available, without blocking.
+
+    The result of the last check is cached on disk. When it is older than ttl seconds, pip is asked again in a
+    background thread and the new result is used from the next call on. The check runs on import only when the
+    FORESTOPS_VERSION_CHECK environment variable is set to 1.
+
+    Args:
+        ttl (float): Number of seconds a cached result stays fresh. Default is one day.
+        cache_file (str, optional): Path of the cache file. Defaults to VERSION_CHECK_FILE.
+        wait (bool): Wait for a refresh to finish rather than using the cached result. Default is False.
+
+    Returns:
+        bool or None: Whether a newer version is available, or None when it is not known yet.
+    """
     package_name = 'ForestOps'
-    current_version = '0.1.0'
+    cache_file = cache_file or VERSION_CHECK_FILE
+
+    cache = _read_version_check(cache_file)
+    fresh = cache is not None and cache.get('version') == __version__ and time.time() - cache.get('checked', 0) < ttl
+    if not fresh:
+        refresh = threading.Thread(target=_refresh_version_check, args=(package_name, __version__, cache_file),
+                                   daemon=True)
+        refresh.start()
+        if wait:
+            refresh.join()
+            cache = _read_version_check(cache_file)
+    if cache is None:
+        return None
 
-    if check_newer_version(package_name, current_version):
+    if cache['newer']:
         warning_message = f"A newer version of {package_name} is available. Please consider upgrading."
     else:
         warning_message = f"This is the latest version of {package_name}. Beware it is under development, please report any bugs."
 
     warnings.warn(warning_message, UserWarning)
+    return cache['newer']
+
+
+if os.environ.get('FORESTOPS_VERSION_CHECK', '').lower() in ['1', 'true', 'yes']:
+    check_for_updates()
+
+
+# Names of the data_ops module. The names of geo_ops come from geo_ops itself, which also imports lazily.
+_DATA_OPS_EXPORTS = ['add_data', 'flatten_json', 'data_sources']
+_SUBMODULES = ['geo_ops', 'stats', 'data_ops']
+
+
+def __getattr__(name):
+    """
+    Import the submodule defining a public name when the name is first used (PEP 562), so importing ForestOps does
+    not import geopandas, rasterio or GDAL.
+    """
+    if name in _DATA_OPS_EXPORTS:
+        value = getattr(importlib.import_module('.data_ops', __name__), name)
+    elif name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    else:
+        geo_ops = importlib.import_module('.geo_ops', __name__)
+        if name not in geo_ops.__all__:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        value = getattr(geo_ops, name)
+    globals()[name] = value
+    return value
 
 
-_warn_if_newer_version_available()
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
 
 
-from .geo_ops import *
-from .stats import *
-from .data_ops import *
+__all__ = importlib.import_module('.geo_ops', __name__).__all__ + _DATA_OPS_EXPORTS
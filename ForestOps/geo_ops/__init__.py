@@ -1,8 +1,63 @@
 # GeoOps/__init__.py
 
-from .geo_io import *
-from .raster_ops import *
-from .geo_stats import *
-from .geo_funcs import *
+'''
+The submodules pull in geopandas, rasterio and GDAL, so each one is only imported when one of its names is first used
+'''
 
+import importlib
 
+
+# Public names of each submodule
+_SUBMODULE_EXPORTS = {
+    'geo_io': ['get_record_limit', 'get_feature_server_metadata', 'get_feature_count', 'read_from_url',
+               'read_raster_file', 'read_attribute_chunks', 'read_data', 'write_raster'],
+    'raster_ops': ['time_recording', 'raster_summary', 'snap_bounds', 'build_vrt', 'block_windows',
+                   'write_vrt_windows', 'merge_geotiffs', 'view_raster', 'raster_calculator', 'POINT_AGGREGATIONS',
+                   'points_to_raster', 'raster_grid', 'vector_to_raster', 'SAMPLE_METHODS', 'sample_raster'],
+    'tile_index': ['find_geotiffs', 'read_tile_header', 'default_tile_index_path', 'update_tile_index',
+                   'area_of_interest', 'filter_tile_headers', 'query_tile_index'],
+    'raster_cache': ['RasterCache', 'get_raster_cache', 'set_raster_cache_size', 'clear_raster_cache',
+                     'read_raster_cached'],
+    'raster_profiles': ['RASTER_PROFILES', 'output_profile', 'resolve_output_profile', 'overview_factors',
+                        'open_raster_writer'],
+    'crs_cache': ['CRS_CACHE_SIZE', 'OSTN15_GRID', 'parse_crs', 'crs_equivalent', 'get_transformer', 'clear_crs_cache',
+                  'crs_cache_info', 'transform_coordinates', 'transform_geometries', 'reproject'],
+    'sindex_cache': ['PackedRTree', 'IndexedLayer', 'SpatialIndexCache', 'get_sindex_cache', 'clear_sindex_cache',
+                     'cached_index'],
+    'geo_stats': ['ZONAL_STATS', 'native_zonal_statistics', 'COVERAGE_STATS', 'coverage_weights',
+                  'coverage_zonal_statistics', 'SUMMARY_STATS', 'QuantileSketch', 'FrequentValues',
+                  'StreamingSummary', 'GroupedSummary', 'GeospatialStatistics'],
+    'geo_funcs': ['chunk_geodataframe', 'explode_geodataframe', 'reassemble_geodataframe', 'fix_invalid_geometries',
+                  'check_crs', 'cut_and_retain_intersection', 'extract_overlapping_polygons',
+                  'extract_non_overlapping_polygons', 'clip_and_combine', 'filter_geomtype', 'create_square',
+                  'process_geospatial_data_to_dict', 'plot_layers', 'add_overlap_indicator', 'print_unique_row_counts',
+                  'add_area'],
+    'instrumentation': ['STAGE_COUNTERS', 'PROFILERS', 'StageCollector', 'Stage', 'stage', 'current_stage',
+                        'instrumented', 'get_collector', 'set_collector', 'set_instrumentation', 'enable_profiling',
+                        'disable_profiling', 'peak_rss', 'format_duration'],
+    'pipeline': ['PIPELINE_OVERLAYS', 'Pipeline'],
+    'progress': ['PROGRESS_REPORTERS', 'Progress', 'track_progress', 'report', 'reporting', 'set_progress_reporter',
+                 'format_progress'],
+}
+
+# Submodule defining each public name
+_EXPORTS = {name: module for module, names in _SUBMODULE_EXPORTS.items() for name in names}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    """
+    Import the submodule defining a public name when the name is first used (PEP 562).
+    """
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+        globals()[name] = value
+        return value
+    if name in _SUBMODULE_EXPORTS or name == 'visibility':
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,253 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shapely
+import geopandas as gpd
+from pyproj import CRS, Transformer
+from pyproj.transformer import TransformerGroup
+
+
+'''
+Cached parsing of coordinate reference systems and cached, vectorised transformation between them.
+
+Building a pyproj Transformer takes tens of milliseconds, much longer than transforming the coordinates of a small
+layer, so transformers are kept in a bounded LRU cache keyed by source, target and options. pyproj 3.1 and later
+transformers can be shared between threads.
+'''
+
+
+# Number of parsed CRSs and of transformers kept
+CRS_CACHE_SIZE = 256
+
+# Grid of the Ordnance Survey OSTN15 transformation between OSGB36 / British National Grid and ETRS89
+OSTN15_GRID = 'uk_os_OSTN15_NTv2_OSGBtoETRS'
+
+
+@functools.lru_cache(maxsize=CRS_CACHE_SIZE)
+def _parse_crs(crs):
+    return CRS.from_user_input(crs)
+
+
+def parse_crs(crs):
+    """
+    Return a pyproj CRS for an EPSG code, an authority string such as 'EPSG:27700', WKT, a PROJ string, a dict, a
+    rasterio CRS or a pyproj CRS, parsing each distinct value only once.
+
+    Args:
+        crs: The CRS, or None.
+
+    Returns:
+        pyproj.CRS or None: The parsed CRS, or None when crs is None.
+    """
+    if crs is None or isinstance(crs, CRS):
+        return crs
+    if hasattr(crs, 'to_wkt'):
+        # rasterio and other CRS objects
+        crs = crs.to_wkt()
+    try:
+        return _parse_crs(crs)
+    except TypeError:
+        # Unhashable values such as dicts are parsed every time
+        return CRS.from_user_input(crs)
+
+
+def crs_equivalent(crs1, crs2):
+    """
+    Check whether two CRSs describe the same coordinate system, whatever form they are given in, so 27700,
+    'epsg:27700' and the WKT of British National Grid are all equivalent.
+
+    Axis order is ignored, since GeoPandas and ForestOps always store x then y. Two missing CRSs are equivalent, a
+    missing and a set one are not.
+
+    Args:
+        crs1: First CRS, in any form accepted by parse_crs.
+        crs2: Second CRS, in any form accepted by parse_crs.
+
+    Returns:
+        bool: True when no reprojection is needed between the two.
+    """
+    crs1, crs2 = parse_crs(crs1), parse_crs(crs2)
+    if crs1 is None or crs2 is None:
+        return crs1 is crs2
+    return crs1 is crs2 or crs1.equals(crs2, ignore_axis_order=True)
+
+
+def _ostn15_transformer(source, target):
+    # The best available operation of the group that uses the OSTN15 grid
+    group = TransformerGroup(source, target, always_xy=True)
+    for transformer in group.transformers:
+        if OSTN15_GRID in transformer.definition:
+            return transformer
+    if any(OSTN15_GRID in grid.short_name for operation in group.unavailable_operations
+           for grid in operation.grids):
+        raise ValueError(f"The OSTN15 grid {OSTN15_GRID}.tif is not installed. Download it with "
+                         f"'projsync --file {OSTN15_GRID}.tif' or enable the PROJ network with "
+                         f"pyproj.network.set_network_enabled(True).")
+    raise ValueError(f"No OSTN15 transformation from {source.name} to {target.name}. OSTN15 transforms between "
+                     f"OSGB36 / British National Grid and ETRS89 or WGS 84.")
+
+
+@functools.lru_cache(maxsize=CRS_CACHE_SIZE)
+def _transformer(source_wkt, target_wkt, accuracy, allow_ballpark, ostn15):
+    source, target = _parse_crs(source_wkt), _parse_crs(target_wkt)
+    if ostn15:
+        return _ostn15_transformer(source, target)
+    return Transformer.from_crs(source, target, always_xy=True, accuracy=accuracy, allow_ballpark=allow_ballpark)
+
+
+def get_transformer(source, target, accuracy=None, allow_ballpark=None, ostn15=False):
+    """
+    Return a cached transformer between two CRSs, taking and returning coordinates as x then y.
+
+    Args:
+        source: Source CRS, in any form accepted by parse_crs.
+        target: Target CRS, in any form accepted by parse_crs.
+        accuracy (float, optional): Minimum accuracy in metres of the transformation.
+        allow_ballpark (bool, optional): Allow ballpark transformations when no better one is available.
+        ostn15 (bool): Use the Ordnance Survey OSTN15 grid transformation, accurate to about 0.1 m, between
+            British National Grid (EPSG:27700) and ETRS89 or WGS 84. The grid must be installed or the PROJ network
+            enabled. Default is False, which uses the best transformation PROJ finds, often a Helmert
+            transformation accurate to a few metres.
+
+    Returns:
+        pyproj.Transformer: The transformer.
+    """
+    source, target = parse_crs(source), parse_crs(target)
+    if source is None or target is None:
+        raise ValueError("Both the source and the target CRS are required.")
+    return _transformer(source.to_wkt(), target.to_wkt(), accuracy, allow_ballpark, bool(ostn15))
+
+
+def clear_crs_cache():
+    """
+    Empty the caches of parsed CRSs and transformers, such as after installing new PROJ grids.
+    """
+    _parse_crs.cache_clear()
+    _transformer.cache_clear()
+
+
+def crs_cache_info():
+    """
+    Return the hits, misses and sizes of the caches of parsed CRSs and transformers.
+    """
+    return {'crs': _parse_crs.cache_info()._asdict(), 'transformers': _transformer.cache_info()._asdict()}
+
+
+def transform_coordinates(x, y, source, target, z=None, accuracy=None, allow_ballpark=None, ostn15=False,
+                          chunk_size=1000000, workers=1):
+    """
+    Transform coordinate arrays between two CRSs.
+
+    The coordinates are transformed in chunks of chunk_size, on several threads when workers is more than 1. PROJ
+    releases the GIL while transforming, so the threads run in parallel.
+
+    Args:
+        x (array-like): x coordinates (or longitudes).
+        y (array-like): y coordinates (or latitudes).
+        source: Source CRS, in any form accepted by parse_crs.
+        target: Target CRS, in any form accepted by parse_crs.
+        z (array-like, optional): z coordinates.
+        accuracy (float, optional): Minimum accuracy in metres of the transformation.
+        allow_ballpark (bool, optional): Allow ballpark transformations when no better one is available.
+        ostn15 (bool): Use the OSTN15 grid transformation, see get_transformer. Default is False.
+        chunk_size (int): Number of coordinates transformed at a time. Default is 1000000.
+        workers (int): Number of threads transforming chunks. Default is 1.
+
+    Returns:
+        tuple: The transformed x and y arrays, and z when it was given.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    transformer = get_transformer(source, target, accuracy=accuracy, allow_ballpark=allow_ballpark, ostn15=ostn15)
+    coordinates = [np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64')]
+    if z is not None:
+        coordinates.append(np.asarray(z, dtype='float64'))
+    outputs = [np.empty_like(values) for values in coordinates]
+
+    def transform_chunk(start):
+        stop = start + chunk_size
+        results = transformer.transform(*[values[start:stop] for values in coordinates], errcheck=False)
+        for output, result in zip(outputs, results):
+            output[start:stop] = result
+
+    starts = range(0, len(coordinates[0]), chunk_size)
+    if workers <= 1 or len(starts) <= 1:
+        for start in starts:
+            transform_chunk(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(transform_chunk, starts))
+    return tuple(outputs)
+
+
+def transform_geometries(geometries, source, target, accuracy=None, allow_ballpark=None, ostn15=False,
+                         chunk_size=1000000, workers=1):
+    """
+    Transform an array of shapely geometries between two CRSs, with every coordinate transformed in one vectorised
+    pass, see transform_coordinates.
+
+    Args:
+        geometries (array-like): Shapely geometries, which may be None.
+        source: Source CRS, in any form accepted by parse_crs.
+        target: Target CRS, in any form accepted by parse_crs.
+        accuracy (float, optional): Minimum accuracy in metres of the transformation.
+        allow_ballpark (bool, optional): Allow ballpark transformations when no better one is available.
+        ostn15 (bool): Use the OSTN15 grid transformation, see get_transformer. Default is False.
+        chunk_size (int): Number of coordinates transformed at a time. Default is 1000000.
+        workers (int): Number of threads transforming chunks. Default is 1.
+
+    Returns:
+        numpy.ndarray: The transformed geometries.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    options = {'accuracy': accuracy, 'allow_ballpark': allow_ballpark, 'ostn15': ostn15, 'chunk_size': chunk_size,
+               'workers': workers}
+
+    def transform_xy(coordinates):
+        return np.column_stack(transform_coordinates(coordinates[:, 0], coordinates[:, 1], source, target,
+                                                     **options))
+
+    def transform_xyz(coordinates):
+        return np.column_stack(transform_coordinates(coordinates[:, 0], coordinates[:, 1], source, target,
+                                                     z=coordinates[:, 2], **options))
+
+    # Geometries with z values keep them, the others stay 2D
+    has_z = shapely.has_z(geometries)
+    if not has_z.any():
+        return shapely.transform(geometries, transform_xy)
+    result = np.empty_like(geometries)
+    result[~has_z] = shapely.transform(geometries[~has_z], transform_xy)
+    result[has_z] = shapely.transform(geometries[has_z], transform_xyz, include_z=True)
+    return result
+
+
+def reproject(gdf, crs, accuracy=None, allow_ballpark=None, ostn15=False, chunk_size=1000000, workers=1):
+    """
+    Reproject a GeoDataFrame with a cached transformer, returning it unchanged when it is already in an equivalent
+    CRS.
+
+    Only the geometry column is replaced, the other columns of the result share their data with gdf.
+
+    Args:
+        gdf (GeoDataFrame): Layer to reproject, with a CRS set.
+        crs: Target CRS, in any form accepted by parse_crs.
+        accuracy (float, optional): Minimum accuracy in metres of the transformation.
+        allow_ballpark (bool, optional): Allow ballpark transformations when no better one is available.
+        ostn15 (bool): Use the OSTN15 grid transformation, see get_transformer. Default is False.
+        chunk_size (int): Number of coordinates transformed at a time. Default is 1000000.
+        workers (int): Number of threads transforming chunks. Default is 1.
+
+    Returns:
+        GeoDataFrame: The layer in the target CRS.
+    """
+    if gdf.crs is None:
+        raise ValueError("The GeoDataFrame has no CRS to reproject from. Set one with set_crs first.")
+    target = parse_crs(crs)
+    if crs_equivalent(gdf.crs, target):
+        return gdf
+    geometries = transform_geometries(gdf.geometry.values, gdf.crs, target, accuracy=accuracy,
+                                      allow_ballpark=allow_ballpark, ostn15=ostn15, chunk_size=chunk_size,
+                                      workers=workers)
+    result = gdf.copy(deep=False)
+    result[gdf.geometry.name] = gpd.GeoSeries(geometries, index=gdf.index, crs=target)
+    return result
@@ -3,13 +3,20 @@ This is for any functions applied to geometry
 '''
 
 
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from shapely.validation import explain_validity
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import MultiPolygon, Polygon
-from pyproj import CRS
 from ForestOps.geo_ops.geo_io import read_data
+from ForestOps.geo_ops.crs_cache import parse_crs, crs_equivalent, reproject, transform_geometries
+from ForestOps.geo_ops.sindex_cache import cached_index
+from ForestOps.geo_ops.instrumentation import instrumented, current_stage
+from ForestOps.geo_ops.progress import report, reporting
 
 '''
 Geodataframe Operations
@@ -28,29 +35,74 @@ def chunk_geodataframe(gdf, chunk_size=100000):
         yield gdf.iloc[i:i + chunk_size]
 
 
-def explode_geodataframe(gdf):
+def _get_parts(geometries, workers=1, chunk_size=100000):
+    """
+    Split geometries into their parts, on several threads for large inputs.
+
+    Args:
+        geometries (numpy.ndarray): The geometries.
+        workers (int): Number of threads. Default is 1.
+        chunk_size (int): Number of geometries split by each thread at a time. Default is 100000.
+
+    Returns:
+        tuple: The parts and the position of the geometry each part comes from.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    starts = range(0, len(geometries), chunk_size)
+    if workers <= 1 or len(starts) <= 1:
+        return shapely.get_parts(geometries, return_index=True)
+
+    def split_chunk(start):
+        parts, parents = shapely.get_parts(geometries[start:start + chunk_size], return_index=True)
+        return parts, parents + start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunks = list(executor.map(split_chunk, starts))
+    return np.concatenate([chunk[0] for chunk in chunks]), np.concatenate([chunk[1] for chunk in chunks])
+
+
+@instrumented()
+def explode_geodataframe(gdf, counts_only=False, workers=1, chunk_size=100000):
     """
     Explode a geodataframe into separate rows.
+
+    The result is the same as gdf.explode(index_parts=True): one row for each part of each geometry, indexed by the
+    original index and the number of the part, with rows of missing geometries dropped. The parts are split in one
+    vectorised pass and the other columns are taken once for all parts.
+
     Args:
         gdf (geopandas.GeoDataFrame): The geodataframe to be exploded.
+        counts_only (bool): Only return the number of parts of each geometry, without exploding. Default is False.
+        workers (int): Number of threads splitting the geometries. Default is 1.
+        chunk_size (int): Number of geometries split by each thread at a time. Default is 100000.
     Returns:
-        geopandas.GeoDataFrame: A new geodataframe with the geometries exploded into separate rows.
+        geopandas.GeoDataFrame: A new geodataframe with the geometries exploded into separate rows, or a Series of
+            the number of parts of each geometry, 0 for missing geometries, when counts_only is True.
     """
-    # Explode the geometries into separate rows
-    gdf_exploded = gdf.explode(index_parts=True)
+    current_stage().add(rows=len(gdf))
+    geometries = np.asarray(gdf.geometry.values)
+    if counts_only:
+        return pd.Series(shapely.get_num_geometries(geometries), index=gdf.index)
 
-    # Reset the index
-    gdf_exploded = gdf_exploded.reset_index(drop=False)
-    count_exploded = len(gdf_exploded) - len(gdf)
-    print(f"{count_exploded} polygons created")
+    # Split the geometries into parts, with the position of the row each part comes from
+    parts, parents = _get_parts(geometries, workers, chunk_size)
+    report(f"{len(parts) - len(gdf)} polygons created")
 
-    # Make a copy of the original GeoDataFrame
-    gdf_original = gdf.copy()
+    # Number each part within its row
+    counts = np.bincount(parents, minlength=len(gdf))
+    part_numbers = np.arange(len(parts)) - (np.cumsum(counts) - counts)[parents]
 
-    # Explode the MultiPolygon geometries
-    gdf_exploded = gdf.explode(index_parts=True)
+    # Take the other columns once for all parts and add the parts as the geometry column
+    geometry_name = gdf.geometry.name
+    gdf_exploded = gdf.drop(columns=geometry_name).take(parents)
+    gdf_exploded[geometry_name] = gpd.GeoSeries(parts, index=gdf_exploded.index, crs=gdf.crs).values
+    index = gdf_exploded.index
+    gdf_exploded.index = pd.MultiIndex.from_arrays(
+        [index.get_level_values(level) for level in range(index.nlevels)] + [part_numbers],
+        names=list(index.names) + [None])
 
-    return gdf_exploded
+    return gpd.GeoDataFrame(gdf_exploded, geometry=geometry_name, crs=gdf.crs)
 
 
 def reassemble_geodataframe(gdfs):
@@ -64,72 +116,96 @@ def reassemble_geodataframe(gdfs):
     return pd.concat(gdfs, ignore_index=True)
 
 
-def fix_invalid_geometries(gdf):
+@instrumented()
+def fix_invalid_geometries(gdf, copy=True):
     """
     Fix invalid geometries in a GeoDataFrame.
 
+    Rows with missing geometries are removed, invalid geometries are buffered by 0 and fixed polygons are returned as
+    multipolygons. The validity of every geometry is checked in one vectorised call, and only the invalid ones are
+    rebuilt.
+
     Args:
         gdf (GeoDataFrame): Input GeoDataFrame with potentially invalid geometries.
+        copy (bool): Work on a copy of gdf. With False the geometry column of gdf is replaced, and rows with missing
+            geometries dropped, in place, which saves copying every column of a large frame. Default is True.
 
     Returns:
         GeoDataFrame: GeoDataFrame with fixed geometries.
     """
+    current_stage().add(rows=len(gdf))
 
     # Make a copy of the input GeoDataFrame
-    fixed_gdf = gdf.copy()
+    fixed_gdf = gdf.copy() if copy else gdf
 
     # Check for missing geometries and remove the corresponding rows
-    missing_geometries = fixed_gdf[fixed_gdf['geometry'].isna()]
-    if not missing_geometries.empty:
-        print("Rows with missing geometries have been removed:")
-        print(missing_geometries)
-    fixed_gdf = fixed_gdf[fixed_gdf['geometry'].notna()]
-
-    # Iterate over each geometry in the GeoDataFrame
-    for idx, geometry in fixed_gdf['geometry'].iteritems():
-        # Check if the geometry is invalid
-        if not geometry.is_valid:
-            # Fix the invalid geometry by buffering it with a distance of 0
-            fixed_geometry = geometry.buffer(0)
-
-            # Convert single Polygon to MultiPolygon if necessary
-            if fixed_geometry.geom_type == 'Polygon':
-                fixed_geometry = MultiPolygon([fixed_geometry])
-
-            # Update the geometry in the GeoDataFrame with the fixed geometry
-            fixed_gdf.loc[idx, 'geometry'] = fixed_geometry
-
-            # Print information about the invalid and fixed geometries
-            valid_reason = explain_validity(geometry)  # Assuming `explain_validity` is defined elsewhere
-            fixed_geom = explain_validity(fixed_geometry)  # Assuming `explain_validity` is defined elsewhere
-            print(f"Invalid geometry in GeoDataFrame: index {idx}: {valid_reason}\nResult: {fixed_geom}")
+    missing = fixed_gdf.geometry.isna().to_numpy()
+    if missing.any():
+        report(f"{missing.sum()} rows with missing geometries have been removed")
+        report(f"Rows with missing geometries:\n{fixed_gdf[missing]}", level=logging.DEBUG)
+        if copy:
+            fixed_gdf = fixed_gdf[~missing]
+        else:
+            # Drop by position, since dropping by label would also drop valid rows sharing a label with a missing one
+            index = fixed_gdf.index
+            fixed_gdf.reset_index(drop=True, inplace=True)
+            fixed_gdf.drop(index=np.flatnonzero(missing), inplace=True)
+            fixed_gdf.index = index[~missing]
+
+    # Find the invalid geometries
+    geometries = np.asarray(fixed_gdf.geometry.values)
+    invalid = np.flatnonzero(~shapely.is_valid(geometries))
+    if len(invalid):
+        # Fix the invalid geometries by buffering them with a distance of 0
+        fixed = shapely.buffer(geometries[invalid], 0)
+
+        # Convert single Polygons to MultiPolygons
+        polygons = shapely.get_type_id(fixed) == shapely.GeometryType.POLYGON
+        fixed[polygons] = shapely.multipolygons(fixed[polygons], indices=np.arange(polygons.sum()))
+
+        # Report the invalid and fixed geometries, explaining them only when the details are shown
+        if reporting(logging.DEBUG):
+            for idx, geometry, fixed_geometry in zip(fixed_gdf.index[invalid], geometries[invalid], fixed):
+                report(f"Invalid geometry in GeoDataFrame: index {idx}: {explain_validity(geometry)}\n"
+                       f"Result: {explain_validity(fixed_geometry)}", level=logging.DEBUG)
+
+        # Replace the geometry column, the other columns are left as they are
+        geometries = geometries.copy()
+        geometries[invalid] = fixed
+        fixed_gdf[fixed_gdf.geometry.name] = gpd.GeoSeries(geometries, index=fixed_gdf.index, crs=fixed_gdf.crs)
+    report(f"{len(invalid)} invalid geometries fixed")
 
     return fixed_gdf
 
 
-def check_crs(data, crs):
+def check_crs(data, crs, ostn15=False, workers=1):
     """
     Checks the CRS of a geospatial dataset and applies the specified CRS
     if it has not been set or is different from the provided CRS.
 
+    CRSs are compared by what they describe, so a dataset already in an equivalent CRS given in another form, such
+    as 27700 and 'epsg:27700', is returned without reprojecting. Reprojection uses a cached transformer, see
+    crs_cache.reproject.
+
     Args:
         data (geopandas.GeoDataFrame): Geospatial dataset to check CRS of.
-        crs (dict or str): Target coordinate reference system to apply.
+        crs (dict, str or int): Target coordinate reference system to apply.
+        ostn15 (bool): Reproject with the OSTN15 grid between British National Grid and ETRS89 or WGS 84, see
+            crs_cache.get_transformer. Default is False.
+        workers (int): Number of threads transforming the coordinates. Default is 1.
 
     Returns:
         geopandas.GeoDataFrame: Dataset with updated CRS.
     """
+    crs = parse_crs(crs)
+
     # Check if CRS has been set
     if data.crs is None:
         data.crs = crs
 
     # Check if CRS is different
-    elif data.crs != crs:
-        try:
-            crs = CRS.from_string(crs)
-        except ValueError:
-            pass
-        data = data.to_crs(crs)
+    elif not crs_equivalent(data.crs, crs):
+        data = reproject(data, crs, ostn15=ostn15, workers=workers)
 
     return data
 
@@ -139,6 +215,7 @@ Geospatial operations
 '''
 
 
+@instrumented()
 def cut_and_retain_intersection(gdf):
     """
     Cut the geometries of a GeoDataFrame using their intersection with the union of all geometries.
@@ -149,7 +226,8 @@ def cut_and_retain_intersection(gdf):
     Returns:
         GeoDataFrame: GeoDataFrame with cut geometries.
     """
-    print('cutting and retaining geometry')
+    current_stage().add(rows=len(gdf))
+    report('cutting and retaining geometry')
 
     # Create a copy of the GeoDataFrame to avoid modifying the original
     gdf_cut = gdf.copy()
@@ -160,53 +238,81 @@ def cut_and_retain_intersection(gdf):
     return gdf_cut
 
 
+def _query_layer(gdf, index, predicate='intersects'):
+    """
+    Query an indexed reference layer with the geometries of a GeoDataFrame, reprojected to the CRS of the layer.
+
+    Args:
+        gdf (GeoDataFrame): The query features.
+        index (IndexedLayer): The indexed reference layer.
+        predicate (str): Shapely predicate. Default is 'intersects'.
+
+    Returns:
+        tuple: The query geometries in the CRS of the layer, the positions of the matching features of gdf and the
+            positions of the features of the layer they match.
+    """
+    geometries = np.asarray(gdf.geometry.values)
+    if gdf.crs is not None and index.crs is not None and not crs_equivalent(gdf.crs, index.crs):
+        geometries = transform_geometries(geometries, gdf.crs, index.crs)
+    positions, features = index.query(geometries, predicate=predicate)
+    return geometries, positions, features
+
+
+@instrumented()
 def extract_overlapping_polygons(gdf1, gdf2):
     """
     Extract polygons from gdf1 that overlap with gdf2.
 
+    The spatial index of gdf2 is cached when it is given as a path or as the IndexedLayer returned by
+    sindex_cache.cached_index, so extracting from several layers, or chunks of a layer, against it builds it once.
+
     Args:
         gdf1 (GeoDataFrame): First GeoDataFrame.
-        gdf2 (GeoDataFrame): Second GeoDataFrame.
+        gdf2 (GeoDataFrame, str or IndexedLayer): Second GeoDataFrame, the path to it or its cached index.
 
     Returns:
         GeoDataFrame: GeoDataFrame with overlapping polygons from gdf1.
     """
-    # Perform a spatial join using 'intersects' operation
-    intersection = gpd.sjoin(gdf1, gdf2, how='inner', predicate='intersects')
-
-    # Extract the indices of polygons from gdf1 that overlap with gdf2
-    overlapping_indices = intersection.index.unique()
+    current_stage().add(rows=len(gdf1))
+    # Find the polygons of gdf1 intersecting any polygon of gdf2
+    overlapping = np.unique(_query_layer(gdf1, cached_index(gdf2))[1])
 
-    return gdf1[gdf1.index.isin(overlapping_indices)]
+    return gdf1.iloc[overlapping]
 
 
+@instrumented()
 def extract_non_overlapping_polygons(gdf1, gdf2):
     """
     Extract polygons from gdf1 that do not overlap with gdf2.
 
     Args:
         gdf1 (GeoDataFrame): First GeoDataFrame.
-        gdf2 (GeoDataFrame): Second GeoDataFrame.
+        gdf2 (GeoDataFrame, str or IndexedLayer): Second GeoDataFrame, the path to it or its cached index, see
+            extract_overlapping_polygons.
 
     Returns:
         GeoDataFrame: GeoDataFrame with non-overlapping polygons from gdf1.
     """
-    # Perform a spatial join using 'intersects' operation
-    intersection = gpd.sjoin(gdf1, gdf2, how='left', predicate='intersects')
+    current_stage().add(rows=len(gdf1))
+    # Keep the polygons of gdf1 intersecting no polygon of gdf2
+    non_overlapping = np.ones(len(gdf1), dtype=bool)
+    non_overlapping[_query_layer(gdf1, cached_index(gdf2))[1]] = False
 
-    # Extract the indices of polygons from gdf1 that do not overlap with gdf2
-    non_overlapping_indices = intersection[intersection.index_right.isna()].index.unique()
-
-    return gdf1[gdf1.index.isin(non_overlapping_indices)]
+    return gdf1[non_overlapping]
 
 
+@instrumented()
 def clip_and_combine(gdf1, gdf2, column):
     """
     Clip and combine gdf1 with gdf2 based on their intersection.
 
+    Only the features of gdf2 near gdf1, found with its cached spatial index, are overlaid, see
+    extract_overlapping_polygons.
+
     Args:
         gdf1 (GeoDataFrame): First GeoDataFrame.
-        gdf2 (GeoDataFrame): Second GeoDataFrame.
+        gdf2 (GeoDataFrame, str or IndexedLayer): Second GeoDataFrame, the path to it or its cached index. Only its
+            geometries are used.
         column (str): Name of the column to be added for indicating the intersection.
 
     Returns:
@@ -215,8 +321,15 @@ def clip_and_combine(gdf1, gdf2, column):
             - GeoDataFrame: GeoDataFrame representing the intersecting polygons.
             - GeoDataFrame: GeoDataFrame representing the non-intersecting polygons.
     """
+    current_stage().add(rows=len(gdf1))
     parcel_columns = gdf1.columns
 
+    # The features of gdf2 whose bounding boxes intersect gdf1, in the CRS of gdf1
+    index = cached_index(gdf2)
+    gdf2 = index.to_geodataframe(np.unique(_query_layer(gdf1, index, predicate=None)[2]))
+    if gdf1.crs is not None and gdf2.crs is not None:
+        gdf2 = reproject(gdf2, gdf1.crs)
+
     gdf_intersect = gpd.overlay(gdf1, gdf2, how='intersection', keep_geom_type=True)
     gdf_intersect = gdf_intersect.reindex(columns=parcel_columns)
     gdf_intersect[column] = True
@@ -311,8 +424,8 @@ def process_geospatial_data_to_dict(urls):
             print(f"Error reading files for {key}: {str(e)}")
             continue
 
-        # Fix invalid geometries
-        data[key] = fix_invalid_geometries(data[key])
+        # Fix invalid geometries, in place since nothing else holds the frame just read
+        data[key] = fix_invalid_geometries(data[key], copy=False)
 
         # Set 'status' to None before calling check_crs function
         data[key]['status'] = None
@@ -369,16 +482,23 @@ def add_overlap_indicator(gdf1, gdf2, column_name):
     """
     Add an overlap indicator column to gdf1 based on its intersection with gdf2.
 
+    Polygons overlap when their interiors intersect, so polygons that only touch gdf2 are not flagged.
+
     Args:
         gdf1 (GeoDataFrame): First GeoDataFrame.
-        gdf2 (GeoDataFrame): Second GeoDataFrame.
+        gdf2 (GeoDataFrame, str or IndexedLayer): Second GeoDataFrame, the path to it or its cached index, see
+            extract_overlapping_polygons.
         column_name (str): Name of the column to be added.
 
     Returns:
         GeoDataFrame: gdf1 with the overlap indicator column added.
     """
-    overlap = gpd.overlay(gdf1, gdf2, how='intersection')
-    gdf1[column_name] = gdf1.index.isin(overlap.index)
+    index = cached_index(gdf2)
+    geometries, positions, features = _query_layer(gdf1, index)
+
+    # Keep the intersecting pairs whose interiors intersect
+    interiors = shapely.relate_pattern(geometries[positions], index.geometries(features), 'T********')
+    gdf1[column_name] = np.isin(np.arange(len(gdf1)), positions[interiors])
     return gdf1
 
 
@@ -4,7 +4,13 @@ import json
 import requests
 import pprint
 import os
+import itertools
+import numpy as np
 import rasterio
+from ForestOps.geo_ops.raster_profiles import open_raster_writer
+from ForestOps.geo_ops.raster_cache import get_raster_cache
+from ForestOps.geo_ops.instrumentation import instrumented, current_stage
+from ForestOps.geo_ops.progress import track_progress, report
 
 
 '''
@@ -113,6 +119,7 @@ def get_feature_count(url):
     return data["count"]
 
 
+@instrumented(rows=len)
 def read_from_url(file_path, rows_per_request, offset, crs):
     """
     Read data from a URL in chunks and return a GeoDataFrame.
@@ -131,33 +138,34 @@ def read_from_url(file_path, rows_per_request, offset, crs):
     base_url = file_path.split("?")[0]  # Remove any existing parameters
     count = get_feature_count(url=base_url)
     max_rows = get_record_limit(file_path)
-    print(f"The max rows returned from the server is {max_rows}")
+    report(f"The max rows returned from the server is {max_rows}")
 
     if rows_per_request == 0 or rows_per_request > max_rows:
         # Determine the number of rows per request based on the record limit
         if rows_per_request == 0:
-            print(f"Record limit not set, using server limit of {max_rows}")
+            report(f"Record limit not set, using server limit of {max_rows}")
             rows_per_request = max_rows
         else:
-            print(f"Limit exceeded, using server limit of {max_rows}")
+            report(f"Limit exceeded, using server limit of {max_rows}")
             rows_per_request = max_rows
 
     number_requests = count / rows_per_request
-    print(f"Record count = {count}, splitting into {round(number_requests)} requests")
+    report(f"Record count = {count}, splitting into {round(number_requests)} requests")
 
     features = []
-    while True:
-        print(f"Offset: {offset}")
-        # Construct the query URL
-        query = f"{base_url}?outFields=*&outSR={crs}&where=1%3D1&f=geojson&resultOffset={offset}&resultRecordCount={rows_per_request}"
-        # Read data from the query URL
-        gdf = gpd.read_file(query)
+    with track_progress('Reading features', total=count, unit='features') as read:
+        while True:
+            # Construct the query URL
+            query = f"{base_url}?outFields=*&outSR={crs}&where=1%3D1&f=geojson&resultOffset={offset}&resultRecordCount={rows_per_request}"
+            # Read data from the query URL
+            gdf = gpd.read_file(query)
 
-        if len(gdf) == 0:
-            break
+            if len(gdf) == 0:
+                break
 
-        features.append(gdf)
-        offset += rows_per_request
+            features.append(gdf)
+            read.update(len(gdf))
+            offset += rows_per_request
 
     gdf = gpd.GeoDataFrame(pd.concat(features, ignore_index=True))
     # Set the coordinate reference system (CRS)
@@ -166,12 +174,16 @@ def read_from_url(file_path, rows_per_request, offset, crs):
     return gdf
 
 
-def read_raster_file(raster_file):
+@instrumented(pixels=lambda result: result[0].size, bytes=lambda result: result[0].nbytes)
+def read_raster_file(raster_file, cache=False):
     """
     Function to read a raster file using the rasterio library.
 
     Args:
         raster_file (str): Path to the raster file.
+        cache (bool): Read the band through the shared raster cache, so reading the same file again does not decode
+            it again. The array is then read-only and shared, so copy it before modifying it. Default is False,
+            which returns a new writable array.
 
     Returns:
         raster_array (numpy.ndarray): Array containing the raster data.
@@ -179,6 +191,11 @@ def read_raster_file(raster_file):
 
     """
 
+    # Read the band and profile through the shared cache
+    if cache:
+        raster_cache = get_raster_cache()
+        return raster_cache.read(raster_file), raster_cache.profile(raster_file)
+
     # Open the raster file using rasterio
     with rasterio.open(raster_file) as raster:
         # Read the raster data into an array
@@ -190,6 +207,95 @@ def read_raster_file(raster_file):
     return raster_array, raster_profile
 
 
+def _arrow_chunks(file_path, columns, chunk_size, read_geometry):
+    """
+    Read a vector file in batches from one pyogrio Arrow stream, so the file is read only once whatever the driver.
+
+    Args:
+        file_path (str): Path to the vector file.
+        columns (list): Names of the columns to read, or None to read every column.
+        chunk_size (int): Maximum number of rows in each batch.
+        read_geometry (bool): Also read the geometries, yielding GeoDataFrames.
+
+    Yields:
+        pandas.DataFrame or geopandas.GeoDataFrame: The next batch of rows.
+    """
+    import pyogrio
+
+    with pyogrio.open_arrow(file_path, columns=columns, read_geometry=read_geometry, batch_size=chunk_size,
+                            use_pyarrow=True) as (meta, reader):
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        for batch in reader:
+            chunk = batch.to_pandas()
+            if read_geometry:
+                geometry = gpd.GeoSeries.from_wkb(chunk.pop(geometry_name), crs=meta['crs'])
+                chunk = gpd.GeoDataFrame(chunk, geometry=geometry.rename('geometry'))
+            yield chunk
+
+
+def _fiona_chunks(file_path, columns, chunk_size, read_geometry):
+    """
+    Read a vector file in batches of features from one fiona collection.
+
+    Args:
+        file_path (str): Path to the vector file.
+        columns (list): Names of the columns to read, or None to read every column.
+        chunk_size (int): Maximum number of rows in each batch.
+        read_geometry (bool): Also read the geometries, yielding GeoDataFrames.
+
+    Yields:
+        pandas.DataFrame or geopandas.GeoDataFrame: The next batch of rows.
+    """
+    import fiona
+
+    with fiona.open(file_path) as source:
+        names = list(source.schema['properties']) if columns is None else columns
+        features = iter(source)
+        while True:
+            batch = list(itertools.islice(features, chunk_size))
+            if not batch:
+                break
+            if read_geometry:
+                yield gpd.GeoDataFrame.from_features(batch, crs=source.crs, columns=names + ['geometry'])
+            else:
+                yield pd.DataFrame([dict(feature['properties']) for feature in batch], columns=names)
+
+
+def read_attribute_chunks(file_path, columns, chunk_size=100000, read_geometry=False):
+    """
+    Read attribute columns of a vector file in chunks, by default without reading the geometries.
+
+    The chunks are the batches of one open cursor on the file, so drivers that can only read sequentially, such as
+    GeoJSON and CSV, are read once rather than scanned again from the start for every chunk. The batches are
+    streamed through Arrow when pyarrow is installed, and through fiona otherwise.
+
+    Args:
+        file_path (str): Path to the vector file.
+        columns (list): Names of the columns to read, or None to read every column.
+        chunk_size (int): Maximum number of rows in each chunk. Default is 100000.
+        read_geometry (bool): Also read the geometries, yielding GeoDataFrames. Default is False.
+
+    Yields:
+        pandas.DataFrame or geopandas.GeoDataFrame: The next chunk of rows, holding only the requested columns and,
+        with read_geometry, the geometry.
+    """
+    try:
+        import pyogrio  # noqa: F401
+        import pyarrow  # noqa: F401
+        read_chunks = _arrow_chunks
+    except ImportError:
+        read_chunks = _fiona_chunks
+
+    for chunk in read_chunks(file_path, columns, chunk_size, read_geometry):
+        if len(chunk) == 0:
+            continue
+        if columns is not None:
+            # Keep the columns in the order they were asked for
+            chunk = chunk[columns + ['geometry'] if read_geometry else columns]
+        yield chunk
+
+
+@instrumented(rows=lambda result: len(result) if isinstance(result, pd.DataFrame) else 0)
 def read_data(file_path, rows_per_request=0, offset=0, crs=27700):
     """
     Function to read geospatial data from different sources.
@@ -205,6 +311,9 @@ def read_data(file_path, rows_per_request=0, offset=0, crs=27700):
         gdf (geopandas.GeoDataFrame): Geospatial data as a GeoDataFrame.
 
     """
+    # Count the bytes read from local files, URLs and geodatabase folders are not counted
+    if os.path.isfile(file_path):
+        current_stage().add(bytes=os.path.getsize(file_path))
 
     # Check if the file path ends with specific extensions
     if file_path.endswith('.shp'):
@@ -252,31 +361,39 @@ def read_data(file_path, rows_per_request=0, offset=0, crs=27700):
 
 
 # Write out Datasets
-def write_raster(filename, data, transform, crs):
+@instrumented()
+def write_raster(filename, data, transform, crs, nodata=None, profile=None):
     """
     Write a GeoTIFF raster using the given data, transform, and CRS.
 
     Args:
         filename (str): Output file name.
-        data (numpy.ndarray): 2D numpy array of raster values.
+        data (numpy.ndarray): 2D numpy array of raster values, or 3D array of (bands, rows, columns) for a
+            multi-band raster.
         transform (affine.Affine): Affine transformation object.
         crs (rasterio.crs.CRS): CRS object.
+        nodata (float or int, optional): Nodata value of the raster. Defaults to None.
+        profile (str or dict, optional): Output profile such as 'tiled', 'zstd', 'lerc' or 'cog', or a profile
+            built with output_profile. Defaults to None, which writes a plain striped GeoTIFF.
 
     Returns:
         None.
     """
-    height, width = data.shape
-    count = 1
+    # Write a single band raster as a raster with one band
+    if data.ndim == 2:
+        data = data[np.newaxis, ...]
+    count, height, width = data.shape
     dtype = data.dtype
-    with rasterio.open(
+    current_stage().add(pixels=data.size, bytes=data.nbytes)
+    with open_raster_writer(
         filename,
-        'w',
-        driver='GTiff',
-        height=height,
         width=width,
+        height=height,
         count=count,
         dtype=dtype,
         crs=crs,
-        transform=transform
+        transform=transform,
+        nodata=nodata,
+        profile=profile
     ) as dst:
-        dst.write(data, 1)
\ No newline at end of file
+        dst.write(data)
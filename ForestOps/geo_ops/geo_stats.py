@@ -1,10 +1,877 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import geopandas as gpd
+import rasterio
+from rasterio import features
+from rasterio.windows import Window, from_bounds
+import rasterio.windows
+import shapely
 from shapely.geometry import Point, LineString, Polygon, MultiPoint
-from shapely.ops import transform, unary_union, polygonize, cascaded_union
-from osgeo import gdal
+from shapely.ops import transform, unary_union, polygonize
 # import rasterstats
 import numpy as np
+import pandas as pd
 from scipy.stats import skew, kurtosis
+from ForestOps.geo_ops.raster_cache import get_raster_cache
+from ForestOps.geo_ops.geo_io import read_attribute_chunks
+from ForestOps.geo_ops.crs_cache import reproject
+from ForestOps.geo_ops.raster_ops import block_windows
+from ForestOps.geo_ops.instrumentation import instrumented
+
+
+# Statistics computed by zonal_statistics
+ZONAL_STATS = ['min', 'mean', 'max', 'count', 'sum', 'std', 'median', 'majority']
+
+
+def _zone_layers(geometries, cell_size, all_touched=False):
+    """
+    Split zones into layers in which no two zones share a cell, so overlapping zones each keep all their cells.
+
+    Args:
+        geometries (numpy.ndarray): Zone geometries.
+        cell_size (float): Largest cell dimension of the raster.
+        all_touched (bool): Whether zones take every cell they touch, in which case zones less than a cell apart
+            can also share cells.
+
+    Returns:
+        numpy.ndarray: The layer of each zone, 0 for zones that do not overlap an earlier zone.
+    """
+    tree = shapely.STRtree(geometries)
+    if all_touched:
+        pairs = tree.query(geometries, predicate='dwithin', distance=cell_size * np.sqrt(2))
+    else:
+        pairs = np.concatenate([tree.query(geometries, predicate=predicate)
+                                for predicate in ['overlaps', 'contains', 'within']], axis=1)
+    pairs = pairs[:, pairs[0] < pairs[1]]
+
+    layers = np.zeros(len(geometries), dtype=np.int64)
+    if pairs.shape[1] == 0:
+        return layers
+
+    # Give each overlapping zone the lowest layer not taken by the earlier zones it overlaps
+    order = np.argsort(pairs[1], kind='stable')
+    later, earlier = pairs[1][order], pairs[0][order]
+    starts = np.flatnonzero(np.r_[True, later[1:] != later[:-1]])
+    ends = np.r_[starts[1:], len(later)]
+    for start, end in zip(starts, ends):
+        taken = set(layers[earlier[start:end]].tolist())
+        layer = 0
+        while layer in taken:
+            layer += 1
+        layers[later[start]] = layer
+    return layers
+
+
+def _zone_moments(zones, values, keep_values=False):
+    """
+    Reduce the cell values of a window to per-zone moments with sorted-segment reductions.
+
+    Args:
+        zones (numpy.ndarray): Zone of each cell.
+        values (numpy.ndarray): Value of each cell.
+        keep_values (bool): Also return the cells sorted by zone, for the median and majority.
+
+    Returns:
+        dict: The zones present and their count, sum, sum of squared deviations, minimum and maximum.
+    """
+    order = np.argsort(zones, kind='stable')
+    zones, values = zones[order], values[order]
+    starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+    counts = np.diff(np.r_[starts, len(zones)])
+    sums = np.add.reduceat(values, starts)
+    deviations = values - np.repeat(sums / counts, counts)
+
+    moments = {
+        'zones': zones[starts],
+        'count': counts,
+        'sum': sums,
+        'm2': np.add.reduceat(deviations * deviations, starts),
+        'min': np.minimum.reduceat(values, starts),
+        'max': np.maximum.reduceat(values, starts),
+    }
+    if keep_values:
+        moments['cell_zones'], moments['cell_values'] = zones, values
+    return moments
+
+
+def _segment_median_majority(zones, values):
+    """
+    Compute the median and majority of each zone from all its cell values.
+
+    The majority is the most frequent value, the smallest one on ties.
+
+    Args:
+        zones (numpy.ndarray): Zone of each cell.
+        values (numpy.ndarray): Value of each cell.
+
+    Returns:
+        tuple: The zones present, their median and their majority.
+    """
+    order = np.lexsort((values, zones))
+    zones, values = zones[order], values[order]
+    starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+    counts = np.diff(np.r_[starts, len(zones)])
+    medians = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+
+    # Runs of equal values within each zone, longest first and then smallest value first
+    runs = np.flatnonzero(np.r_[True, (zones[1:] != zones[:-1]) | (values[1:] != values[:-1])])
+    run_lengths = np.diff(np.r_[runs, len(zones)])
+    run_zones, run_values = zones[runs], values[runs]
+    order = np.lexsort((run_values, -run_lengths, run_zones))
+    run_zones, run_values = run_zones[order], run_values[order]
+    firsts = np.flatnonzero(np.r_[True, run_zones[1:] != run_zones[:-1]])
+
+    return zones[starts], medians, run_values[firsts]
+
+
+@instrumented(rows=len)
+def native_zonal_statistics(raster_file, zones_gdf, stats=None, band=1, nodata=None, all_touched=False,
+                            block_size=1024, workers=1):
+    """
+    Compute zonal statistics by rasterising the zones onto the raster grid window by window.
+
+    Each window of the raster is read once, the zones intersecting it are burned as zone ids, and the statistics of
+    every zone are reduced at once with sorted-segment reductions. Partial results of the windows are merged, so a
+    zone spanning several windows gets the same result as if the raster were read whole. Zones that overlap are
+    burned in separate layers, so each keeps all of its cells.
+
+    Args:
+        raster_file (str): Path to the raster.
+        zones_gdf (GeoDataFrame): The zones, reprojected to the CRS of the raster when both have a CRS.
+        stats (list, optional): Statistics to compute, from ZONAL_STATS. Defaults to all of them.
+        band (int): Band number. Default is 1.
+        nodata (float or int, optional): Value of cells to ignore. Defaults to the nodata value of the raster.
+        all_touched (bool): Include every cell touched by a zone, rather than the cells whose centre is in it.
+            Default is False.
+        block_size (int): Width and height of the windows in pixels. Default is 1024.
+        workers (int): Number of threads reading and reducing windows. Default is 1.
+
+    Returns:
+        list: A dictionary of statistics for each zone, in the order of zones_gdf. Zones without valid cells have a
+        count of 0 and None for the other statistics.
+    """
+    if stats is None:
+        stats = list(ZONAL_STATS)
+    unknown = [stat for stat in stats if stat not in ZONAL_STATS]
+    if unknown:
+        raise ValueError(f"Invalid stats {', '.join(unknown)}. Must be one of {', '.join(ZONAL_STATS)}.")
+    keep_values = 'median' in stats or 'majority' in stats
+
+    with rasterio.open(raster_file) as src:
+        raster_crs, width, height = src.crs, src.width, src.height
+        cell_size = max(abs(src.res[0]), abs(src.res[1]))
+        if nodata is None:
+            nodata = src.nodata
+
+    if zones_gdf.crs is not None and raster_crs is not None:
+        zones_gdf = reproject(zones_gdf, raster_crs)
+
+    # Missing and empty zones cannot be burned and keep a count of 0
+    geometries = zones_gdf.geometry.values
+    burnable = np.flatnonzero(~(geometries.isna() | geometries.is_empty))
+    geometries = np.asarray(geometries)[burnable]
+    layers = _zone_layers(geometries, cell_size, all_touched=all_touched)
+    tree = shapely.STRtree(geometries)
+
+    # Dataset handles must not be shared between threads, so each thread opens its own
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def reduce_window(window):
+        if not hasattr(local, 'src'):
+            local.src = rasterio.open(raster_file)
+            with handles_lock:
+                handles.append(local.src)
+        src = local.src
+
+        left, bottom, right, top = src.window_bounds(window)
+        candidates = tree.query(shapely.box(left, bottom, right, top), predicate='intersects')
+        if len(candidates) == 0:
+            return None
+
+        data = src.read(band, window=window)
+        valid = np.ones(data.shape, dtype=bool)
+        if nodata is not None:
+            valid &= data != nodata
+        if np.issubdtype(data.dtype, np.floating):
+            valid &= ~np.isnan(data)
+
+        # Clip the zones to the window, grown by a cell so edges burn the same as without clipping
+        clipped = shapely.clip_by_rect(geometries[candidates], left - cell_size, bottom - cell_size,
+                                       right + cell_size, top + cell_size)
+        shape = (int(window.height), int(window.width))
+        window_transform = src.window_transform(window)
+
+        zone_parts, value_parts = [], []
+        for layer in np.unique(layers[candidates]):
+            members = np.flatnonzero(layers[candidates] == layer)
+            shapes = [(clipped[i], int(candidates[i]) + 1) for i in members if not clipped[i].is_empty]
+            if not shapes:
+                continue
+            zone_ids = features.rasterize(shapes, out_shape=shape, transform=window_transform, fill=0,
+                                          all_touched=all_touched, dtype='int32')
+            cells = (zone_ids > 0) & valid
+            zone_parts.append(zone_ids[cells] - 1)
+            value_parts.append(data[cells])
+
+        zones = np.concatenate(zone_parts) if zone_parts else np.empty(0, dtype=np.int32)
+        if len(zones) == 0:
+            return None
+        return _zone_moments(zones, np.concatenate(value_parts).astype(np.float64), keep_values=keep_values)
+
+    count = np.zeros(len(geometries), dtype=np.int64)
+    total = np.zeros(len(geometries))
+    m2 = np.zeros(len(geometries))
+    minimum = np.full(len(geometries), np.inf)
+    maximum = np.full(len(geometries), -np.inf)
+    cell_zones, cell_values = [], []
+
+    def merge_window(moments):
+        if moments is None:
+            return
+        zones = moments['zones']
+        count_a, count_b = count[zones], moments['count']
+        merged = count_a + count_b
+        # Chan's update combines the squared deviations of the zone so far with those of the window
+        mean_a = np.divide(total[zones], count_a, out=np.zeros(len(zones)), where=count_a > 0)
+        delta = moments['sum'] / count_b - mean_a
+        m2[zones] += moments['m2'] + delta * delta * count_a * count_b / merged
+        count[zones] = merged
+        total[zones] += moments['sum']
+        minimum[zones] = np.minimum(minimum[zones], moments['min'])
+        maximum[zones] = np.maximum(maximum[zones], moments['max'])
+        if keep_values:
+            cell_zones.append(moments['cell_zones'])
+            cell_values.append(moments['cell_values'])
+
+    windows = block_windows(width, height, block_size)
+    try:
+        if workers <= 1:
+            for window in windows:
+                merge_window(reduce_window(window))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Submit a few batches at a time so finished windows do not pile up ahead of the merge
+                batch_size = workers * 4
+                for i in range(0, len(windows), batch_size):
+                    for moments in executor.map(reduce_window, windows[i:i + batch_size]):
+                        merge_window(moments)
+    finally:
+        for handle in handles:
+            handle.close()
+
+    medians = np.full(len(geometries), np.nan)
+    majorities = np.full(len(geometries), np.nan)
+    if keep_values and cell_zones:
+        zones, zone_medians, zone_majorities = _segment_median_majority(np.concatenate(cell_zones),
+                                                                        np.concatenate(cell_values))
+        medians[zones], majorities[zones] = zone_medians, zone_majorities
+
+    # Gather the statistics of every zone, in the order of the input
+    results = [{stat: (0 if stat == 'count' else None) for stat in stats} for _ in range(len(zones_gdf))]
+    computed = {
+        'min': minimum,
+        'max': maximum,
+        'sum': total,
+        'mean': np.divide(total, count, out=np.zeros(len(count)), where=count > 0),
+        'std': np.sqrt(np.divide(m2, count, out=np.zeros(len(count)), where=count > 0)),
+        'median': medians,
+        'majority': majorities,
+    }
+    for zone in np.flatnonzero(count):
+        result = results[burnable[zone]]
+        for stat in stats:
+            result[stat] = int(count[zone]) if stat == 'count' else float(computed[stat][zone])
+    return results
+
+
+# Statistics computed by coverage_zonal_statistics
+COVERAGE_STATS = ['count', 'sum', 'mean', 'std', 'min', 'max']
+
+
+def _cell_boxes(window_transform, rows, cols):
+    """
+    Build the boxes of cells of a window.
+
+    Args:
+        window_transform (affine.Affine): Affine transform of the window.
+        rows (numpy.ndarray): Rows of the cells.
+        cols (numpy.ndarray): Columns of the cells.
+
+    Returns:
+        numpy.ndarray: The cell boxes.
+    """
+    left, top = window_transform * (cols, rows)
+    right, bottom = window_transform * (cols + 1, rows + 1)
+    return shapely.box(np.minimum(left, right), np.minimum(bottom, top), np.maximum(left, right),
+                       np.maximum(bottom, top))
+
+
+def coverage_weights(geometry, window_transform, shape, max_direct_cells=4096):
+    """
+    Compute the fraction of each cell of a window covered by a polygon.
+
+    Cells crossed by the polygon boundary get the exact area of their intersection with the polygon, in the style of
+    exactextract, and every other cell is either fully inside or fully outside. Small windows test every cell box
+    against the polygon at once. Larger windows find the boundary cells by burning the boundary, and decide the
+    other cells by their centre.
+
+    Args:
+        geometry (shapely.Geometry): Polygon or MultiPolygon.
+        window_transform (affine.Affine): Affine transform of the window.
+        shape (tuple): Number of rows and columns of the window.
+        max_direct_cells (int): Largest window, in cells, whose cell boxes are all tested. Default is 4096.
+
+    Returns:
+        numpy.ndarray: The covered fraction of each cell, between 0 and 1.
+    """
+    shapely.prepare(geometry)
+
+    if shape[0] * shape[1] <= max_direct_cells:
+        rows, cols = np.indices(shape).reshape(2, -1)
+        cells = _cell_boxes(window_transform, rows, cols)
+        weights = shapely.contains_properly(geometry, cells).astype(np.float64)
+        boundary = np.flatnonzero(shapely.intersects(geometry, cells) & (weights == 0))
+        weights[boundary] = shapely.area(shapely.intersection(cells[boundary], geometry)) / \
+            shapely.area(cells[boundary])
+        return weights.reshape(shape)
+
+    weights = features.rasterize([(geometry, 1)], out_shape=shape, transform=window_transform, fill=0,
+                                 dtype='uint8').astype(np.float64)
+    boundary = features.rasterize([(shapely.boundary(geometry), 1)], out_shape=shape, transform=window_transform,
+                                  fill=0, all_touched=True, dtype='uint8').astype(bool)
+
+    # Intersect only the boundary cells with the polygon, all at once
+    rows, cols = np.nonzero(boundary)
+    if len(rows):
+        cells = _cell_boxes(window_transform, rows, cols)
+        weights[rows, cols] = shapely.area(shapely.intersection(cells, geometry)) / shapely.area(cells)
+    return weights
+
+
+@instrumented(rows=len)
+def coverage_zonal_statistics(raster_file, zones_gdf, stats=None, band=1, nodata=None, workers=1):
+    """
+    Compute zonal statistics weighted by the fraction of each cell covered by each polygon.
+
+    Small polygons keep the cells they partly cover instead of getting none, or a biased mean from the few cells whose
+    centre they contain. Each polygon reads only the window of the raster under its bounding box.
+
+    Args:
+        raster_file (str): Path to the raster.
+        zones_gdf (GeoDataFrame): The polygons, reprojected to the CRS of the raster when both have a CRS.
+        stats (list, optional): Statistics to compute, from COVERAGE_STATS. 'count' is the covered number of cells,
+            'sum', 'mean' and 'std' are weighted by coverage, and 'min' and 'max' are over the cells the polygon
+            touches. Defaults to all of them.
+        band (int): Band number. Default is 1.
+        nodata (float or int, optional): Value of cells to ignore. Defaults to the nodata value of the raster.
+        workers (int): Number of threads reading windows and computing weights. Default is 1.
+
+    Returns:
+        list: A dictionary of statistics for each polygon, in the order of zones_gdf. Polygons without valid cells
+        have a count of 0 and None for the other statistics.
+    """
+    if stats is None:
+        stats = list(COVERAGE_STATS)
+    unknown = [stat for stat in stats if stat not in COVERAGE_STATS]
+    if unknown:
+        raise ValueError(f"Invalid stats {', '.join(unknown)}. Must be one of {', '.join(COVERAGE_STATS)}.")
+
+    with rasterio.open(raster_file) as src:
+        raster_crs = src.crs
+        if nodata is None:
+            nodata = src.nodata
+
+    if zones_gdf.crs is not None and raster_crs is not None:
+        zones_gdf = reproject(zones_gdf, raster_crs)
+
+    # Dataset handles must not be shared between threads, so each thread opens its own
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def polygon_statistics(geometry):
+        empty = {stat: (0 if stat == 'count' else None) for stat in stats}
+        if geometry is None or geometry.is_empty:
+            return empty
+
+        if not hasattr(local, 'src'):
+            local.src = rasterio.open(raster_file)
+            with handles_lock:
+                handles.append(local.src)
+        src = local.src
+
+        # Read the window of whole cells under the bounding box of the polygon
+        window = from_bounds(*geometry.bounds, transform=src.transform)
+        col_off, row_off = np.floor(window.col_off), np.floor(window.row_off)
+        window = Window(col_off, row_off, np.ceil(window.col_off + window.width) - col_off,
+                        np.ceil(window.row_off + window.height) - row_off)
+        extent = Window(0, 0, src.width, src.height)
+        if not rasterio.windows.intersect([window, extent]):
+            return empty
+        window = window.intersection(extent)
+        data = src.read(band, window=window).astype(np.float64)
+        weights = coverage_weights(geometry, src.window_transform(window), data.shape)
+
+        cells = weights > 0
+        if nodata is not None:
+            cells &= data != nodata
+        cells &= ~np.isnan(data)
+        values, weights = data[cells], weights[cells]
+        if len(values) == 0:
+            return empty
+
+        count = weights.sum()
+        mean = (values * weights).sum() / count
+        computed = {
+            'count': count,
+            'sum': (values * weights).sum(),
+            'mean': mean,
+            'std': np.sqrt((weights * (values - mean) ** 2).sum() / count),
+            'min': values.min(),
+            'max': values.max(),
+        }
+        return {stat: float(computed[stat]) for stat in stats}
+
+    geometries = list(zones_gdf.geometry)
+    try:
+        if workers <= 1:
+            return [polygon_statistics(geometry) for geometry in geometries]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(polygon_statistics, geometries, chunksize=64))
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+# Statistics returned by StreamingSummary and GroupedSummary
+SUMMARY_STATS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max', 'sum', 'skewness', 'kurtosis', 'range',
+                 'iqr', 'cv', 'geometric_mean', 'harmonic_mean', 'mode']
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch in the style of KLL.
+
+    Values are kept exactly until there are more than sketch_size of them. After that, full levels are sorted and
+    every other value is promoted to the next level with twice the weight, so memory stays around sketch_size values
+    per level while rank errors stay small.
+
+    Args:
+        sketch_size (int): Number of values held per level. Default is 8192.
+        seed (int, optional): Seed of the random offsets used when compacting.
+    """
+
+    def __init__(self, sketch_size=8192, seed=None):
+        self.sketch_size = sketch_size
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        """
+        Add values to the sketch.
+
+        Args:
+            values (numpy.ndarray): Values to add.
+        """
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(values, dtype=np.float64)])
+        self._compact()
+
+    def merge(self, other):
+        """
+        Add the values summarised by another sketch.
+
+        Args:
+            other (QuantileSketch): The sketch to merge in.
+        """
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.sketch_size:
+                values = np.sort(values)
+                # An odd value out stays on this level, the rest promote every other value
+                even = len(values) - len(values) % 2
+                promoted = values[self._rng.integers(2):even:2]
+                self.levels[level] = values[even:]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def percentile(self, q):
+        """
+        Return the percentiles of the values added.
+
+        While every value is still held this matches numpy.percentile.
+
+        Args:
+            q (float or list): Percentiles between 0 and 100.
+
+        Returns:
+            numpy.ndarray or float: The percentiles, NaN when the sketch is empty.
+        """
+        if len(self.levels) == 1:
+            if len(self.levels[0]) == 0:
+                return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+            return np.percentile(self.levels[0], q)
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 2 ** level) for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, cumulative = values[order], np.cumsum(weights[order])
+        ranks = np.asarray(q, dtype=np.float64) / 100 * cumulative[-1]
+        return values[np.minimum(np.searchsorted(cumulative, ranks), len(values) - 1)]
+
+
+class FrequentValues:
+    """
+    Mergeable Misra-Gries sketch of the most frequent values.
+
+    Counts are exact while there are at most capacity distinct values. Beyond that, any value more frequent than
+    1 / (capacity + 1) of the total is still kept, with its count underestimated by at most that fraction.
+
+    Args:
+        capacity (int): Number of distinct values counted. Default is 8192.
+    """
+
+    def __init__(self, capacity=8192):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+
+    def update(self, values):
+        """
+        Count values.
+
+        Args:
+            values (array-like): Values to count.
+        """
+        self._add(pd.Series(values).value_counts(sort=False))
+
+    def merge(self, other):
+        """
+        Add the counts of another sketch.
+
+        Args:
+            other (FrequentValues): The sketch to merge in.
+        """
+        self._add(other.counts)
+
+    def _add(self, counts):
+        counts = self.counts.add(counts, fill_value=0).astype(np.int64) if len(self.counts) else counts
+        if len(counts) > self.capacity:
+            # Subtract the count of the first value that does not fit from every count, dropping the values at zero
+            threshold = np.partition(counts.to_numpy(), -(self.capacity + 1))[-(self.capacity + 1)]
+            counts = counts - threshold
+            counts = counts[counts > 0]
+        self.counts = counts
+
+    def mode(self):
+        """
+        Return the most frequent value, the smallest one on ties.
+
+        Returns:
+            The mode, or NaN when nothing was counted.
+        """
+        if len(self.counts) == 0:
+            return np.nan
+        top = self.counts[self.counts == self.counts.max()]
+        return top.index.min()
+
+
+class StreamingSummary:
+    """
+    Single pass, mergeable summary statistics of a numeric attribute.
+
+    Count, sum, extrema and the central moments up to the fourth are combined exactly between chunks with the
+    pairwise update of Pebay, while percentiles and the mode come from a QuantileSketch and a FrequentValues sketch.
+    Missing values are ignored.
+
+    Args:
+        sketch_size (int): Size of the percentile and mode sketches. Default is 8192.
+    """
+
+    def __init__(self, sketch_size=8192):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.total = 0.0
+        self.log_total = 0.0
+        self.reciprocal_total = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.quantiles = QuantileSketch(sketch_size)
+        self.frequent = FrequentValues(sketch_size)
+
+    def update(self, values):
+        """
+        Add a chunk of values.
+
+        Args:
+            values (array-like): Values to add.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        chunk = StreamingSummary(self.quantiles.sketch_size)
+        chunk.count = len(values)
+        chunk.mean = values.mean()
+        deviations = values - chunk.mean
+        squared = deviations * deviations
+        chunk.m2 = squared.sum()
+        chunk.m3 = (squared * deviations).sum()
+        chunk.m4 = (squared * squared).sum()
+        chunk.total = values.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunk.log_total = np.log(values).sum()
+            chunk.reciprocal_total = (1 / values).sum()
+        chunk.minimum, chunk.maximum = values.min(), values.max()
+        self.merge(chunk, sketches=False)
+        self.quantiles.update(values)
+        self.frequent.update(values)
+
+    def merge(self, other, sketches=True):
+        """
+        Combine with the summary of other values.
+
+        Args:
+            other (StreamingSummary): The summary to merge in.
+            sketches (bool): Also merge the percentile and mode sketches. Default is True.
+        """
+        if sketches:
+            self.quantiles.merge(other.quantiles)
+            self.frequent.merge(other.frequent)
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.m3, self.m4 = other.count, other.mean, other.m2, other.m3, other.m4
+        else:
+            n_a, n_b = self.count, other.count
+            n = n_a + n_b
+            delta = other.mean - self.mean
+            m2 = self.m2 + other.m2 + delta ** 2 * n_a * n_b / n
+            m3 = (self.m3 + other.m3 + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2
+                  + 3 * delta * (n_a * other.m2 - n_b * self.m2) / n)
+            m4 = (self.m4 + other.m4 + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n ** 3
+                  + 6 * delta ** 2 * (n_a ** 2 * other.m2 + n_b ** 2 * self.m2) / n ** 2
+                  + 4 * delta * (n_a * other.m3 - n_b * self.m3) / n)
+            self.count, self.mean, self.m2, self.m3, self.m4 = n, self.mean + delta * n_b / n, m2, m3, m4
+        self.total += other.total
+        self.log_total += other.log_total
+        self.reciprocal_total += other.reciprocal_total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def summary(self):
+        """
+        Return the statistics of geospatial_summary_stats.
+
+        Returns:
+            dict: count, mean, std, min, 25%, 50%, 75%, max, sum, skewness, kurtosis, range, iqr, cv,
+            geometric_mean, harmonic_mean and mode.
+        """
+        n = self.count
+        q25, q50, q75 = self.quantiles.percentile([25, 50, 75]) if n else (np.nan, np.nan, np.nan)
+        std = np.sqrt(self.m2 / (n - 1)) if n > 1 else np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {
+                'count': n,
+                'mean': self.mean if n else np.nan,
+                'std': std,
+                'min': self.minimum if n else np.nan,
+                '25%': q25,
+                '50%': q50,
+                '75%': q75,
+                'max': self.maximum if n else np.nan,
+                'sum': self.total,
+                'skewness': np.sqrt(n) * self.m3 / self.m2 ** 1.5 if n else np.nan,
+                'kurtosis': n * self.m4 / self.m2 ** 2 - 3 if n else np.nan,
+                'range': self.maximum - self.minimum if n else np.nan,
+                'iqr': q75 - q25,
+                'cv': std / self.mean * 100 if n else np.nan,
+                'geometric_mean': np.exp(self.log_total / n) if n else np.nan,
+                'harmonic_mean': n / self.reciprocal_total if n else np.nan,
+                'mode': self.frequent.mode(),
+            }
+
+
+class GroupedSummary:
+    """
+    Mergeable summary statistics of a numeric attribute per group.
+
+    Each chunk is reduced to per-group moments with vectorised groupby sums, and chunks are combined with the same
+    pairwise update as StreamingSummary, applied to every group at once. Percentiles come from a QuantileSketch per
+    group, and the mode from value counts per group capped in the Misra-Gries way. Rows with a missing value or group
+    are ignored.
+
+    Args:
+        sketch_size (int): Size of the percentile and mode sketches of each group. Default is 8192.
+    """
+
+    def __init__(self, sketch_size=8192):
+        self.sketch_size = sketch_size
+        self.moments = None
+        self.quantiles = {}
+        self.frequent = None
+
+    def update(self, groups, values):
+        """
+        Add a chunk of values.
+
+        Args:
+            groups (pandas.DataFrame or pandas.Series): Group of each value, one column per grouping key.
+            values (array-like): Values to add.
+        """
+        frame = pd.DataFrame(groups).reset_index(drop=True)
+        keys = list(frame.columns)
+        frame['value'] = np.asarray(values, dtype=np.float64)
+        frame = frame[frame.notna().all(axis=1)]
+        if len(frame) == 0:
+            return
+
+        grouped = frame.groupby(keys, sort=False)['value']
+        value = frame['value']
+        deviation = value - grouped.transform('mean')
+        squared = deviation * deviation
+        with np.errstate(divide='ignore', invalid='ignore'):
+            parts = pd.DataFrame({'m2': squared, 'm3': squared * deviation, 'm4': squared * squared,
+                                  'log_total': np.log(value), 'reciprocal_total': 1 / value})
+        sums = parts.groupby([frame[key] for key in keys], sort=False).sum()
+        moments = pd.DataFrame({
+            'count': grouped.size(),
+            'mean': grouped.mean(),
+            'total': grouped.sum(),
+            'minimum': grouped.min(),
+            'maximum': grouped.max(),
+        }).join(sums)
+        self._merge_moments(moments)
+
+        values = value.to_numpy()
+        for key, positions in grouped.indices.items():
+            if key not in self.quantiles:
+                self.quantiles[key] = QuantileSketch(self.sketch_size)
+            self.quantiles[key].update(values[positions])
+        self._merge_counts(frame.groupby(keys + ['value'], sort=False).size())
+
+    def merge(self, other):
+        """
+        Combine with the summary of other values.
+
+        Args:
+            other (GroupedSummary): The summary to merge in.
+        """
+        if other.moments is None:
+            return
+        self._merge_moments(other.moments)
+        for key, sketch in other.quantiles.items():
+            if key in self.quantiles:
+                self.quantiles[key].merge(sketch)
+            else:
+                self.quantiles[key] = sketch
+        self._merge_counts(other.frequent)
+
+    def _merge_moments(self, other):
+        if self.moments is None:
+            self.moments = other
+            return
+
+        a, b = self.moments.align(other, join='outer')
+        fill = {'minimum': np.inf, 'maximum': -np.inf}
+        a = a.fillna({column: fill.get(column, 0) for column in a.columns})
+        b = b.fillna({column: fill.get(column, 0) for column in b.columns})
+
+        # The pairwise update reduces to the other side when one side of a group is empty
+        n_a, n_b = a['count'], b['count']
+        n = n_a + n_b
+        delta = b['mean'] - a['mean']
+        merged = pd.DataFrame({
+            'count': n,
+            'mean': a['mean'] + delta * n_b / n,
+            'total': a['total'] + b['total'],
+            'minimum': np.minimum(a['minimum'], b['minimum']),
+            'maximum': np.maximum(a['maximum'], b['maximum']),
+            'm2': a['m2'] + b['m2'] + delta ** 2 * n_a * n_b / n,
+            'm3': (a['m3'] + b['m3'] + delta ** 3 * n_a * n_b * (n_a - n_b) / n ** 2
+                   + 3 * delta * (n_a * b['m2'] - n_b * a['m2']) / n),
+            'm4': (a['m4'] + b['m4'] + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n ** 3
+                   + 6 * delta ** 2 * (n_a ** 2 * b['m2'] + n_b ** 2 * a['m2']) / n ** 2
+                   + 4 * delta * (n_a * b['m3'] - n_b * a['m3']) / n),
+            'log_total': a['log_total'] + b['log_total'],
+            'reciprocal_total': a['reciprocal_total'] + b['reciprocal_total'],
+        })
+        self.moments = merged
+
+    def _merge_counts(self, counts):
+        if self.frequent is not None:
+            counts = self.frequent.add(counts, fill_value=0).astype(np.int64)
+        group_levels = list(range(counts.index.nlevels - 1))
+
+        # Cap every group at sketch_size distinct values, subtracting the count of the first value that does not fit
+        sizes = counts.groupby(level=group_levels, sort=False).size()
+        if sizes.max() > self.sketch_size:
+            rank = counts.groupby(level=group_levels, sort=False).rank(method='first', ascending=False)
+            threshold = counts.where(rank == self.sketch_size + 1).groupby(level=group_levels, sort=False).max()
+            threshold = threshold.reindex(counts.index.droplevel(-1)).fillna(0).to_numpy()
+            counts = counts - threshold.astype(np.int64)
+            counts = counts[counts > 0]
+        self.frequent = counts
+
+    def summary(self):
+        """
+        Return the statistics of geospatial_summary_stats for every group.
+
+        Returns:
+            pandas.DataFrame: One row per group, with the count, mean, std, min, 25%, 50%, 75%, max, sum, skewness,
+            kurtosis, range, iqr, cv, geometric_mean, harmonic_mean and mode columns.
+        """
+        if self.moments is None:
+            return pd.DataFrame(columns=SUMMARY_STATS)
+
+        moments = self.moments.sort_index()
+        n = moments['count']
+        percentiles = pd.DataFrame([self.quantiles[key].percentile([25, 50, 75]) for key in moments.index],
+                                   index=moments.index, columns=['25%', '50%', '75%'])
+
+        # The mode is the most frequent value of each group, the smallest one on ties
+        counts = self.frequent.rename('frequency').reset_index()
+        keys = list(counts.columns[:-2])
+        counts = counts.sort_values(keys + ['frequency', 'value'], ascending=[True] * len(keys) + [False, True])
+        mode = counts.drop_duplicates(keys).set_index(keys)['value']
+
+        std = np.sqrt(moments['m2'] / (n - 1)).where(n > 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary = pd.DataFrame({
+                'count': n.astype(np.int64),
+                'mean': moments['mean'],
+                'std': std,
+                'min': moments['minimum'],
+                '25%': percentiles['25%'],
+                '50%': percentiles['50%'],
+                '75%': percentiles['75%'],
+                'max': moments['maximum'],
+                'sum': moments['total'],
+                'skewness': np.sqrt(n) * moments['m3'] / moments['m2'] ** 1.5,
+                'kurtosis': n * moments['m4'] / moments['m2'] ** 2 - 3,
+                'range': moments['maximum'] - moments['minimum'],
+                'iqr': percentiles['75%'] - percentiles['25%'],
+                'cv': std / moments['mean'] * 100,
+                'geometric_mean': np.exp(moments['log_total'] / n),
+                'harmonic_mean': n / moments['reciprocal_total'],
+                'mode': mode.reindex(moments.index),
+            })
+        return summary
+
 
 class GeospatialStatistics:
 
@@ -12,31 +879,168 @@ class GeospatialStatistics:
         self.polygon_file = polygon_file
         self.attribute = attribute
 
-    def zonal_statistics(self, raster_file, vector_file, stats=None):
+    def zonal_statistics(self, raster_file, vector_file, stats=None, engine='native', nodata=None, all_touched=False,
+                         block_size=1024, workers=1, coverage=False):
         """
         Computes statistical measures for a set of raster cells or polygons that intersect with another set of polygons or regions.
 
         Parameters:
             raster_file (str): The file path of the input raster dataset.
-            vector_file (str): The file path of the input vector dataset.
+            vector_file (str or GeoDataFrame): The file path of the input vector dataset, or the zones themselves.
             stats (list): The statistical measures to compute as a list of strings. Default is None, which computes all stats.
+            engine (str): 'native' to rasterise the zones window by window with native_zonal_statistics, or
+                'rasterstats' to process the polygons one by one with rasterstats. Default is 'native'.
+            nodata (float or int, optional): Value of cells to ignore. Defaults to the nodata value of the raster.
+            all_touched (bool): Include every cell touched by a polygon. Default is False.
+            block_size (int): Window size in pixels for the native engine. Default is 1024.
+            workers (int): Number of threads for the native engine. Default is 1.
+            coverage (bool): Weight every cell by the fraction of it covered by the polygon, with
+                coverage_zonal_statistics. Supports the stats in COVERAGE_STATS and the native engine only.
+                Default is False.
 
         Returns:
-            A dictionary containing the statistics for each polygon in the input vector dataset.
+            A list containing a dictionary of statistics for each polygon in the input vector dataset.
         """
+        if engine not in ['native', 'rasterstats']:
+            raise ValueError("Invalid engine. Must be 'native' or 'rasterstats'.")
+        if coverage and engine != 'native':
+            raise ValueError("Coverage weighted statistics require the native engine.")
         if stats is None:
-            stats = ['min', 'mean', 'max', 'count', 'sum', 'std', 'median', 'majority']
-        stats_dict = rasterstats.zonal_stats(vector_file, raster_file, stats=stats, nodata=-999)
+            stats = list(COVERAGE_STATS) if coverage else ['min', 'mean', 'max', 'count', 'sum', 'std', 'median',
+                                                           'majority']
+
+        if engine == 'native':
+            zones = vector_file if isinstance(vector_file, gpd.GeoDataFrame) else gpd.read_file(vector_file)
+            if coverage:
+                return coverage_zonal_statistics(raster_file, zones, stats=stats, nodata=nodata, workers=workers)
+            return native_zonal_statistics(raster_file, zones, stats=stats, nodata=nodata, all_touched=all_touched,
+                                           block_size=block_size, workers=workers)
+
+        import rasterstats
+
+        # Pass the band from the shared raster cache, so repeated runs against the same raster do not decode it again
+        raster_cache = get_raster_cache()
+        raster_array = raster_cache.read(raster_file)
+        profile = raster_cache.profile(raster_file)
+        stats_dict = rasterstats.zonal_stats(vector_file, raster_array, affine=profile['transform'], stats=stats,
+                                             nodata=nodata if nodata is not None else profile['nodata'],
+                                             all_touched=all_touched)
 
         return stats_dict
 
-    def geospatial_summary_stats(self, stats=None):
-        # Read in the polygon file as a GeoDataFrame
-        polygons = gpd.read_file(self.polygon_file)
+    def grouped_summary_stats(self, by=None, regions=None, region_column=None, predicate=None, stats=None,
+                              chunk_size=100000, workers=1, sketch_size=8192):
+        """
+        Summarise the attribute of the polygon file per group, with the statistics of geospatial_summary_stats.
+
+        Groups are the values of attribute columns, the regions of another polygon layer each polygon falls in, or
+        both. The file is read in chunks, each chunk is reduced with a GroupedSummary, and the partial summaries are
+        merged, so chunks can be reduced in parallel.
 
-        # Calculate summary statistics for the given attribute
+        Parameters:
+            by (str or list, optional): Column or columns of the polygon file to group by.
+            regions (str or GeoDataFrame, optional): Polygon layer, or the path to one, to group spatially by.
+            region_column (str, optional): Column of regions naming each region. Required with regions.
+            predicate (str, optional): Spatial predicate between the polygons and the regions, e.g. 'intersects',
+                in which case a polygon counts towards every region it matches. Defaults to assigning each polygon
+                to the regions containing its representative point.
+            stats (list, optional): Statistics to return, from SUMMARY_STATS. Defaults to all of them.
+            chunk_size (int): Number of rows read at a time. Default is 100000.
+            workers (int): Number of threads reducing chunks. Default is 1.
+            sketch_size (int): Size of the percentile and mode sketches of each group. Default is 8192.
+
+        Returns:
+            A DataFrame with one row per group and one column per statistic.
+        """
+        if by is None and regions is None:
+            raise ValueError("Either by or regions is required.")
+        if regions is not None and region_column is None:
+            raise ValueError("region_column is required when grouping by regions.")
+        by = [by] if isinstance(by, str) else list(by or [])
+        if stats is None:
+            stats = list(SUMMARY_STATS)
+        unknown = [stat for stat in stats if stat not in SUMMARY_STATS]
+        if unknown:
+            raise ValueError(f"Invalid stats {', '.join(unknown)}. Must be one of {', '.join(SUMMARY_STATS)}.")
+
+        if regions is not None and not isinstance(regions, gpd.GeoDataFrame):
+            regions = gpd.read_file(regions)
+        keys = ([region_column] if regions is not None else []) + by
+
+        def summarise(chunk):
+            if regions is None:
+                groups, values = chunk[by], chunk[self.attribute]
+            else:
+                # Join the chunk to the regions through the spatial index of the regions
+                left = pd.DataFrame(chunk[[self.attribute] + by])
+                if predicate is None:
+                    left = gpd.GeoDataFrame(left, geometry=chunk.geometry.representative_point(), crs=chunk.crs)
+                else:
+                    left = gpd.GeoDataFrame(left, geometry=chunk.geometry, crs=chunk.crs)
+                joined = gpd.sjoin(left, regions, how='inner', predicate=predicate or 'within')
+                groups, values = joined[keys], joined[self.attribute]
+            summary = GroupedSummary(sketch_size)
+            summary.update(groups, pd.to_numeric(values))
+            return summary
+
+        result = GroupedSummary(sketch_size)
+        chunks = read_attribute_chunks(self.polygon_file, [self.attribute] + by, chunk_size=chunk_size,
+                                       read_geometry=regions is not None)
+        batch = []
+        prepared = regions is None
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for chunk in chunks:
+                if not prepared:
+                    # Match the regions to the polygons and build their spatial index once, before any thread uses it
+                    if chunk.crs is not None and regions.crs is not None:
+                        regions = reproject(regions, chunk.crs)
+                    regions = regions[[region_column, regions.geometry.name]]
+                    regions.sindex
+                    prepared = True
+                batch.append(chunk)
+                # Reduce a few batches at a time so read chunks do not pile up ahead of the merge
+                if len(batch) >= workers * 4:
+                    for summary in executor.map(summarise, batch):
+                        result.merge(summary)
+                    batch = []
+            for summary in executor.map(summarise, batch):
+                result.merge(summary)
+
+        return result.summary()[stats]
+
+    def geospatial_summary_stats(self, stats=None, streaming=False, chunk_size=100000, sketch_size=8192):
+        """
+        Summarise the attribute of the polygon file.
+
+        Only the attribute column is read, without the geometries.
+
+        Parameters:
+            stats (list): The describe statistics to return, from count, mean, std, min, 25%, 50%, 75% and max.
+                Default is None, which returns all of them. The additional statistics are always returned.
+            streaming (bool): Read the column in chunks and summarise it in a single pass with StreamingSummary,
+                so memory does not grow with the file. Percentiles and the mode are then exact up to sketch_size
+                rows and distinct values, and approximate beyond. Missing values are ignored. Default is False.
+            chunk_size (int): Number of rows read at a time when streaming. Default is 100000.
+            sketch_size (int): Size of the percentile and mode sketches when streaming. Default is 8192.
+
+        Returns:
+            A dictionary of summary statistics of the attribute.
+        """
         if stats is None:
             stats = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+        if streaming:
+            summary = StreamingSummary(sketch_size)
+            for chunk in read_attribute_chunks(self.polygon_file, [self.attribute], chunk_size=chunk_size):
+                summary.update(pd.to_numeric(chunk[self.attribute]).to_numpy(dtype=np.float64, na_value=np.nan))
+            all_stats = summary.summary()
+            describe = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+            return {stat: all_stats[stat] for stat in stats + [stat for stat in all_stats if stat not in describe]}
+
+        # Read in the attribute column of the polygon file
+        polygons = gpd.read_file(self.polygon_file, columns=[self.attribute], ignore_geometry=True)
+
+        # Calculate summary statistics for the given attribute
         desc_stats = polygons[self.attribute].describe(percentiles=[0.25, 0.5, 0.75])
         stats = desc_stats[stats].to_dict()
 
@@ -0,0 +1,455 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+from collections import deque
+
+
+'''
+Timing and profiling of processing stages.
+
+A stage records its wall time, the CPU time of its thread, how much the peak resident memory of the process rose
+while it ran, that peak itself and the rows, pixels and bytes it processed into a thread-safe collector, which can be
+exported as JSON or logged. Stages nest, so a stage run inside
+another one is recorded under the path of both, such as 'merge_geotiffs/write_vrt_windows'.
+'''
+
+
+logger = logging.getLogger(__name__)
+
+STAGE_COUNTERS = ['rows', 'pixels', 'bytes']
+PROFILERS = ['cprofile', 'pyinstrument']
+
+_state = threading.local()
+
+
+def peak_rss():
+    """
+    Return the peak resident memory of the process in bytes, or None when it cannot be measured.
+    """
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, other systems kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_duration(seconds):
+    """
+    Format a duration in seconds as HH:MM:SS.
+    """
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
+
+
+class StageCollector:
+    """
+    Thread-safe store of stage records, with running totals for each stage.
+
+    Only the most recent max_records records are kept, so a long running job does not grow without bound, while the
+    totals cover every stage run since the collector was created or cleared.
+
+    Args:
+        max_records (int): Number of individual records kept. Default is 10000.
+    """
+
+    def __init__(self, max_records=10000):
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max_records)
+        self._totals = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def add(self, record):
+        """
+        Add the record of a finished stage.
+
+        Args:
+            record (dict): Record with at least the path, wall and cpu of the stage.
+        """
+        with self._lock:
+            self._records.append(record)
+            totals = self._totals.get(record['path'])
+            if totals is None:
+                totals = self._totals[record['path']] = {'calls': 0, 'errors': 0, 'wall': 0.0, 'wall_max': 0.0,
+                                                         'cpu': 0.0, 'peak_rss_growth': None,
+                                                         'process_peak_rss': None,
+                                                         **{counter: 0 for counter in STAGE_COUNTERS}}
+            totals['calls'] += 1
+            totals['errors'] += record['error'] is not None
+            totals['wall'] += record['wall']
+            totals['wall_max'] = max(totals['wall_max'], record['wall'])
+            totals['cpu'] += record['cpu']
+            for memory in ['peak_rss_growth', 'process_peak_rss']:
+                if record[memory] is not None:
+                    totals[memory] = max(totals[memory] or 0, record[memory])
+            for counter in STAGE_COUNTERS:
+                totals[counter] += record[counter]
+
+    def records(self, path=None):
+        """
+        Return copies of the kept records, oldest first.
+
+        Args:
+            path (str, optional): Only return the records of this stage path.
+
+        Returns:
+            list: The records as dicts.
+        """
+        with self._lock:
+            return [dict(record) for record in self._records if path is None or record['path'] == path]
+
+    def summary(self):
+        """
+        Return the totals of each stage, with throughput in rows, pixels and bytes per second of wall time.
+
+        Returns:
+            dict: Totals by stage path.
+        """
+        with self._lock:
+            summary = {path: dict(totals) for path, totals in self._totals.items()}
+        for totals in summary.values():
+            totals['wall_mean'] = totals['wall'] / totals['calls']
+            for counter in STAGE_COUNTERS:
+                totals[f'{counter}_per_second'] = totals[counter] / totals['wall'] if totals['wall'] > 0 else None
+        return summary
+
+    def clear(self):
+        """
+        Remove every record and total.
+        """
+        with self._lock:
+            self._records.clear()
+            self._totals.clear()
+
+    def to_json(self, path=None, records=True):
+        """
+        Export the summary, and the kept records, as JSON.
+
+        Args:
+            path (str, optional): File to write the JSON to.
+            records (bool): Include the individual records. Default is True.
+
+        Returns:
+            str: The JSON document.
+        """
+        document = {'pid': os.getpid(), 'exported': time.time(), 'summary': self.summary()}
+        if records:
+            document['records'] = self.records()
+        text = json.dumps(document, indent=2, default=str)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def log_summary(self, log=None, level=logging.INFO):
+        """
+        Log one line per stage with its calls, times, peak memory and throughput.
+
+        Args:
+            log (logging.Logger, optional): Logger to write to. Defaults to the logger of this module.
+            level (int): Logging level. Default is INFO.
+        """
+        log = log or logger
+        for path, totals in sorted(self.summary().items()):
+            line = (f"{path}: {totals['calls']} call(s), wall {totals['wall']:.3f} s "
+                    f"(max {totals['wall_max']:.3f} s), cpu {totals['cpu']:.3f} s")
+            if totals['process_peak_rss'] is not None:
+                line += (f", peak rss growth {totals['peak_rss_growth'] / 2 ** 20:.1f} MiB "
+                         f"(process peak {totals['process_peak_rss'] / 2 ** 20:.1f} MiB)")
+            for counter in STAGE_COUNTERS:
+                if totals[counter]:
+                    line += f", {totals[counter]} {counter} ({totals[f'{counter}_per_second']:.0f}/s)"
+            if totals['errors']:
+                line += f", {totals['errors']} error(s)"
+            log.log(level, line)
+
+
+_settings = {'enabled': os.environ.get('FORESTOPS_INSTRUMENTATION', '1').lower() not in ['0', 'false', 'no'],
+             'collector': StageCollector(), 'profiler': None, 'profile_stages': None, 'profile_dir': None}
+_profile_lock = threading.Lock()
+
+
+def get_collector():
+    """
+    Return the collector the stages are recorded into.
+    """
+    return _settings['collector']
+
+
+def set_collector(collector):
+    """
+    Record the stages into another collector, such as a fresh one for each job of a batch worker.
+
+    Args:
+        collector (StageCollector): The collector.
+
+    Returns:
+        StageCollector: The previous collector.
+    """
+    previous = _settings['collector']
+    _settings['collector'] = collector
+    return previous
+
+
+def set_instrumentation(enabled=True):
+    """
+    Turn the recording of stages on or off. It is on unless the FORESTOPS_INSTRUMENTATION environment variable is
+    set to 0.
+
+    Args:
+        enabled (bool): Record stages. Default is True.
+    """
+    _settings['enabled'] = bool(enabled)
+
+
+def enable_profiling(profiler='cprofile', stages=None, output_dir=None):
+    """
+    Profile stages with cProfile or pyinstrument.
+
+    Only outermost stages are profiled, one at a time, since profilers cannot be nested. The statistics of each
+    profiled stage are written to output_dir, and their path is kept in the record of the stage.
+
+    Args:
+        profiler (str): 'cprofile' or 'pyinstrument'. Default is 'cprofile'.
+        stages (list, optional): Names of the stages to profile. Defaults to every outermost stage.
+        output_dir (str, optional): Folder of the profiles. Defaults to the working directory.
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(f"Invalid profiler. Must be one of {PROFILERS}.")
+    if profiler == 'pyinstrument':
+        try:
+            import pyinstrument  # noqa: F401
+        except ImportError:
+            raise ImportError("pyinstrument is required for profiler='pyinstrument'")
+    _settings.update(profiler=profiler, profile_stages=set(stages) if stages is not None else None,
+                     profile_dir=output_dir or os.getcwd())
+
+
+def disable_profiling():
+    """
+    Stop profiling stages.
+    """
+    _settings.update(profiler=None, profile_stages=None, profile_dir=None)
+
+
+class _Profile:
+    # Wraps a cProfile or pyinstrument profiler behind start, stop and save
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        if profiler == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+        else:
+            import pyinstrument
+            self._profiler = pyinstrument.Profiler()
+
+    def start(self):
+        if self.profiler == 'cprofile':
+            self._profiler.enable()
+        else:
+            self._profiler.start()
+
+    def stop(self):
+        if self.profiler == 'cprofile':
+            self._profiler.disable()
+        else:
+            self._profiler.stop()
+
+    def save(self, name, folder):
+        os.makedirs(folder, exist_ok=True)
+        stem = os.path.join(folder, f"{name.replace('/', '.')}_{os.getpid()}_{time.time_ns()}")
+        if self.profiler == 'cprofile':
+            path = f"{stem}.prof"
+            self._profiler.dump_stats(path)
+        else:
+            path = f"{stem}.html"
+            with open(path, 'w') as f:
+                f.write(self._profiler.output_html())
+        return path
+
+
+class Stage:
+    """
+    A timed processing stage, used as a context manager. Use stage() to create one.
+
+    Args:
+        name (str): Name of the stage.
+        **counters: Initial rows, pixels and bytes of the stage.
+    """
+
+    def __init__(self, name, **counters):
+        self.name = name
+        self.path = name
+        self.counters = {counter: 0 for counter in STAGE_COUNTERS}
+        self.add(**counters)
+        self.started = None
+        self.record = None
+        self._profile = None
+
+    def add(self, rows=0, pixels=0, bytes=0):
+        """
+        Add to the rows, pixels and bytes processed by the stage.
+        """
+        self.counters['rows'] += int(rows)
+        self.counters['pixels'] += int(pixels)
+        self.counters['bytes'] += int(bytes)
+
+    @property
+    def elapsed(self):
+        """
+        Wall time of the stage in seconds so far, or in total once it has finished.
+        """
+        if self.record is not None:
+            return self.record['wall']
+        return time.perf_counter() - self._wall if self.started is not None else 0.0
+
+    def __enter__(self):
+        stack = getattr(_state, 'stack', None)
+        if stack is None:
+            stack = _state.stack = []
+        if stack:
+            self.path = f"{stack[-1].path}/{self.name}"
+        stack.append(self)
+
+        profiler = _settings['profiler']
+        if profiler and len(stack) == 1 and (_settings['profile_stages'] is None or
+                                            self.name in _settings['profile_stages']):
+            if _profile_lock.acquire(blocking=False):
+                self._profile = _Profile(profiler)
+                try:
+                    self._profile.start()
+                except (ValueError, RuntimeError):
+                    # Another profiler is already active
+                    _profile_lock.release()
+                    self._profile = None
+
+        self.started = time.time()
+        # CPU time of this thread only, so stages on worker threads are not charged for each other's work
+        self._cpu = time.thread_time()
+        self._peak_rss = peak_rss()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+        # The peak is the high-water mark of the whole process, so only its rise belongs to this stage
+        process_peak_rss = peak_rss()
+        peak_rss_growth = process_peak_rss - self._peak_rss if process_peak_rss is not None else None
+        _state.stack.pop()
+
+        profile_path = None
+        if self._profile is not None:
+            try:
+                self._profile.stop()
+                profile_path = self._profile.save(self.name, _settings['profile_dir'])
+            finally:
+                _profile_lock.release()
+                self._profile = None
+
+        self.record = {'name': self.name, 'path': self.path, 'thread': threading.current_thread().name,
+                       'started': self.started, 'wall': wall, 'cpu': cpu, 'peak_rss_growth': peak_rss_growth,
+                       'process_peak_rss': process_peak_rss,
+                       **self.counters, 'error': exc_type.__name__ if exc_type is not None else None,
+                       'profile': profile_path}
+        _settings['collector'].add(self.record)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s finished in %.3f s (cpu %.3f s)", self.path, wall, cpu)
+        return False
+
+
+class _NullStage:
+    # Stands in for a stage when instrumentation is off, or outside any stage
+
+    name = path = None
+    started = record = None
+    elapsed = 0.0
+
+    def add(self, rows=0, pixels=0, bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, **counters):
+    """
+    Time a processing stage in a with block.
+
+        with stage('read_tiles') as timing:
+            ...
+            timing.add(pixels=array.size, bytes=array.nbytes)
+
+    Args:
+        name (str): Name of the stage.
+        **counters: Initial rows, pixels and bytes of the stage.
+
+    Returns:
+        Stage: The stage, or a stand-in that records nothing when instrumentation is off.
+    """
+    if not _settings['enabled']:
+        return _NULL_STAGE
+    return Stage(name, **counters)
+
+
+def current_stage():
+    """
+    Return the innermost stage running in this thread, so a function can add the rows, pixels or bytes it
+    processed, or a stand-in that records nothing outside any stage.
+    """
+    stack = getattr(_state, 'stack', None)
+    return stack[-1] if stack else _NULL_STAGE
+
+
+def instrumented(name=None, rows=None, pixels=None, bytes=None):
+    """
+    Decorate a function to run each call as a stage.
+
+    Args:
+        name (str, optional): Name of the stage. Defaults to the name of the function.
+        rows (callable, optional): Function of the return value giving the rows processed, such as len.
+        pixels (callable, optional): Function of the return value giving the pixels processed.
+        bytes (callable, optional): Function of the return value giving the bytes processed.
+
+    Returns:
+        callable: The decorator.
+    """
+    counters = {'rows': rows, 'pixels': pixels, 'bytes': bytes}
+    counters = {counter: count for counter, count in counters.items() if count is not None}
+
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _settings['enabled']:
+                return function(*args, **kwargs)
+            with Stage(stage_name) as timing:
+                result = function(*args, **kwargs)
+                if counters and result is not None:
+                    timing.add(**{counter: count(result) for counter, count in counters.items()})
+                return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,266 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from ForestOps.geo_ops.geo_io import read_attribute_chunks, read_data
+from ForestOps.geo_ops.crs_cache import reproject
+from ForestOps.geo_ops.geo_funcs import chunk_geodataframe, fix_invalid_geometries, check_crs, clip_and_combine
+from ForestOps.geo_ops.instrumentation import stage
+from ForestOps.geo_ops.progress import track_progress, report
+
+
+'''
+Lazy, chunked processing of vector layers.
+
+A Pipeline records its stages, such as fixing geometries, reprojecting and overlaying, without running them. When a
+sink such as write or collect is called, the layer is read chunk by chunk and each chunk flows through every stage,
+so only a few chunks are in memory at a time whatever the size of the layer, and stages work on the chunk in place
+rather than copying it.
+'''
+
+
+# Overlays that only return parts of the features of the layer, so they can run on each chunk separately
+PIPELINE_OVERLAYS = ['intersection', 'difference']
+
+
+class _OtherLayer:
+    # A layer overlaid on every chunk: read once, reprojected to the CRS of the chunks and indexed once
+
+    def __init__(self, other):
+        self._layer = read_data(other) if isinstance(other, str) else other
+        self._by_crs = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, chunk):
+        # Features of the layer whose bounding boxes intersect the chunk, in the CRS of the chunk
+        key = chunk.crs.to_wkt() if chunk.crs is not None else None
+        with self._lock:
+            layer = self._by_crs.get(key)
+            if layer is None:
+                layer = self._layer
+                if chunk.crs is not None and layer.crs is not None:
+                    layer = reproject(layer, chunk.crs)
+                # Build the spatial index once, before the chunks query it from several threads
+                layer.sindex
+                self._by_crs[key] = layer
+        if len(chunk) == 0:
+            return layer.iloc[:0]
+        hits = layer.sindex.query(chunk.geometry.values, predicate='intersects')[1]
+        return layer.iloc[np.unique(hits)]
+
+
+class Pipeline:
+    """
+    A chain of stages applied lazily to a vector layer, chunk by chunk.
+
+    Each stage method returns a new Pipeline with the stage added, so pipelines can be built up, shared and branched.
+    Nothing is read until a sink runs: write streams the result to a file, collect returns it as one GeoDataFrame
+    and iterating yields the processed chunks.
+
+        (Pipeline('parcels.gpkg', chunk_size=50000)
+            .fix_invalid()
+            .to_crs(27700)
+            .overlay('woodland.gpkg', how='intersection')
+            .write('parcels_in_woodland.gpkg', workers=4))
+
+    Args:
+        source (str, GeoDataFrame or iterable): Path to a vector file, read chunk by chunk, a GeoDataFrame, split
+            into chunks, or an iterable of GeoDataFrames used as the chunks.
+        chunk_size (int): Number of features in each chunk read from a file or GeoDataFrame. Default is 100000.
+        columns (list, optional): Columns to read from a file. Defaults to every column.
+    """
+
+    def __init__(self, source, chunk_size=100000, columns=None):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1.")
+        self.source = source
+        self.chunk_size = chunk_size
+        self.columns = columns
+        self.stages = []
+
+    def __repr__(self):
+        source = self.source if isinstance(self.source, str) else type(self.source).__name__
+        return f"Pipeline({source!r}, stages=[{', '.join(name for name, _ in self.stages)}])"
+
+    def then(self, name, function):
+        """
+        Add a stage.
+
+        Args:
+            name (str): Name of the stage, used in timings and progress.
+            function (callable): Function taking a chunk as a GeoDataFrame and returning the processed chunk. The
+                chunk belongs to the pipeline, so the function may modify it in place.
+
+        Returns:
+            Pipeline: A new pipeline ending with the stage.
+        """
+        pipeline = Pipeline(self.source, self.chunk_size, self.columns)
+        pipeline.stages = self.stages + [(name, function)]
+        return pipeline
+
+    def fix_invalid(self):
+        """
+        Add a stage removing missing geometries and fixing invalid ones, see fix_invalid_geometries.
+        """
+        return self.then('fix_invalid', lambda chunk: fix_invalid_geometries(chunk, copy=False))
+
+    def to_crs(self, crs, ostn15=False):
+        """
+        Add a stage setting or reprojecting to a CRS, see check_crs.
+        """
+        return self.then('to_crs', lambda chunk: check_crs(chunk, crs, ostn15=ostn15))
+
+    def map(self, function, name='map'):
+        """
+        Add a stage applying a function to each chunk, see then.
+        """
+        return self.then(name, function)
+
+    def filter(self, predicate, name='filter'):
+        """
+        Add a stage keeping the rows of each chunk for which predicate(chunk) is True.
+
+        Args:
+            predicate (callable): Function taking a chunk and returning a boolean Series or array.
+            name (str): Name of the stage. Default is 'filter'.
+        """
+        return self.then(name, lambda chunk: chunk[np.asarray(predicate(chunk), dtype=bool)])
+
+    def overlay(self, other, how='intersection', keep_geom_type=True):
+        """
+        Add a stage overlaying each chunk with another layer.
+
+        The other layer is read once, reprojected to the CRS of the chunks when they differ and indexed, and each
+        chunk is only overlaid with the features of the other layer whose bounding boxes it intersects.
+
+        Args:
+            other (str or GeoDataFrame): Path to the other layer, or the layer.
+            how (str): 'intersection' or 'difference'. Default is 'intersection'.
+            keep_geom_type (bool): Only keep geometries of the type of the chunk. Default is True.
+        """
+        if how not in PIPELINE_OVERLAYS:
+            raise ValueError(f"Invalid how. Must be one of {PIPELINE_OVERLAYS}.")
+        other = _OtherLayer(other)
+        return self.then(f'overlay_{how}', lambda chunk: gpd.overlay(chunk, other.candidates(chunk), how=how,
+                                                                     keep_geom_type=keep_geom_type))
+
+    def clip(self, mask):
+        """
+        Add a stage clipping each chunk to the geometries of a mask layer, see geopandas.clip.
+
+        Args:
+            mask (str or GeoDataFrame): Path to the mask layer, or the layer.
+        """
+        mask = _OtherLayer(mask)
+        return self.then('clip', lambda chunk: gpd.clip(chunk, mask.candidates(chunk)))
+
+    def clip_and_combine(self, other, column):
+        """
+        Add a stage splitting each chunk into its parts inside and outside another layer, see clip_and_combine.
+
+        Args:
+            other (str or GeoDataFrame): Path to the other layer, or the layer.
+            column (str): Name of the column flagging the parts inside the other layer.
+        """
+        other = _OtherLayer(other)
+        return self.then('clip_and_combine', lambda chunk: clip_and_combine(chunk, other.candidates(chunk),
+                                                                            column)[0])
+
+    def _chunks(self):
+        # The chunks of the source, as they are read
+        if isinstance(self.source, str):
+            return read_attribute_chunks(self.source, self.columns, chunk_size=self.chunk_size, read_geometry=True)
+        if isinstance(self.source, gpd.GeoDataFrame):
+            return chunk_geodataframe(self.source, self.chunk_size)
+        return iter(self.source)
+
+    def _process(self, chunk):
+        for name, function in self.stages:
+            with stage(f'pipeline.{name}', rows=len(chunk)):
+                chunk = function(chunk)
+        return chunk
+
+    def iter_chunks(self, workers=1, max_pending=None):
+        """
+        Run the pipeline, yielding the processed chunks in the order of the source.
+
+        Args:
+            workers (int): Number of threads processing chunks. Default is 1, which processes each chunk as it is
+                read.
+            max_pending (int, optional): Most chunks read but not yet yielded, which bounds memory use. Defaults to
+                twice the number of workers.
+
+        Yields:
+            GeoDataFrame: The next processed chunk.
+        """
+        if workers <= 1:
+            for chunk in self._chunks():
+                yield self._process(chunk)
+            return
+
+        max_pending = max_pending or workers * 2
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # A bounded queue of chunks being processed, the oldest is yielded before another one is read
+            pending = deque()
+            for chunk in self._chunks():
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(self._process, chunk))
+            while pending:
+                yield pending.popleft().result()
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def collect(self, workers=1, max_pending=None):
+        """
+        Run the pipeline and return the result as one GeoDataFrame with a new index, which must fit in memory.
+
+        Args:
+            workers (int): Number of threads processing chunks. Default is 1.
+            max_pending (int, optional): Most chunks being processed at a time, see iter_chunks.
+
+        Returns:
+            GeoDataFrame: The processed layer.
+        """
+        chunks = list(self.iter_chunks(workers, max_pending))
+        if not chunks:
+            return gpd.GeoDataFrame()
+        return gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), crs=chunks[0].crs)
+
+    def write(self, file_path, layer=None, driver=None, workers=1, max_pending=None):
+        """
+        Run the pipeline, appending each processed chunk to a vector file as soon as it is ready.
+
+        Args:
+            file_path (str): Path of the output file, replaced if it exists. When no features are left an empty
+                layer is written, with the columns of the chunks when there were any.
+            layer (str, optional): Layer name, for formats such as GeoPackage.
+            driver (str, optional): OGR driver. Defaults to the driver matching the extension of file_path.
+            workers (int): Number of threads processing chunks. Default is 1.
+            max_pending (int, optional): Most chunks being processed at a time, see iter_chunks.
+
+        Returns:
+            int: Number of features written.
+        """
+        written = 0
+        schema = None
+        with stage('pipeline'), track_progress('Pipeline', unit='features') as features:
+            for chunk in self.iter_chunks(workers, max_pending):
+                if len(chunk) == 0:
+                    # Keep the columns of the first chunk in case every chunk is empty
+                    if schema is None:
+                        schema = chunk
+                    continue
+                chunk.to_file(file_path, layer=layer, driver=driver, mode='a' if written else 'w')
+                written += len(chunk)
+                features.update(len(chunk))
+
+        # Replace the output even when nothing was written, so no features from an earlier run are left in it
+        if not written:
+            schema = gpd.GeoDataFrame(geometry=[]) if schema is None else schema.iloc[:0]
+            schema.to_file(file_path, layer=layer, driver=driver, mode='w')
+        report(f"{written} features written to {file_path}")
+        return written
@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import logging
+import threading
+
+
+'''
+Progress reporting of long running operations.
+
+Operations report progress and messages through this module instead of printing. Nothing is shown by default:
+messages go to the 'ForestOps.geo_ops.progress' logger at INFO level, which is silent unless logging is configured,
+and progress updates are dropped. set_progress_reporter sends both to the log, to the console or to a callback, with
+progress updates limited to one every interval seconds, each with its throughput.
+'''
+
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_REPORTERS = ['log', 'print']
+
+_settings = {'reporter': None, 'interval': 1.0, 'level': logging.INFO}
+
+
+def _format_count(value):
+    return f"{value:,.0f}" if float(value).is_integer() else f"{value:,.1f}"
+
+
+def format_progress(event):
+    """
+    Format a progress event as one line, such as
+    'Reading features: 12,000/50,000 features (24%), 3,500 features/s, 1.2 MB/s, 11 s left'.
+
+    Args:
+        event (dict): Progress event.
+
+    Returns:
+        str: The line.
+    """
+    if event['kind'] == 'message':
+        return event['message']
+    line = f"{event['description']}: {_format_count(event['count'])}"
+    if event['total']:
+        line += f"/{_format_count(event['total'])} {event['unit']} ({100 * event['count'] / event['total']:.0f}%)"
+    else:
+        line += f" {event['unit']}"
+    if event['rate'] is not None:
+        line += f", {_format_count(event['rate'])} {event['unit']}/s"
+    if event['bytes_rate'] is not None:
+        line += f", {event['bytes_rate'] / 1e6:.1f} MB/s"
+    if event['done']:
+        line += f", done in {event['elapsed']:.1f} s"
+    elif event['remaining'] is not None:
+        line += f", {event['remaining']:.0f} s left"
+    return line
+
+
+def _log_event(event):
+    logger.info(format_progress(event))
+
+
+def _print_event(event):
+    print(format_progress(event), file=sys.stdout, flush=True)
+
+
+def set_progress_reporter(reporter=None, interval=1.0, level=logging.INFO):
+    """
+    Choose where progress updates and messages are reported.
+
+    Args:
+        reporter (str or callable, optional): 'log' to log them to the 'ForestOps.geo_ops.progress' logger, 'print'
+            to print them, or a function called with each event dict. Events have a 'kind' of 'progress' or
+            'message'; see Progress for their keys. Defaults to None, which drops progress updates and only logs
+            messages. The FORESTOPS_PROGRESS environment variable sets the reporter at import.
+        interval (float): Minimum number of seconds between two progress updates of an operation. Default is 1.
+        level (int): Lowest logging level of the messages passed to a 'print' or function reporter, the level of
+            the logger applies to the 'log' reporter. Default is INFO, so details such as each invalid geometry,
+            reported at DEBUG level, are left out.
+
+    Returns:
+        The previous reporter.
+    """
+    if reporter is not None and not callable(reporter) and reporter not in PROGRESS_REPORTERS:
+        raise ValueError(f"Invalid reporter. Must be None, a function or one of {PROGRESS_REPORTERS}.")
+    if interval < 0:
+        raise ValueError("interval must not be negative.")
+    previous = _settings['reporter']
+    _settings['reporter'] = reporter
+    _settings['interval'] = interval
+    _settings['level'] = level
+    return previous
+
+
+def _reporter():
+    reporter = _settings['reporter']
+    if reporter == 'log':
+        return _log_event
+    if reporter == 'print':
+        return _print_event
+    return reporter
+
+
+def reporting(level=logging.INFO):
+    """
+    Return whether messages of a logging level are currently reported, to skip building costly messages.
+    """
+    reporter = _reporter()
+    if reporter is None or reporter is _log_event:
+        return logger.isEnabledFor(level)
+    return level >= _settings['level']
+
+
+def report(message, level=logging.INFO):
+    """
+    Report a one-off message of an operation, such as a setting it chose or a count of the features it changed.
+
+    Args:
+        message (str): The message.
+        level (int): Logging level of the message. Default is INFO.
+    """
+    reporter = _reporter()
+    if reporter is None or reporter is _log_event:
+        logger.log(level, message)
+    elif level >= _settings['level']:
+        reporter({'kind': 'message', 'message': message, 'level': level})
+
+
+class Progress:
+    """
+    Progress of an operation over a number of items, such as features, tiles or blocks, reported at most once every
+    interval seconds with the rate of items and bytes per second. Use track_progress() to create one.
+
+    Events passed to a callback reporter hold kind ('progress'), description, unit, count, total, bytes, elapsed,
+    rate, bytes_rate, remaining (seconds, when the total is known) and done.
+
+    Args:
+        description (str): What the operation is doing, such as 'Reading features'.
+        total (int, optional): Number of items expected, when known.
+        unit (str): Name of the items. Default is 'items'.
+        reporter (callable): Function called with each event.
+        interval (float): Minimum number of seconds between two updates.
+    """
+
+    def __init__(self, description, total=None, unit='items', reporter=None, interval=1.0):
+        self.description = description
+        self.total = total
+        self.unit = unit
+        self.count = 0
+        self.bytes = 0
+        self._reporter = reporter
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._reported = self._started
+
+    def update(self, n=1, bytes=0):
+        """
+        Add to the items and bytes processed, reporting progress when interval seconds have passed since the last
+        report. Safe to call from several threads.
+
+        Args:
+            n (int): Number of items processed. Default is 1.
+            bytes (int): Number of bytes processed. Default is 0.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.count += n
+            self.bytes += bytes
+            if now - self._reported < self._interval:
+                return
+            self._reported = now
+            event = self._event(now, done=False)
+        self._reporter(event)
+
+    def close(self):
+        """
+        Report the final count and throughput.
+        """
+        with self._lock:
+            event = self._event(time.monotonic(), done=True)
+        self._reporter(event)
+
+    def _event(self, now, done):
+        elapsed = now - self._started
+        rate = self.count / elapsed if elapsed > 0 else None
+        remaining = None
+        if self.total and rate:
+            remaining = max(self.total - self.count, 0) / rate
+        return {'kind': 'progress', 'description': self.description, 'unit': self.unit, 'count': self.count,
+                'total': self.total, 'bytes': self.bytes, 'elapsed': elapsed, 'rate': rate,
+                'bytes_rate': self.bytes / elapsed if self.bytes and elapsed > 0 else None, 'remaining': remaining,
+                'done': done}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        return False
+
+
+class _NullProgress:
+    # Stands in for a Progress when progress is not reported, so updates cost a method call and nothing else
+
+    count = bytes = 0
+
+    def update(self, n=1, bytes=0):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_PROGRESS = _NullProgress()
+
+
+def track_progress(description, total=None, unit='items'):
+    """
+    Track the progress of an operation in a with block.
+
+        with track_progress('Merging tiles', total=len(files), unit='tiles') as tiles:
+            for file in files:
+                ...
+                tiles.update(1, bytes=os.path.getsize(file))
+
+    Args:
+        description (str): What the operation is doing, such as 'Reading features'.
+        total (int, optional): Number of items expected, when known.
+        unit (str): Name of the items, such as 'features', 'tiles' or 'blocks'. Default is 'items'.
+
+    Returns:
+        Progress: The progress, or a stand-in that reports nothing when no reporter is set.
+    """
+    reporter = _reporter()
+    if reporter is None:
+        return _NULL_PROGRESS
+    return Progress(description, total=total, unit=unit, reporter=reporter, interval=_settings['interval'])
+
+
+if os.environ.get('FORESTOPS_PROGRESS', '').lower() in PROGRESS_REPORTERS:
+    set_progress_reporter(os.environ['FORESTOPS_PROGRESS'].lower())
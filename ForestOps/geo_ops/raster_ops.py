@@ -1,17 +1,47 @@
 import os
-import glob
+import math
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 import rasterio
 from rasterio import merge
+from rasterio.crs import CRS
+from rasterio import features
+from rasterio.enums import MergeAlg
+from rasterio.windows import Window
+import rasterio.windows
+from affine import Affine
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
 import matplotlib.pyplot as plt
 import time
+from ForestOps.geo_ops.tile_index import (find_geotiffs, read_tile_header, update_tile_index, query_tile_index,
+                                          default_tile_index_path, area_of_interest, filter_tile_headers)
+from ForestOps.geo_ops.raster_profiles import output_profile, resolve_output_profile, open_raster_writer
+from ForestOps.geo_ops.geo_funcs import chunk_geodataframe
+from ForestOps.geo_ops.crs_cache import reproject
+from ForestOps.geo_ops.raster_cache import get_raster_cache, read_raster_cached
+from ForestOps.geo_ops.instrumentation import instrumented, current_stage, format_duration
+from ForestOps.geo_ops.progress import track_progress, report
 
 # from geoops.geo_io import time_recording
 
 
+# Start and end times of time_recording, for each thread
+_recorded_times = threading.local()
+
+
 def time_recording(type='start'):
     """
     Record the start time, end time, or duration of a process.
 
+    The times are kept per thread. Prefer the stage context manager of the instrumentation module, which also
+    records CPU time, memory and throughput.
+
     Args:
         type (str): The type of time recording. Options are 'start', 'end', or 'duration'.
                     Defaults to 'start'.
@@ -19,8 +49,6 @@ def time_recording(type='start'):
     Returns:
         float or str or None: The recorded time or None if the type is invalid.
     """
-    global start_time, end_time
-
     # Check if the type argument is valid
     if type not in ['start', 'end', 'duration']:
         print("Error: Invalid time recording type. Must be 'start', 'end', or 'duration'.")
@@ -28,24 +56,24 @@ def time_recording(type='start'):
 
     # Record the start time
     if type == 'start':
-        start_time = time.time()
-        return time.strftime("%H:%M:%S", time.localtime(start_time))
+        _recorded_times.start = time.time()
+        return time.strftime("%H:%M:%S", time.localtime(_recorded_times.start))
     # Record the end time
     elif type == 'end':
-        end_time = time.time()
-        return time.strftime("%H:%M:%S", time.localtime(end_time))
+        _recorded_times.end = time.time()
+        return time.strftime("%H:%M:%S", time.localtime(_recorded_times.end))
     # Calculate the duration
     elif type == 'duration':
+        start_time = getattr(_recorded_times, 'start', None)
+        end_time = getattr(_recorded_times, 'end', None)
         if start_time is not None and end_time is not None:
-            duration = end_time - start_time
-            hours, remainder = divmod(duration, 3600)
-            minutes, seconds = divmod(remainder, 60)
-            return f"{int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
+            return format_duration(end_time - start_time)
         else:
             print("Error: Both start time and end time must be recorded.")
             return None
 
 
+@instrumented()
 def raster_summary(raster_file, nodata=None, display_summary=False):
     """
     Compute summary statistics from a raster dataset, including nodata handling.
@@ -57,39 +85,40 @@ def raster_summary(raster_file, nodata=None, display_summary=False):
     Returns:
         dict: A dictionary containing the computed summary statistics, including nodata count.
     """
-    # Open raster dataset
-    with rasterio.open(raster_file) as src:
-        # Read raster data as a NumPy array
-        raster_data = src.read(1)
-
-        # Detect nodata value from raster metadata if not provided
-        if nodata is None:
-            nodata = src.nodata
-
-        # Mask nodata values
-        if nodata is not None:
-            raster_data = raster_data[raster_data != nodata]
-
-        # Compute summary statistics
-        min_value = raster_data.min()
-        max_value = raster_data.max()
-        mean_value = raster_data.mean()
-        std_value = raster_data.std()
-
-        # Count nodata values
-        nodata_count = 0
-        if nodata is not None:
-            nodata_count = (src.read(1) == nodata).sum()
-
-        # Create a dictionary to store the summary statistics
-        summary = {
-            'minimum': min_value,
-            'maximum': max_value,
-            'mean': mean_value,
-            'standard_deviation': std_value,
-            'nodata': nodata,
-            'nodata_count': nodata_count
-        }
+    # Read raster data as a NumPy array, through the shared cache so the band is only decoded once
+    band_data = read_raster_cached(raster_file)
+    current_stage().add(pixels=band_data.size, bytes=band_data.nbytes)
+
+    # Detect nodata value from raster metadata if not provided
+    if nodata is None:
+        nodata = get_raster_cache().profile(raster_file)['nodata']
+
+    # Mask nodata values
+    raster_data = band_data
+    if nodata is not None:
+        nodata_mask = band_data == nodata
+        raster_data = band_data[~nodata_mask]
+
+    # Compute summary statistics
+    min_value = raster_data.min()
+    max_value = raster_data.max()
+    mean_value = raster_data.mean()
+    std_value = raster_data.std()
+
+    # Count nodata values
+    nodata_count = 0
+    if nodata is not None:
+        nodata_count = nodata_mask.sum()
+
+    # Create a dictionary to store the summary statistics
+    summary = {
+        'minimum': min_value,
+        'maximum': max_value,
+        'mean': mean_value,
+        'standard_deviation': std_value,
+        'nodata': nodata,
+        'nodata_count': nodata_count
+    }
     if display_summary:
         print("Summary statistics for raster file:", raster_file)
         print("Minimum value:", summary['minimum'])
@@ -102,78 +131,337 @@ def raster_summary(raster_file, nodata=None, display_summary=False):
     return summary
 
 
-def merge_geotiffs(in_folder, out_folder, out_file='', recursive=False, crs=27700):
+# GDAL names for the numpy data types that can appear in a VRT band
+_GDAL_DATA_TYPES = {
+    'uint8': 'Byte',
+    'int8': 'Int8',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'uint64': 'UInt64',
+    'int64': 'Int64',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+
+def snap_bounds(bounds, header):
     """
-    Merge multiple GeoTIFF files into a single raster using rasterio merge.
+    Snap a bounding box outwards onto the pixel grid of a tile.
 
     Args:
-        geotif_folder (str): Path to the folder containing the GeoTIFF files.
-        out_folder (str): Path to the folder where the merged raster will be saved.
-        out_file_name (str): Name of the output merged raster file. Default is 'dem.tif'.
-        recursive (bool): Option to search for GeoTIFF files recursively in subdirectories. Default is False.
+        bounds (tuple): Bounding box as (min_x, min_y, max_x, max_y).
+        header (dict): Tile header as returned by read_tile_header.
 
     Returns:
-        None
+        tuple: The snapped bounding box.
     """
-    # Record the start time
-    start_time = time_recording('start')
-    print(f"Start Time: {start_time}")
+    res_x, res_y = header['res']
+    origin_x, origin_y = header['bounds'][0], header['bounds'][3]
+    return (
+        origin_x + math.floor((bounds[0] - origin_x) / res_x) * res_x,
+        origin_y - math.ceil((origin_y - bounds[1]) / res_y) * res_y,
+        origin_x + math.ceil((bounds[2] - origin_x) / res_x) * res_x,
+        origin_y - math.floor((origin_y - bounds[3]) / res_y) * res_y,
+    )
 
-    # Check if all parameters are provided
-    if not in_folder or not out_folder or not out_file:
-        raise ValueError("geotif_folder, out_folder, and out_file_name are required parameters.")
-    # Check if out_file_name ends with .tif
-    if not in_folder.endswith('.tif'):
-        raise ValueError("out_file_name should end with '.tif'")
-
-    # Use glob to get a list of GeoTIFF files in the input directory, with an option to search recursively
-    geotiff_files = []
-    if recursive:
-        for dirpath, dirnames, filenames in os.walk(in_folder):
-            for filename in filenames:
-                if filename.endswith('.tif'):
-                    geotiff_files.append(os.path.join(dirpath, filename))
-    else:
-        geotiff_files = glob.glob(os.path.join(in_folder, '*.tif'))
 
-    # Create an empty list to store the selected geotiff files
-    selected_geotiffs = []
+def build_vrt(headers, vrt_file, nodata=None, crs=None, bounds=None):
+    """
+    Build a VRT mosaic from tile headers, so the tiles can be read as a single raster without merging them in memory.
+
+    The tiles must share a resolution, data type and band count. Where tiles overlap the first tile in the list wins,
+    matching rasterio merge.
+
+    Args:
+        headers (list): Tile headers as returned by read_tile_header.
+        vrt_file (str): Path of the VRT file to write.
+        nodata (float or int, optional): Nodata value of the mosaic. Defaults to the nodata value of the first tile.
+        crs (optional): CRS written to the VRT. Defaults to the CRS of the first tile.
+        bounds (tuple, optional): Limit the mosaic to (min_x, min_y, max_x, max_y), snapped outwards to the pixel
+            grid of the first tile. Defaults to the union of the tile footprints.
+
+    Returns:
+        dict: The width, height, transform, band count, data type and nodata value of the mosaic.
+    """
+    if not headers:
+        raise ValueError("At least one tile is required to build a VRT.")
+
+    first = headers[0]
+    res_x, res_y = first['res']
+    dtype = first['dtype']
+    count = first['count']
+    if nodata is None:
+        nodata = first['nodata']
+    if crs is None:
+        crs = first['crs']
+
+    for header in headers:
+        if header['dtype'] != dtype or header['count'] != count:
+            raise ValueError(f"{header['path']} does not match the data type and band count of {first['path']}")
+
+    # The mosaic covers the union of the tile footprints at the resolution of the first tile
+    min_x = min(header['bounds'][0] for header in headers)
+    min_y = min(header['bounds'][1] for header in headers)
+    max_x = max(header['bounds'][2] for header in headers)
+    max_y = max(header['bounds'][3] for header in headers)
+
+    if bounds is not None:
+        bounds = snap_bounds(bounds, first)
+        min_x, min_y = max(min_x, bounds[0]), max(min_y, bounds[1])
+        max_x, max_y = min(max_x, bounds[2]), min(max_y, bounds[3])
+        if min_x >= max_x or min_y >= max_y:
+            raise ValueError("The bounds do not overlap any of the tiles.")
+
+    width = int(round((max_x - min_x) / res_x))
+    height = int(round((max_y - min_y) / res_y))
+    transform = Affine(res_x, 0.0, min_x, 0.0, -res_y, max_y)
+
+    gdal_type = _GDAL_DATA_TYPES[dtype]
+
+    root = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    if crs is not None:
+        ET.SubElement(root, 'SRS').text = CRS.from_user_input(crs).to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(repr(v) for v in transform.to_gdal())
+
+    for band in range(1, count + 1):
+        band_element = ET.SubElement(root, 'VRTRasterBand', dataType=gdal_type, band=str(band))
+        if nodata is not None:
+            ET.SubElement(band_element, 'NoDataValue').text = repr(nodata)
+
+        # Sources are painted in order, so list them in reverse to let the first tile win
+        for header in reversed(headers):
+            left, bottom, right, top = header['bounds']
+            source = ET.SubElement(band_element, 'ComplexSource')
+            ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = header['path']
+            ET.SubElement(source, 'SourceBand').text = str(band)
+            # Recording the source properties lets GDAL defer opening the tile until its pixels are needed
+            ET.SubElement(source, 'SourceProperties', RasterXSize=str(header['width']),
+                          RasterYSize=str(header['height']), DataType=gdal_type,
+                          BlockXSize=str(header['block_width']), BlockYSize=str(header['block_height']))
+            ET.SubElement(source, 'SrcRect', xOff='0', yOff='0',
+                          xSize=str(header['width']), ySize=str(header['height']))
+            ET.SubElement(source, 'DstRect', xOff=repr((left - min_x) / res_x), yOff=repr((max_y - top) / res_y),
+                          xSize=repr((right - left) / res_x), ySize=repr((top - bottom) / res_y))
+            if header['nodata'] is not None:
+                ET.SubElement(source, 'NODATA').text = repr(header['nodata'])
+
+    ET.ElementTree(root).write(vrt_file)
+
+    return {'width': width, 'height': height, 'transform': transform, 'count': count, 'dtype': dtype,
+            'nodata': nodata}
+
+
+def block_windows(width, height, block_size=512):
+    """
+    Split a raster into square windows, row by row.
+
+    Args:
+        width (int): Width of the raster in pixels.
+        height (int): Height of the raster in pixels.
+        block_size (int): Width and height of the windows in pixels. Default is 512.
+
+    Returns:
+        list: rasterio Windows covering the raster.
+    """
+    return [
+        Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+        for row_off in range(0, height, block_size)
+        for col_off in range(0, width, block_size)
+    ]
 
-    # Loop over each GeoTIFF file
-    for file in geotiff_files:
-        print(file)
-        # Open the file with rasterio
-        with rasterio.open(file) as src:
-            # Get the bounding box of the raster
-            selected_geotiffs.append(file)
 
-    # Read the selected rasters into memory
-    rasters = [rasterio.open(file) for file in selected_geotiffs]
+@instrumented()
+def write_vrt_windows(vrt_file, out_file, crs=None, nodata=None, block_size=512, compress='deflate', workers=1,
+                      profile=None):
+    """
+    Copy a VRT mosaic to a tiled, compressed GeoTIFF one block at a time.
 
-    # Merge the rasters into a single raster
-    merged, out_transform = merge.merge(rasters)
+    Only the blocks currently being copied are held in memory, and GDAL only keeps a small pool of tiles open, so the
+    size of the mosaic is not limited by memory or by the number of file handles.
 
-    merged = merged.squeeze()
+    Args:
+        vrt_file (str): Path of the VRT mosaic.
+        out_file (str): Path of the output GeoTIFF.
+        crs (optional): CRS of the output. Defaults to the CRS of the VRT.
+        nodata (float or int, optional): Nodata value of the output. Defaults to the nodata value of the VRT.
+        block_size (int): Width and height of the output tiles in pixels. Must be a multiple of 16. Default is 512.
+        compress (str): GeoTIFF compression. Default is 'deflate'.
+        workers (int): Number of threads reading blocks from the VRT. Default is 1.
+        profile (str or dict, optional): Output profile, see output_profile. Defaults to a tiled profile with the
+            given block_size and compress.
+
+    Returns:
+        None
+    """
+    with rasterio.open(vrt_file) as vrt:
+        dtype = vrt.dtypes[0]
+        if profile is None:
+            profile = output_profile('tiled', dtype=dtype, compress=compress, block_size=block_size)
+        else:
+            profile = resolve_output_profile(profile, dtype)
+            block_size = profile.get('blockxsize', block_size)
+
+        with open_raster_writer(out_file, vrt.width, vrt.height, vrt.count, dtype,
+                                crs if crs is not None else vrt.crs, vrt.transform,
+                                nodata=nodata if nodata is not None else vrt.nodata, profile=profile) as dst:
+            windows = block_windows(vrt.width, vrt.height, block_size)
+            current_stage().add(pixels=vrt.width * vrt.height * vrt.count,
+                                bytes=vrt.width * vrt.height * vrt.count * np.dtype(dtype).itemsize)
+
+            blocks = track_progress('Writing blocks', total=len(windows), unit='blocks')
+            if workers <= 1:
+                for window in windows:
+                    data = vrt.read(window=window)
+                    dst.write(data, window=window)
+                    blocks.update(1, bytes=data.nbytes)
+                blocks.close()
+                return
+
+            # Dataset handles must not be shared between threads, so each reader thread opens its own
+            local = threading.local()
+            handles = []
+            handles_lock = threading.Lock()
+
+            def read_window(window):
+                if not hasattr(local, 'src'):
+                    local.src = rasterio.open(vrt_file)
+                    with handles_lock:
+                        handles.append(local.src)
+                return window, local.src.read(window=window)
+
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    # Submit a few batches at a time so finished blocks do not pile up ahead of the writer
+                    batch_size = workers * 4
+                    for i in range(0, len(windows), batch_size):
+                        for window, data in executor.map(read_window, windows[i:i + batch_size]):
+                            dst.write(data, window=window)
+                            blocks.update(1, bytes=data.nbytes)
+                blocks.close()
+            finally:
+                for handle in handles:
+                    handle.close()
+
+
+@instrumented()
+def merge_geotiffs(in_folder, out_folder, out_file='', recursive=False, crs=27700, method='merge', nodata=-9999,
+                   block_size=512, compress='deflate', workers=1, keep_vrt=False, bounds=None, geometry=None,
+                   tile_index=None, profile=None):
+    """
+    Merge multiple GeoTIFF files into a single raster.
 
-    height, width = merged.shape
+    The 'merge' method reads every tile into a single in-memory array with rasterio merge. The 'vrt' method builds a
+    VRT mosaic from the tile headers and writes the output block by block as a tiled, compressed GeoTIFF, which keeps
+    memory use and open file handles bounded for folders of thousands of tiles.
+
+    When bounds or a geometry of interest are given only the tiles that intersect them are opened, and the output is
+    limited to the bounds of that area. With a tile index the footprints come from the index, which is refreshed for
+    new or modified tiles first, instead of from the header of every tile in the folder.
+
+    Args:
+        in_folder (str): Path to the folder containing the GeoTIFF files.
+        out_folder (str): Path to the folder where the merged raster will be saved.
+        out_file (str): Name of the output merged raster file, ending with '.tif'.
+        recursive (bool): Option to search for GeoTIFF files recursively in subdirectories. Default is False.
+        crs (optional): CRS of the output raster. Default is 27700.
+        method (str): 'merge' or 'vrt'. Default is 'merge'.
+        nodata (float or int): Nodata value of the output raster. Default is -9999.
+        block_size (int): Tile size of the output raster for the 'vrt' method. Default is 512.
+        compress (str): Compression of the output raster for the 'vrt' method. Default is 'deflate'.
+        workers (int): Number of threads reading blocks for the 'vrt' method. Default is 1.
+        keep_vrt (bool): Keep the VRT mosaic next to the output raster for the 'vrt' method. Default is False.
+        bounds (tuple, optional): Bounding box of interest as (min_x, min_y, max_x, max_y).
+        geometry (optional): Shapely geometry, GeoSeries or GeoDataFrame of interest.
+        tile_index (str or bool, optional): Path to a SQLite tile index, or True for 'tile_index.sqlite' in
+            in_folder. Default is None, which reads the tile headers directly.
+        profile (str or dict, optional): Output profile such as 'tiled', 'zstd', 'lerc' or 'cog', or a profile
+            built with output_profile. Defaults to a plain GeoTIFF for the 'merge' method and to a tiled GeoTIFF
+            with the given block_size and compress for the 'vrt' method.
+
+    Returns:
+        None
+    """
+    # The call is timed as a stage, see the instrumentation module
+    timing = current_stage()
+    started = time.time()
+    report(f"Start Time: {time.strftime('%H:%M:%S', time.localtime(started))}")
+
+    # Check if all parameters are provided
+    if not in_folder or not out_folder or not out_file:
+        raise ValueError("in_folder, out_folder, and out_file are required parameters.")
+    # Check if out_file ends with .tif
+    if not out_file.endswith('.tif'):
+        raise ValueError("out_file should end with '.tif'")
+    if method not in ['merge', 'vrt']:
+        raise ValueError("Invalid method. Must be 'merge' or 'vrt'.")
+
+    area = None
+    if tile_index:
+        # Refresh the index for new or modified tiles, then select the tiles from their indexed footprints
+        if tile_index is True:
+            tile_index = default_tile_index_path(in_folder)
+        update_tile_index(in_folder, tile_index, recursive=recursive)
+        headers = query_tile_index(tile_index, bounds=bounds, geometry=geometry, in_folder=in_folder,
+                                   recursive=recursive)
+        area = area_of_interest(bounds, geometry, crs)
+    else:
+        # Get a list of GeoTIFF files in the input directory, with an option to search recursively
+        headers = None
+        geotiff_files = find_geotiffs(in_folder, recursive=recursive)
+        if method == 'vrt' or bounds is not None or geometry is not None:
+            # Only the headers are read here, the pixels are read when merging
+            headers = [read_tile_header(file) for file in geotiff_files]
+            area = area_of_interest(bounds, geometry, crs)
+            headers = filter_tile_headers(headers, area)
+
+    if headers is not None:
+        geotiff_files = [header['path'] for header in headers]
+    if not geotiff_files:
+        raise ValueError(f"No GeoTIFF files found in {in_folder} for the area of interest")
 
-    # Write the masked merged raster to a new file using the specified output folder and file name
     out_file = os.path.join(out_folder, out_file)
-    with rasterio.open(out_file, 'w', driver='GTiff', width=merged.shape[1], height=merged.shape[0],
-                       count=1, dtype=merged.dtype, crs=crs, transform=out_transform) as dst:
-        dst.write(merged, 1)
-        dst.nodata = -9999  # Set the nodata value
+    out_bounds = snap_bounds(area.bounds, headers[0]) if area is not None else None
+
+    if method == 'vrt':
+        if keep_vrt:
+            vrt_file = os.path.splitext(out_file)[0] + '.vrt'
+            build_vrt(headers, vrt_file, nodata=nodata, bounds=out_bounds)
+            write_vrt_windows(vrt_file, out_file, crs=crs, nodata=nodata, block_size=block_size,
+                              compress=compress, workers=workers, profile=profile)
+        else:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                vrt_file = os.path.join(tmpdir, 'mosaic.vrt')
+                build_vrt(headers, vrt_file, nodata=nodata, bounds=out_bounds)
+                write_vrt_windows(vrt_file, out_file, crs=crs, nodata=nodata, block_size=block_size,
+                                  compress=compress, workers=workers, profile=profile)
+    else:
+        with ExitStack() as stack:
+            # Open each raster once, they are all closed when the merge has been written
+            rasters = []
+            with track_progress('Opening tiles', total=len(geotiff_files), unit='tiles') as tiles:
+                for file in geotiff_files:
+                    rasters.append(stack.enter_context(rasterio.open(file)))
+                    tiles.update(1)
 
-    # Record the end time
-    end_time = time_recording('end')
-    print(f"End Time: {end_time}")
+            # Merge the rasters into a single raster
+            merged, out_transform = merge.merge(rasters, bounds=out_bounds, nodata=nodata)
 
-    # Calculate the duration
-    duration = time_recording('duration')
+        merged = merged.squeeze()
+        timing.add(pixels=merged.size, bytes=merged.nbytes)
+
+        # Write the merged raster to a new file using the specified output folder and file name
+        with open_raster_writer(out_file, width=merged.shape[1], height=merged.shape[0], count=1,
+                                dtype=merged.dtype, crs=crs, transform=out_transform, nodata=nodata,
+                                profile=profile) as dst:
+            dst.write(merged, 1)
 
-    print(f"Duration: {duration}")
-    print('processing complete')
-    print(f'{len(selected_geotiffs)} tiffs merged to {os.path.join(out_folder, out_file)}')
+    # Each tile counts as a row of the stage
+    timing.add(rows=len(geotiff_files))
+    duration = time.time() - started
+    report(f"{len(geotiff_files)} tiffs merged to {out_file} in {format_duration(duration)} "
+           f"({len(geotiff_files) / max(duration, 1e-9):.1f} tiles/s)")
 
 
 def view_raster(raster_file, cmap='gray', min_value=0, display_meta=False, fig_size=(10, 10), display_axis=True):
@@ -250,7 +538,8 @@ def view_raster(raster_file, cmap='gray', min_value=0, display_meta=False, fig_s
 import numpy as np
 import rasterio
 
-def raster_calculator(raster1, raster2, output_path, operation):
+@instrumented()
+def raster_calculator(raster1, raster2, output_path, operation, profile=None):
     # Open the input raster datasets
     src1 = rasterio.open(raster1)
     src2 = rasterio.open(raster2)
@@ -258,6 +547,7 @@ def raster_calculator(raster1, raster2, output_path, operation):
     # Read the raster bands as numpy arrays
     arr1 = src1.read(1, masked=True) # Read with masked array to handle nodata values
     arr2 = src2.read(1, masked=True)
+    current_stage().add(pixels=arr1.size, bytes=arr1.data.nbytes + arr2.data.nbytes)
 
     # Perform the specified operation
     if operation == 'add':
@@ -275,11 +565,16 @@ def raster_calculator(raster1, raster2, output_path, operation):
     elif operation == 'max':
         result = np.ma.masked_array(np.maximum(arr1, arr2), mask=(arr1.mask | arr2.mask)) # compare the two rasters and get the maximum value
 
-    # Write the result to the output raster
-    profile = src1.profile
-    profile.update(count=1)
-    with rasterio.open(output_path, 'w', **profile) as dst:
-        dst.write(result, 1)
+    # Write the result to the output raster, with the layout of raster1 unless an output profile is given
+    if profile is None:
+        profile = src1.profile
+        profile.update(count=1)
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            dst.write(result, 1)
+    else:
+        with open_raster_writer(output_path, src1.width, src1.height, 1, result.dtype, src1.crs, src1.transform,
+                                nodata=src1.nodata, profile=profile) as dst:
+            dst.write(result, 1)
 
     # Close the input raster datasets
     src1.close()
@@ -298,47 +593,443 @@ from rasterio.transform import from_origin
 import numpy as np
 
 
-def points_to_raster(gdf, cell_size, output_file, value_column=None):
-    # Get the bounding box of the GeoDataFrame
-    bounds = gdf.total_bounds
+# Aggregations supported by points_to_raster
+POINT_AGGREGATIONS = ['count', 'sum', 'mean', 'min', 'max', 'last']
 
 
+def _reduce_by_cell(cells, values, ufunc):
+    """
+    Reduce the values falling in each cell with a numpy ufunc.
 
+    Args:
+        cells (numpy.ndarray): Flat cell index of each value.
+        values (numpy.ndarray): Values to reduce.
+        ufunc (numpy.ufunc): Reduction, e.g. np.minimum or np.maximum.
 
+    Returns:
+        tuple: The unique cells and the reduced value of each cell.
+    """
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    return cells[starts], ufunc.reduceat(values[order], starts)
 
-    # Calculate the dimensions of the raster based on the bounding box and cell size
-    width = int((bounds[2] - bounds[0]) / cell_size)
-    height = int((bounds[3] - bounds[1]) / cell_size)
 
-    # Create an empty raster with the specified dimensions
-    raster = np.zeros((height, width))
+@instrumented()
+def points_to_raster(gdf, cell_size, output_file, value_column=None, profile=None, aggregation=None, dtype=None,
+                     nodata=None, bounds=None, crs=None, chunk_size=None):
+    """
+    Rasterise points by aggregating the points, or a value of the points, falling in each cell.
 
-    # Create the transform for the raster
-    transform = from_origin(bounds[0], bounds[1] + cell_size * height, cell_size, cell_size)
+    The cell of every point is computed with numpy and the values are accumulated with bincount and sorted
+    reductions, so the cost is a few array passes rather than a Python loop over the points. The input can be
+    processed in chunks to bound memory use: either a GeoDataFrame split into chunk_size rows, or any iterable of
+    GeoDataFrames, such as a file read in chunks, in which case the bounds are required.
 
-    # Loop through each point and update the raster cell with the value from the specified column
-    if value_column is not None:
-        for idx, point in gdf.iterrows():
-            col = int((point.geometry.x - bounds[0]) / cell_size)
-            row = int((bounds[3] - point.geometry.y) / cell_size)
+    Args:
+        gdf (GeoDataFrame or iterable): Point GeoDataFrame, or an iterable of point GeoDataFrames.
+        cell_size (float): Size of the raster cells in CRS units.
+        output_file (str): Path of the output raster.
+        value_column (str, optional): Column holding the point values. Defaults to None, which counts points.
+        profile (str or dict, optional): Output profile, see output_profile. Defaults to a plain GeoTIFF.
+        aggregation (str, optional): 'count', 'sum', 'mean', 'min', 'max' or 'last'. Defaults to 'sum' when a
+            value_column is given and 'count' otherwise.
+        dtype (str, optional): Data type of the output. Defaults to 'uint32' for counts, 'float32' for means and
+            the data type of the value column otherwise, with sums widened to 64 bits.
+        nodata (float or int, optional): Value of cells without points for the 'mean', 'min', 'max' and 'last'
+            aggregations, which must fit the data type. Defaults to -9999 for floating point data types, the
+            smallest value of a signed integer type and the largest value of an unsigned one. Cells without points
+            are 0 for 'count' and 'sum'.
+        bounds (tuple, optional): Extent of the raster as (min_x, min_y, max_x, max_y). Defaults to the bounds of
+            the points. Points outside the bounds are ignored.
+        crs (optional): CRS of the output. Defaults to the CRS of the points.
+        chunk_size (int, optional): Number of points processed at a time. Defaults to None, which processes all
+            points at once.
 
-            # Check if the calculated indices are within the valid range
-            if 0 <= row < height and 0 <= col < width:
-                raster[row, col] += point[value_column]
+    Returns:
+        None
+    """
+    if aggregation is None:
+        aggregation = 'sum' if value_column is not None else 'count'
+    if aggregation not in POINT_AGGREGATIONS:
+        raise ValueError(f"Invalid aggregation. Must be one of {', '.join(POINT_AGGREGATIONS)}.")
+    if aggregation != 'count' and value_column is None:
+        raise ValueError(f"A value_column is required for the '{aggregation}' aggregation.")
+
+    if isinstance(gdf, gpd.GeoDataFrame):
+        if bounds is None:
+            bounds = gdf.total_bounds
+        if crs is None:
+            crs = gdf.crs
+        chunks = chunk_geodataframe(gdf, chunk_size) if chunk_size else [gdf]
+    elif bounds is None:
+        raise ValueError("bounds are required when the points are given as an iterable of GeoDataFrames.")
     else:
-        # If no value_column is specified, assume each point represents a single value
-        for idx, point in gdf.iterrows():
-            col = int((point.geometry.x - bounds[0]) / cell_size)
-            row = int((bounds[3] - point.geometry.y) / cell_size)
+        chunks = gdf
+
+    # Calculate the dimensions of the raster based on the bounding box and cell size
+    min_x, min_y, max_x, max_y = bounds
+    width = max(int(np.ceil((max_x - min_x) / cell_size)), 1)
+    height = max(int(np.ceil((max_y - min_y) / cell_size)), 1)
+
+    # Create the transform for the raster, with the origin at the top left corner used for the row calculation
+    transform = from_origin(min_x, max_y, cell_size, cell_size)
+
+    # Flat accumulators over all cells, filled chunk by chunk
+    size = width * height
+    counts = np.zeros(size, dtype=np.int64)
+    totals = np.zeros(size, dtype=np.float64) if aggregation in ['sum', 'mean'] else None
+    reduced = None
+    value_dtype = None
+
+    for chunk in chunks:
+        if crs is None:
+            crs = chunk.crs
+        # Get the coordinates of the points as arrays
+        geometries = chunk.geometry.values
+        current_stage().add(rows=len(geometries))
+        x = shapely.get_x(geometries)
+        y = shapely.get_y(geometries)
+
+        # Keep points with coordinates inside the raster extent
+        valid = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        values = None
+        if value_column is not None:
+            values = chunk[value_column].to_numpy()
+            value_dtype = values.dtype if value_dtype is None else value_dtype
+            if aggregation != 'count' and np.issubdtype(values.dtype, np.floating):
+                valid &= ~np.isnan(values)
+            values = values[valid]
+
+        # Calculate the row and column of each point, points on the maximum edges fall in the last row or column
+        cols = np.minimum(((x[valid] - min_x) / cell_size).astype(np.int64), width - 1)
+        rows = np.minimum(((max_y - y[valid]) / cell_size).astype(np.int64), height - 1)
+        cells = rows * width + cols
+
+        chunk_counts = np.bincount(cells, minlength=size)
+        counts += chunk_counts
+        if totals is not None:
+            totals += np.bincount(cells, weights=values, minlength=size)
+        elif aggregation in ['min', 'max', 'last'] and len(cells):
+            if reduced is None:
+                reduced = np.zeros(size, dtype=values.dtype)
+            if aggregation == 'last':
+                # The last point of a cell is the first one seen when reading the points backwards
+                unique_cells, first = np.unique(cells[::-1], return_index=True)
+                cell_values = values[::-1][first]
+            else:
+                ufunc = np.minimum if aggregation == 'min' else np.maximum
+                unique_cells, cell_values = _reduce_by_cell(cells, values, ufunc)
+                # Combine with the cells already filled by earlier chunks
+                seen = counts[unique_cells] > chunk_counts[unique_cells]
+                cell_values[seen] = ufunc(cell_values[seen], reduced[unique_cells[seen]])
+            reduced[unique_cells] = cell_values
+
+    # Choose the output data type
+    if dtype is None:
+        if aggregation == 'count':
+            dtype = 'uint32'
+        elif aggregation == 'mean' or value_dtype is None:
+            dtype = 'float32'
+        elif aggregation == 'sum':
+            dtype = np.result_type(value_dtype, np.int64) if value_dtype.kind in 'biu' else np.float64
+        else:
+            dtype = value_dtype
+    dtype = np.dtype(dtype)
+
+    empty = counts == 0
+    if aggregation in ['count', 'sum']:
+        raster = (counts if aggregation == 'count' else totals).astype(dtype)
+        nodata = None
+    else:
+        if nodata is None:
+            if dtype.kind == 'u':
+                nodata = np.iinfo(dtype).max
+            elif dtype.kind == 'i':
+                nodata = np.iinfo(dtype).min
+            else:
+                nodata = -9999
+        elif dtype.kind in 'iu':
+            limits = np.iinfo(dtype)
+            if not float(nodata).is_integer() or not limits.min <= nodata <= limits.max:
+                raise ValueError(f"nodata {nodata} does not fit the {dtype.name} data type, whose values run from "
+                                 f"{limits.min} to {limits.max}.")
+        elif dtype.kind == 'f' and not np.isnan(nodata) and abs(nodata) > np.finfo(dtype).max:
+            raise ValueError(f"nodata {nodata} does not fit the {dtype.name} data type.")
+        if aggregation == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                raster = totals / counts
+        else:
+            raster = reduced if reduced is not None else np.zeros(size, dtype=dtype)
+        raster = raster.astype(dtype)
+        raster[empty] = nodata
 
-            # Check if the calculated indices are within the valid range
-            if 0 <= row < height and 0 <= col < width:
-                raster[row, col] += 1
+    raster = raster.reshape(height, width)
 
     # Save the raster to a file using rasterio
-    with rasterio.open(output_file, 'w', driver='GTiff', height=height, width=width, count=1, dtype=raster.dtype, crs=gdf.crs, transform=transform) as dst:
+    with open_raster_writer(output_file, width=width, height=height, count=1, dtype=raster.dtype, crs=crs,
+                            transform=transform, nodata=nodata, profile=profile) as dst:
         dst.write(raster, 1)
 
 
+def raster_grid(like):
+    """
+    Return the grid of an existing raster, so other rasters can be aligned to it.
+
+    Args:
+        like (str or rasterio.io.DatasetReader): Path to the raster, or an open raster dataset.
+
+    Returns:
+        tuple: The transform, width, height and CRS of the raster.
+    """
+    if isinstance(like, str):
+        with rasterio.open(like) as src:
+            return src.transform, src.width, src.height, src.crs
+    return like.transform, like.width, like.height, like.crs
+
+
+@instrumented()
+def vector_to_raster(gdf, output_file, cell_size=None, like=None, value_column=None, burn_value=1,
+                     all_touched=False, coverage=False, supersample=10, merge_alg='replace', dtype=None, nodata=None,
+                     bounds=None, block_size=512, workers=1, profile=None):
+    """
+    Rasterise polygons or lines with rasterio.features.rasterize.
+
+    The output is written window by window, each window only rasterising the geometries that intersect it, clipped
+    to the window, so large extents are not limited by memory and windows can be rasterised in parallel. The grid is
+    either built from a cell size and bounds, or taken from an existing raster so the result lines up cell for cell
+    with it, for example to use both in the raster calculator.
+
+    Args:
+        gdf (GeoDataFrame): Polygons or lines to rasterise.
+        output_file (str): Path of the output raster.
+        cell_size (float, optional): Size of the raster cells in CRS units. Required unless like is given.
+        like (str or rasterio.io.DatasetReader, optional): Raster whose grid and CRS the output is aligned to. The
+            geometries are reprojected to its CRS if needed.
+        value_column (str, optional): Column holding the value burned for each geometry. Defaults to None, which
+            burns burn_value.
+        burn_value (float or int): Value burned when no value_column is given. Default is 1.
+        all_touched (bool): Burn every cell touched by a geometry rather than only the cells whose centre is
+            inside it. Default is False.
+        coverage (bool): Write the fraction of each cell covered by the geometries instead of burn values.
+            Default is False.
+        supersample (int): Number of sub-cells per cell side used to estimate the coverage fraction. Default is 10.
+        merge_alg (str): 'replace' or 'add', how overlapping geometries combine. Default is 'replace'.
+        dtype (str, optional): Data type of the output. Defaults to 'float32' for coverage and to the data type of
+            the burn values otherwise.
+        nodata (float or int, optional): Value of cells not covered by any geometry, also set as the nodata value of
+            the output. Defaults to None, which fills with 0.
+        bounds (tuple, optional): Extent of the raster as (min_x, min_y, max_x, max_y) when like is not given.
+            Defaults to the bounds of the geometries.
+        block_size (int): Width and height of the windows in pixels. Default is 512.
+        workers (int): Number of threads rasterising windows. Default is 1.
+        profile (str or dict, optional): Output profile, see output_profile. Defaults to a plain GeoTIFF.
+
+    Returns:
+        None
+    """
+    if merge_alg not in ['replace', 'add']:
+        raise ValueError("Invalid merge_alg. Must be 'replace' or 'add'.")
+
+    # Build the output grid
+    if like is not None:
+        transform, width, height, crs = raster_grid(like)
+        if crs is not None and gdf.crs is not None:
+            gdf = reproject(gdf, crs)
+    elif cell_size is None:
+        raise ValueError("Either cell_size or like is required.")
+    else:
+        min_x, min_y, max_x, max_y = bounds if bounds is not None else gdf.total_bounds
+        width = max(int(np.ceil((max_x - min_x) / cell_size)), 1)
+        height = max(int(np.ceil((max_y - min_y) / cell_size)), 1)
+        transform = from_origin(min_x, max_y, cell_size, cell_size)
+        crs = gdf.crs
+
+    # Drop missing and empty geometries, they cannot be burned
+    keep = ~(gdf.geometry.isna() | gdf.geometry.is_empty)
+    geometries = gdf.geometry.values[keep.to_numpy()]
+    current_stage().add(rows=len(geometries), pixels=width * height)
+    if value_column is not None:
+        values = gdf[value_column].to_numpy()[keep.to_numpy()]
+    else:
+        values = np.full(len(geometries), burn_value)
+
+    # Choose the output data type
+    if dtype is None:
+        if coverage:
+            dtype = 'float32'
+        elif values.dtype == bool:
+            dtype = 'uint8'
+        elif value_column is None and float(burn_value).is_integer() and 0 <= burn_value <= 255:
+            dtype = 'uint8'
+        else:
+            dtype = values.dtype
+    dtype = np.dtype(dtype)
+    fill = nodata if nodata is not None else 0
+
+    tree = shapely.STRtree(geometries)
+    alg = MergeAlg.add if merge_alg == 'add' else MergeAlg.replace
+
+    def rasterize_window(window):
+        window_transform = rasterio.windows.transform(window, transform)
+        left, bottom, right, top = rasterio.windows.bounds(window, transform)
+        shape = (int(window.height), int(window.width))
+
+        # Keep the candidates in input order, so later geometries replace earlier ones as without windows
+        candidates = np.sort(tree.query(shapely.box(left, bottom, right, top), predicate='intersects'))
+        if len(candidates) == 0:
+            return window, np.full(shape, fill, dtype=dtype)
+
+        # Clip the geometries to the window, grown by a cell so edges burn the same as without clipping
+        margin = max(abs(transform.a), abs(transform.e))
+        clipped = shapely.clip_by_rect(geometries[candidates], left - margin, bottom - margin, right + margin,
+                                       top + margin)
+
+        if coverage:
+            # Burn sub-cells at their centres and average them back to the output cells
+            fine = features.rasterize(
+                [(geometry, 1) for geometry in clipped if not geometry.is_empty],
+                out_shape=(shape[0] * supersample, shape[1] * supersample),
+                transform=window_transform * Affine.scale(1 / supersample),
+                fill=0,
+                dtype='uint8',
+            )
+            fraction = fine.reshape(shape[0], supersample, shape[1], supersample).mean(axis=(1, 3))
+            data = fraction.astype(dtype)
+            if nodata is not None:
+                data[fraction == 0] = nodata
+            return window, data
+
+        shapes = [(geometry, value) for geometry, value in zip(clipped, values[candidates]) if not geometry.is_empty]
+        if not shapes:
+            return window, np.full(shape, fill, dtype=dtype)
+        return window, features.rasterize(shapes, out_shape=shape, transform=window_transform, fill=fill,
+                                          all_touched=all_touched, merge_alg=alg, dtype=dtype)
+
+    windows = block_windows(width, height, block_size)
+
+    with open_raster_writer(output_file, width=width, height=height, count=1, dtype=dtype, crs=crs,
+                            transform=transform, nodata=nodata, profile=profile) as dst:
+        if workers <= 1:
+            for window in windows:
+                window, data = rasterize_window(window)
+                dst.write(data, 1, window=window)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Submit a few batches at a time so finished windows do not pile up ahead of the writer
+                batch_size = workers * 4
+                for i in range(0, len(windows), batch_size):
+                    for window, data in executor.map(rasterize_window, windows[i:i + batch_size]):
+                        dst.write(data, 1, window=window)
 
 
+# Methods supported by sample_raster
+SAMPLE_METHODS = ['nearest', 'bilinear']
+
+
+@instrumented(rows=len)
+def sample_raster(points_gdf, raster, bands=None, method='nearest', block_size=512):
+    """
+    Sample the values of a raster at many points.
+
+    Points are grouped by the block of the raster they fall in, each block is read once for all the requested bands,
+    and the values of its points are picked out with vectorised indexing, instead of asking GDAL point by point.
+
+    Args:
+        points_gdf (GeoDataFrame): The points to sample, reprojected to the CRS of the raster when both have a CRS.
+        raster (str or rasterio.io.DatasetReader): Path to the raster, or an open raster dataset.
+        bands (int or list, optional): Band or bands to sample. Defaults to every band.
+        method (str): 'nearest' for the value of the cell containing each point, or 'bilinear' to interpolate
+            between the four nearest cell centres. Default is 'nearest'.
+        block_size (int): Minimum size in pixels of the blocks points are grouped by. Smaller native blocks, such
+            as the single row strips of a striped GeoTIFF, are combined up to this size. Default is 512.
+
+    Returns:
+        pandas.DataFrame: The sampled values, with a band_<n> column for each band, aligned to the index of
+        points_gdf. Points outside the raster or on nodata cells are NaN.
+    """
+    if method not in SAMPLE_METHODS:
+        raise ValueError(f"Invalid method. Must be one of {', '.join(SAMPLE_METHODS)}.")
+
+    if isinstance(raster, str):
+        with rasterio.open(raster) as src:
+            return sample_raster(points_gdf, src, bands=bands, method=method, block_size=block_size)
+    src = raster
+
+    if bands is None:
+        bands = list(range(1, src.count + 1))
+    elif isinstance(bands, int):
+        bands = [bands]
+    else:
+        bands = list(bands)
+
+    points = points_gdf
+    if points.crs is not None and src.crs is not None:
+        points = reproject(points, src.crs)
+
+    values = np.full((len(points), len(bands)), np.nan)
+    columns = [f"band_{band}" for band in bands]
+
+    # Fractional column and row of every point. Bilinear interpolation works between cell centres.
+    col_f, row_f = ~src.transform * (points.geometry.x.to_numpy(), points.geometry.y.to_numpy())
+    if method == 'bilinear':
+        col_f, row_f = col_f - 0.5, row_f - 0.5
+        inside = (col_f >= -0.5) & (col_f <= src.width - 0.5) & (row_f >= -0.5) & (row_f <= src.height - 0.5)
+    else:
+        inside = (col_f >= 0) & (col_f < src.width) & (row_f >= 0) & (row_f < src.height)
+
+    indices = np.flatnonzero(inside)
+    if len(indices) == 0:
+        return pd.DataFrame(values, index=points_gdf.index, columns=columns)
+
+    col0 = np.floor(col_f[indices]).astype(np.int64)
+    row0 = np.floor(row_f[indices]).astype(np.int64)
+
+    # Group the points by block, with native blocks combined up to block_size
+    native_height, native_width = src.block_shapes[0]
+    block_height = native_height * max(1, -(-block_size // native_height))
+    block_width = native_width * max(1, -(-block_size // native_width))
+    blocks_x = -(-src.width // block_width)
+    block_ids = (np.clip(row0, 0, None) // block_height) * blocks_x + np.clip(col0, 0, None) // block_width
+
+    order = np.argsort(block_ids, kind='stable')
+    sorted_ids = block_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    # Bilinear interpolation also needs the row and column after the block
+    halo = 1 if method == 'bilinear' else 0
+
+    for start, end in zip(starts, ends):
+        members = order[start:end]
+        block_row, block_col = divmod(int(sorted_ids[start]), blocks_x)
+        row_off, col_off = block_row * block_height, block_col * block_width
+        window = Window(col_off, row_off, min(block_width + halo, src.width - col_off),
+                        min(block_height + halo, src.height - row_off))
+
+        # Read the block once for every band, with nodata cells as NaN
+        data = src.read(bands, window=window).astype(np.float64)
+        for position, band in enumerate(bands):
+            nodata = src.nodatavals[band - 1]
+            if nodata is not None:
+                data[position][data[position] == nodata] = np.nan
+
+        rows, cols = row0[members], col0[members]
+        if method == 'nearest':
+            values[indices[members]] = data[:, rows - row_off, cols - col_off].T
+            continue
+
+        # Points within half a cell of the edge take the edge cells as their missing neighbours
+        row_a = np.clip(rows, 0, src.height - 1) - row_off
+        row_b = np.clip(rows + 1, 0, src.height - 1) - row_off
+        col_a = np.clip(cols, 0, src.width - 1) - col_off
+        col_b = np.clip(cols + 1, 0, src.width - 1) - col_off
+        weight_row = row_f[indices[members]] - rows
+        weight_col = col_f[indices[members]] - cols
+        values[indices[members]] = (
+            data[:, row_a, col_a] * (1 - weight_row) * (1 - weight_col)
+            + data[:, row_a, col_b] * (1 - weight_row) * weight_col
+            + data[:, row_b, col_a] * weight_row * (1 - weight_col)
+            + data[:, row_b, col_b] * weight_row * weight_col
+        ).T
+
+    return pd.DataFrame(values, index=points_gdf.index, columns=columns)
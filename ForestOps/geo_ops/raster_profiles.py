@@ -0,0 +1,208 @@
+import os
+from contextlib import contextmanager
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.env import GDALVersion
+
+
+'''
+This module builds the GeoTIFF output profiles (tiling, compression, overviews and COG layout) used by the raster
+writers
+'''
+
+
+# Named output profiles. 'gtiff' is the plain striped, uncompressed layout the writers have always produced.
+RASTER_PROFILES = {
+    'gtiff': {},
+    'tiled': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate', 'bigtiff': 'IF_SAFER'},
+    'zstd': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'zstd', 'bigtiff': 'IF_SAFER'},
+    'lerc': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'lerc_deflate', 'max_z_error': 0,
+             'bigtiff': 'IF_SAFER'},
+    'cog': {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate', 'bigtiff': 'IF_SAFER',
+            'overviews': 'auto', 'cog': True},
+}
+
+# Compression methods that benefit from a horizontal differencing predictor
+_PREDICTOR_COMPRESSION = ['deflate', 'zstd', 'lzw', 'lzma']
+
+
+def output_profile(profile='tiled', dtype='float32', compress=None, predictor=None, block_size=None, bigtiff=None,
+                   overviews=None, overview_resampling='average', cog=None, **creation_options):
+    """
+    Build a GeoTIFF output profile from a named profile and overrides.
+
+    Args:
+        profile (str): Name of the base profile in RASTER_PROFILES: 'gtiff', 'tiled', 'zstd', 'lerc' or 'cog'.
+            Default is 'tiled'.
+        dtype (str): Data type of the raster, used to choose the predictor. Default is 'float32'.
+        compress (str, optional): Compression, e.g. 'deflate', 'zstd', 'lerc', 'lerc_deflate' or 'lerc_zstd'.
+        predictor (int, optional): 1 (none), 2 (horizontal) or 3 (floating point). Defaults to 2 for integer and
+            3 for floating point data when the compression supports it.
+        block_size (int, optional): Width and height of the internal tiles in pixels. Must be a multiple of 16.
+        bigtiff (str, optional): 'YES', 'NO', 'IF_NEEDED' or 'IF_SAFER'.
+        overviews (list or str, optional): Overview decimation factors, or 'auto' to halve the raster until it
+            fits in a single tile.
+        overview_resampling (str): Resampling used to build the overviews. Default is 'average'.
+        cog (bool, optional): Write a Cloud-Optimized GeoTIFF layout.
+        **creation_options: Any other GDAL GeoTIFF creation options, e.g. zlevel or max_z_error.
+
+    Returns:
+        dict: The output profile, which can be passed as the profile argument of the raster writers.
+    """
+    if profile not in RASTER_PROFILES:
+        raise ValueError(f"Invalid profile. Must be one of {', '.join(RASTER_PROFILES)}.")
+
+    options = dict(RASTER_PROFILES[profile])
+
+    if compress is not None:
+        options['compress'] = compress
+    if block_size is not None:
+        options.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+    if bigtiff is not None:
+        options['bigtiff'] = bigtiff
+    if overviews is not None:
+        options['overviews'] = overviews
+    if cog is not None:
+        options['cog'] = cog
+    if options.get('overviews'):
+        options['overview_resampling'] = overview_resampling
+    options.update(creation_options)
+
+    # Differencing neighbouring pixels before compressing shrinks most elevation and continuous rasters
+    if predictor is None and str(options.get('compress', '')).lower() in _PREDICTOR_COMPRESSION:
+        predictor = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+    if predictor is not None:
+        options['predictor'] = predictor
+
+    return options
+
+
+def resolve_output_profile(profile, dtype):
+    """
+    Turn the profile argument of a raster writer into an output profile.
+
+    Args:
+        profile (str, dict or None): None for the plain 'gtiff' layout, the name of a profile in RASTER_PROFILES, or
+            a profile built with output_profile.
+        dtype (str): Data type of the raster.
+
+    Returns:
+        dict: A copy of the output profile.
+    """
+    if profile is None:
+        return {}
+    if isinstance(profile, str):
+        return output_profile(profile, dtype=dtype)
+    return dict(profile)
+
+
+def overview_factors(width, height, block_size=512):
+    """
+    Return the overview factors needed for a raster to fit in a single tile at its coarsest overview.
+
+    Args:
+        width (int): Width of the raster in pixels.
+        height (int): Height of the raster in pixels.
+        block_size (int): Size of the tiles in pixels. Default is 512.
+
+    Returns:
+        list: Overview decimation factors, e.g. [2, 4, 8].
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def _cog_creation_options(options):
+    """
+    Translate GeoTIFF creation options into the options of the GDAL COG driver.
+
+    Args:
+        options (dict): GeoTIFF creation options of an output profile.
+
+    Returns:
+        dict: COG driver creation options.
+    """
+    cog_options = {}
+    for key, value in options.items():
+        if key in ['tiled', 'blockysize', 'interleave', 'photometric']:
+            continue
+        if key == 'blockxsize':
+            cog_options['blocksize'] = value
+        elif key == 'predictor':
+            cog_options['predictor'] = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}.get(value, value)
+        elif key == 'zlevel':
+            cog_options['level'] = value
+        else:
+            cog_options[key] = value
+    return cog_options
+
+
+@contextmanager
+def open_raster_writer(filename, width, height, count, dtype, crs, transform, nodata=None, profile=None):
+    """
+    Open a GeoTIFF for writing with an output profile, as a context manager yielding the rasterio dataset.
+
+    Overviews are built when the dataset is closed. For the COG layout the data is written to a temporary tiled
+    GeoTIFF next to the output, which is then copied to the output with the overviews placed ahead of the full
+    resolution data.
+
+    Args:
+        filename (str): Output file name.
+        width (int): Width of the raster in pixels.
+        height (int): Height of the raster in pixels.
+        count (int): Number of bands.
+        dtype (str): Data type of the raster.
+        crs: CRS of the raster.
+        transform (affine.Affine): Affine transformation of the raster.
+        nodata (float or int, optional): Nodata value of the raster.
+        profile (str, dict or None): Output profile, see resolve_output_profile.
+
+    Yields:
+        rasterio.io.DatasetWriter: The dataset to write to.
+    """
+    options = resolve_output_profile(profile, dtype)
+    cog = options.pop('cog', False)
+    overviews = options.pop('overviews', None)
+    resampling = options.pop('overview_resampling', 'average')
+
+    if overviews == 'auto':
+        overviews = overview_factors(width, height, options.get('blockxsize', 512))
+
+    target = f"{os.path.splitext(filename)[0]}.tmp.tif" if cog else filename
+    # The temporary file of a COG is only read once, so it is compressed with a fast setting
+    if cog:
+        write_options = {key: options[key] for key in ['blockxsize', 'blockysize', 'bigtiff'] if key in options}
+        write_options.update(tiled=True, compress='deflate', zlevel=1)
+    else:
+        write_options = options
+
+    try:
+        with rasterio.open(target, 'w', driver='GTiff', width=width, height=height, count=count, dtype=dtype,
+                           crs=crs, transform=transform, nodata=nodata, **write_options) as dst:
+            yield dst
+
+            if overviews and not cog:
+                dst.build_overviews(overviews, Resampling[resampling])
+                dst.update_tags(ns='rio_overview', resampling=resampling)
+
+        if cog:
+            if GDALVersion.runtime().at_least('3.1'):
+                cog_options = _cog_creation_options(options)
+                cog_options['overviews'] = 'AUTO' if overviews else 'NONE'
+                cog_options['resampling'] = resampling
+                rasterio.shutil.copy(target, filename, driver='COG', **cog_options)
+            else:
+                # Before GDAL 3.1 a COG is a tiled GeoTIFF copied together with its overviews
+                if overviews:
+                    with rasterio.open(target, 'r+') as src:
+                        src.build_overviews(overviews, Resampling[resampling])
+                rasterio.shutil.copy(target, filename, driver='GTiff', copy_src_overviews=True, **options)
+    finally:
+        if cog and os.path.exists(target):
+            os.remove(target)
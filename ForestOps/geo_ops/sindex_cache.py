@@ -0,0 +1,494 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import geopandas as gpd
+import shapely
+from ForestOps.geo_ops.geo_io import read_data
+from ForestOps.geo_ops.crs_cache import parse_crs
+
+
+'''
+This module caches the spatial indexes of reference layers, such as ancient woodland or scheduled monuments, so
+repeated joins and overlays against the same layer build its index once.
+
+Layers read from files, or given a key, are cached in memory by path or key and version, and also saved to disk as a
+store of WKB geometries with a packed R-tree of their bounding boxes. Later runs load them from there instead of
+reading the source again, and decode only the geometries near the features they are joined to.
+'''
+
+
+class PackedRTree:
+    """
+    Static R-tree of bounding boxes packed by Sort-Tile-Recursive into flat NumPy arrays, which are saved and
+    memory-mapped as they are.
+
+    The tree finds the items near an area without decoding any geometry. Predicate queries between geometries go
+    through a shapely STRtree, which is much faster for large bulk queries.
+
+    Args:
+        order (numpy.ndarray): Positions of the items in leaf order. Items without bounds are left out.
+        boxes (numpy.ndarray): Bounds of the leaves, then of the nodes of each level up to the root, as rows of
+            (minx, miny, maxx, maxy).
+        level_sizes (numpy.ndarray): Number of boxes at each level, leaves first.
+        node_capacity (int): Number of children of each node.
+    """
+
+    def __init__(self, order, boxes, level_sizes, node_capacity):
+        self.order = order
+        self.boxes = boxes
+        self.level_sizes = level_sizes
+        self.node_capacity = node_capacity
+
+    def __repr__(self):
+        return (f"PackedRTree(items={len(self.order)}, levels={len(self.level_sizes)}, "
+                f"node_capacity={self.node_capacity})")
+
+    @classmethod
+    def build(cls, bounds, node_capacity=16):
+        """
+        Pack a tree from the bounds of a set of items.
+
+        Args:
+            bounds (numpy.ndarray): Rows of (minx, miny, maxx, maxy), NaN for missing or empty geometries.
+            node_capacity (int): Number of children of each node. Default is 16.
+
+        Returns:
+            PackedRTree: The tree.
+        """
+        if node_capacity < 2:
+            raise ValueError("node_capacity must be at least 2.")
+        bounds = np.asarray(bounds, dtype='float64').reshape(-1, 4)
+        items = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+        if len(items) == 0:
+            return cls(items, np.empty((0, 4)), np.array([], dtype='int64'), node_capacity)
+
+        # Sort-Tile-Recursive: vertical slices of items by x, each sorted by y
+        centres_x = (bounds[items, 0] + bounds[items, 2]) / 2
+        centres_y = (bounds[items, 1] + bounds[items, 3]) / 2
+        leaves = -(-len(items) // node_capacity)
+        slice_size = int(np.ceil(np.sqrt(leaves))) * node_capacity
+        slices = np.empty(len(items), dtype='int64')
+        slices[np.argsort(centres_x, kind='stable')] = np.arange(len(items)) // slice_size
+        order = items[np.lexsort((centres_y, slices))]
+
+        # Each level holds the bounds of consecutive groups of node_capacity boxes of the level below
+        levels = [bounds[order]]
+        while len(levels[-1]) > 1:
+            below = levels[-1]
+            starts = np.arange(0, len(below), node_capacity)
+            levels.append(np.column_stack([np.minimum.reduceat(below[:, 0], starts),
+                                           np.minimum.reduceat(below[:, 1], starts),
+                                           np.maximum.reduceat(below[:, 2], starts),
+                                           np.maximum.reduceat(below[:, 3], starts)]))
+        return cls(order, np.concatenate(levels), np.array([len(level) for level in levels]), node_capacity)
+
+    def query(self, boxes):
+        """
+        Find the items whose bounds intersect each of a set of boxes, walking every box down the tree at once.
+
+        Args:
+            boxes (array-like): Rows of (minx, miny, maxx, maxy).
+
+        Returns:
+            tuple: The positions of the boxes and of the matching items, one pair for each match.
+        """
+        boxes = np.asarray(boxes, dtype='float64').reshape(-1, 4)
+        if len(self.level_sizes) == 0 or len(boxes) == 0:
+            return np.array([], dtype='int64'), np.array([], dtype='int64')
+        offsets = np.concatenate([[0], np.cumsum(self.level_sizes)])
+
+        def overlapping(queries, nodes, level):
+            node_boxes = self.boxes[offsets[level] + nodes]
+            query_boxes = boxes[queries]
+            return ((node_boxes[:, 0] <= query_boxes[:, 2]) & (node_boxes[:, 2] >= query_boxes[:, 0])
+                    & (node_boxes[:, 1] <= query_boxes[:, 3]) & (node_boxes[:, 3] >= query_boxes[:, 1]))
+
+        # Start from the root and expand the (box, node) pairs that overlap, level by level, down to the leaves
+        level = len(self.level_sizes) - 1
+        queries = np.arange(len(boxes))
+        nodes = np.zeros(len(boxes), dtype='int64')
+        keep = overlapping(queries, nodes, level)
+        queries, nodes = queries[keep], nodes[keep]
+        while level > 0:
+            level -= 1
+            children = (nodes[:, np.newaxis] * self.node_capacity + np.arange(self.node_capacity)).ravel()
+            queries = np.repeat(queries, self.node_capacity)
+            exists = children < self.level_sizes[level]
+            queries, children = queries[exists], children[exists]
+            keep = overlapping(queries, children, level)
+            queries, nodes = queries[keep], children[keep]
+        return queries, self.order[nodes]
+
+    def save(self, folder):
+        """
+        Write the tree arrays to a folder.
+        """
+        np.save(os.path.join(folder, 'tree_order.npy'), self.order)
+        np.save(os.path.join(folder, 'tree_boxes.npy'), self.boxes)
+        np.save(os.path.join(folder, 'tree_levels.npy'), self.level_sizes)
+
+    @classmethod
+    def load(cls, folder, node_capacity):
+        """
+        Memory-map a tree written by save.
+        """
+        level_sizes = np.load(os.path.join(folder, 'tree_levels.npy'))
+        # Empty arrays cannot be memory-mapped
+        mode = 'r' if level_sizes.sum() else None
+        return cls(np.load(os.path.join(folder, 'tree_order.npy'), mmap_mode=mode),
+                   np.load(os.path.join(folder, 'tree_boxes.npy'), mmap_mode=mode), level_sizes, node_capacity)
+
+
+class IndexedLayer:
+    """
+    The geometries of a reference layer with their spatial indexes, built once and shared by every query.
+
+    Layers loaded from disk keep their geometries as WKB and decode them when a query first needs them. A query
+    covering a small part of the layer only decodes and indexes the geometries in that part. Use cached_index to
+    get one.
+
+    Args:
+        geometries (numpy.ndarray, optional): The decoded geometries.
+        crs (optional): CRS of the geometries.
+        key (optional): Key of the layer in the cache.
+        wkb (numpy.ndarray, optional): WKB of every geometry as one byte array, when the geometries are not decoded.
+        offsets (numpy.ndarray, optional): Start of each geometry in wkb, followed by the length of wkb.
+        tree (PackedRTree, optional): Packed tree of the bounds of the geometries. Built when first needed.
+    """
+
+    def __init__(self, geometries=None, crs=None, key=None, wkb=None, offsets=None, tree=None):
+        if geometries is None and wkb is None:
+            raise ValueError("Either geometries or wkb is required.")
+        self.crs = parse_crs(crs)
+        self.key = key
+        self._wkb = wkb
+        self._offsets = offsets
+        self._tree = tree
+        self._sindex = None
+        self._lock = threading.Lock()
+        if geometries is not None:
+            self._geometries = np.asarray(geometries, dtype=object)
+            self._decoded = None
+        else:
+            self._geometries = np.full(len(offsets) - 1, None, dtype=object)
+            self._decoded = np.zeros(len(offsets) - 1, dtype=bool)
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def __repr__(self):
+        return f"IndexedLayer(key={self.key!r}, features={len(self)}, crs={self.crs.to_string() if self.crs else None})"
+
+    @property
+    def tree(self):
+        """
+        PackedRTree: The packed tree of the bounds of the geometries.
+        """
+        if self._tree is None:
+            tree = PackedRTree.build(shapely.bounds(self.geometries()))
+            with self._lock:
+                if self._tree is None:
+                    self._tree = tree
+        return self._tree
+
+    @property
+    def sindex(self):
+        """
+        shapely.STRtree: The index of every geometry of the layer, built the first time it is used.
+        """
+        if self._sindex is None:
+            sindex = shapely.STRtree(self.geometries())
+            with self._lock:
+                if self._sindex is None:
+                    self._sindex = sindex
+        return self._sindex
+
+    def geometries(self, positions=None):
+        """
+        Return geometries of the layer, decoding them first if needed.
+
+        Args:
+            positions (array-like, optional): Positions of the geometries. Defaults to every geometry.
+
+        Returns:
+            numpy.ndarray: The geometries.
+        """
+        if self._decoded is not None:
+            with self._lock:
+                wanted = np.arange(len(self)) if positions is None else np.asarray(positions)
+                missing = wanted[~self._decoded[wanted]]
+                if len(missing):
+                    starts, stops = self._offsets[missing], self._offsets[missing + 1]
+                    self._geometries[missing] = shapely.from_wkb(
+                        [bytes(self._wkb[start:stop]) if stop > start else None for start, stop in zip(starts, stops)])
+                    self._decoded[missing] = True
+                    if self._decoded.all():
+                        self._decoded = None
+        return self._geometries if positions is None else self._geometries[positions]
+
+    def query(self, geometries, predicate='intersects'):
+        """
+        Find the pairs of geometries and features of the layer that satisfy a predicate, as with sindex.query.
+
+        Args:
+            geometries (array-like): The query geometries, in the CRS of the layer.
+            predicate (str, optional): Shapely predicate tested as predicate(geometry, feature), or None to match
+                bounding boxes only. Default is 'intersects'.
+
+        Returns:
+            tuple: The positions of the query geometries and of the matching features, one pair for each match.
+        """
+        geometries = np.asarray(geometries, dtype=object)
+        if len(geometries) == 0 or len(self) == 0:
+            return np.array([], dtype='intp'), np.array([], dtype='intp')
+
+        # Query the whole layer once most of it is decoded or needed, otherwise only the features in the area
+        if self._decoded is not None:
+            area = shapely.total_bounds(geometries)
+            candidates = np.unique(self.tree.query(area)[1]) if not np.isnan(area).any() else np.array([], 'int64')
+            if len(candidates) < len(self) // 2:
+                if len(candidates) == 0:
+                    return np.array([], dtype='intp'), np.array([], dtype='intp')
+                inputs, features = shapely.STRtree(self.geometries(candidates)).query(geometries, predicate=predicate)
+                return inputs, candidates[features]
+        inputs, features = self.sindex.query(geometries, predicate=predicate)
+        return inputs, features
+
+    def to_geodataframe(self, positions=None):
+        """
+        Return geometries of the layer as a GeoDataFrame indexed by their positions.
+
+        Args:
+            positions (array-like, optional): Positions of the features. Defaults to every feature.
+
+        Returns:
+            GeoDataFrame: The features.
+        """
+        index = np.arange(len(self)) if positions is None else np.asarray(positions)
+        return gpd.GeoDataFrame(geometry=self.geometries(index), index=index, crs=self.crs)
+
+    def save(self, folder):
+        """
+        Write the layer to a folder as a WKB store and a packed tree, moving it into place in one step so other
+        processes never see a partial copy.
+
+        Args:
+            folder (str): The folder, which must not exist.
+        """
+        if self._wkb is not None:
+            wkb, offsets = self._wkb, self._offsets
+        else:
+            records = shapely.to_wkb(self._geometries)
+            lengths = np.array([len(record) if record is not None else 0 for record in records], dtype='int64')
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            wkb = np.frombuffer(b''.join(record for record in records if record is not None), dtype='uint8')
+
+        partial = f"{folder}.{os.getpid()}.{threading.get_ident()}"
+        os.makedirs(partial, exist_ok=True)
+        np.save(os.path.join(partial, 'wkb.npy'), wkb)
+        np.save(os.path.join(partial, 'offsets.npy'), offsets)
+        self.tree.save(partial)
+        with open(os.path.join(partial, 'layer.json'), 'w') as file:
+            json.dump({'features': len(self), 'crs': self.crs.to_wkt() if self.crs else None,
+                       'node_capacity': self.tree.node_capacity, 'key': repr(self.key)}, file)
+        try:
+            os.replace(partial, folder)
+        except OSError:
+            # Another process saved the same layer first
+            shutil.rmtree(partial, ignore_errors=True)
+
+    @classmethod
+    def load(cls, folder, key=None):
+        """
+        Open a layer written by save, memory-mapping its WKB store and tree without decoding any geometry.
+
+        Args:
+            folder (str): The folder.
+            key (optional): Key of the layer in the cache.
+
+        Returns:
+            IndexedLayer: The layer.
+        """
+        with open(os.path.join(folder, 'layer.json')) as file:
+            meta = json.load(file)
+        offsets = np.load(os.path.join(folder, 'offsets.npy'))
+        wkb = np.load(os.path.join(folder, 'wkb.npy'), mmap_mode='r') if offsets[-1] else np.empty(0, 'uint8')
+        tree = PackedRTree.load(folder, meta['node_capacity'])
+        return cls(crs=meta['crs'], key=key, wkb=wkb, offsets=offsets, tree=tree)
+
+
+class SpatialIndexCache:
+    """
+    Least recently used cache of indexed reference layers, bounded by the number of layers held.
+
+    Layers are keyed by:
+        - path and file version for layers read from a file;
+        - key and version for GeoDataFrames given a key, such as cached_index(woodland, 'ancient_woodland', '2024'),
+          with their number of features and total bounds, so a changed layer is indexed again even when its version
+          was not changed.
+
+    Other GeoDataFrames are indexed afresh on every call and not cached, since an edit in place cannot be detected
+    without reading every geometry, which costs about as much as building the index.
+
+    Layers read from a file or given a key are also saved in directory, and loaded from there by later runs. The
+    cache is safe to use from several threads.
+
+    Args:
+        max_layers (int): Maximum number of layers held in memory. Default is 16.
+        directory (str, optional): Folder of the saved layers. Defaults to a 'sindex_cache' folder in the system
+            temporary folder.
+    """
+
+    def __init__(self, max_layers=16, directory=None):
+        self.max_layers = max_layers
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'sindex_cache')
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self._layers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"SpatialIndexCache(max_layers={self.max_layers}, layers={len(self._layers)}, hits={self.hits}, "
+                f"misses={self.misses}, loads={self.loads})")
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._layers.get(key)
+            if entry is not None:
+                self._layers.move_to_end(key)
+            return entry
+
+    def _put(self, key, indexed):
+        with self._lock:
+            self._layers[key] = indexed
+            self._layers.move_to_end(key)
+            while len(self._layers) > self.max_layers:
+                self._layers.popitem(last=False)
+
+    def _folder(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def get(self, layer, key=None, version=None, persist=True):
+        """
+        Return the indexed version of a layer, indexing it the first time.
+
+        Args:
+            layer (str, GeoDataFrame, GeoSeries or IndexedLayer): Path to a vector file, or the layer.
+            key (str, optional): Name of the layer, such as 'ancient_woodland'. Layers with the same key and version
+                share their index, across runs when persist is True.
+            version (optional): Version of the layer, such as its release date. Change it when the layer changes,
+                since edits that keep the number of features and the total bounds are not detected otherwise.
+            persist (bool): Save layers read from a file or given a key to the directory, and load them from there.
+                Default is True.
+
+        Returns:
+            IndexedLayer: The indexed layer.
+        """
+        if isinstance(layer, IndexedLayer):
+            return layer
+
+        if isinstance(layer, str):
+            path = os.path.abspath(layer)
+            try:
+                stat = os.stat(path)
+                file_version = (stat.st_mtime, stat.st_size)
+            except OSError:
+                file_version = None
+            cache_key = ('path', path, file_version, key, version)
+        elif key is not None:
+            # A cheap digest of the content, so a layer edited under the same key and version is not matched to the
+            # index of the old one
+            cache_key = ('key', key, version, len(layer), layer.total_bounds.tobytes())
+        else:
+            # Unnamed layers may be edited in place between calls, so they are indexed afresh
+            self.misses += 1
+            return IndexedLayer(np.asarray(layer.geometry.values), crs=layer.crs)
+
+        entry = self._get(cache_key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        folder = self._folder(cache_key)
+        indexed = None
+        if persist and os.path.exists(os.path.join(folder, 'layer.json')):
+            indexed = IndexedLayer.load(folder, key=cache_key)
+            if not isinstance(layer, str) and len(indexed) != len(layer):
+                # Saved from a different layer, so it is replaced
+                shutil.rmtree(folder, ignore_errors=True)
+                indexed = None
+            else:
+                self.loads += 1
+        if indexed is None:
+            self.misses += 1
+            if isinstance(layer, str):
+                layer = read_data(layer)
+            indexed = IndexedLayer(np.asarray(layer.geometry.values), crs=layer.crs, key=cache_key)
+            if persist:
+                os.makedirs(self.directory, exist_ok=True)
+                indexed.save(folder)
+        self._put(cache_key, indexed)
+        return indexed
+
+    def clear(self, disk=False):
+        """
+        Drop every layer held in memory, and the saved layers too when disk is True.
+        """
+        with self._lock:
+            self._layers.clear()
+        if disk:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Cache shared by the overlay and join functions
+_DEFAULT_CACHE = SpatialIndexCache()
+
+
+def get_sindex_cache():
+    """
+    Return the spatial index cache shared by the package.
+
+    Returns:
+        SpatialIndexCache: The shared cache.
+    """
+    return _DEFAULT_CACHE
+
+
+def clear_sindex_cache(disk=False):
+    """
+    Drop the layers held by the shared spatial index cache.
+
+    Args:
+        disk (bool): Also delete the layers saved to disk. Default is False.
+
+    Returns:
+        None
+    """
+    _DEFAULT_CACHE.clear(disk=disk)
+
+
+def cached_index(layer, key=None, version=None, persist=True, cache=None):
+    """
+    Return the indexed version of a reference layer, indexing it only the first time, see SpatialIndexCache.get.
+
+        woodland = cached_index('ancient_woodland.gpkg')
+        for parcels in parcel_batches:
+            extract_overlapping_polygons(parcels, woodland)
+
+    Args:
+        layer (str, GeoDataFrame, GeoSeries or IndexedLayer): Path to a vector file, or the layer.
+        key (str, optional): Name of the layer, shared by every copy of it.
+        version (optional): Version of the layer.
+        persist (bool): Save layers read from a file or given a key to disk. Default is True.
+        cache (SpatialIndexCache, optional): Cache to use. Defaults to the shared cache.
+
+    Returns:
+        IndexedLayer: The indexed layer.
+    """
+    return (cache or _DEFAULT_CACHE).get(layer, key=key, version=version, persist=persist)
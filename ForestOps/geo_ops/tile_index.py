@@ -0,0 +1,297 @@
+import os
+import glob
+import sqlite3
+import numpy as np
+import shapely
+import rasterio
+from shapely.geometry import box
+from ForestOps.geo_ops.progress import report
+
+
+'''
+This module keeps a persistent index of GeoTIFF tile footprints, so merges can select the tiles they need
+without opening every file in a folder
+'''
+
+
+def find_geotiffs(in_folder, recursive=False):
+    """
+    List the GeoTIFF files in a folder.
+
+    Args:
+        in_folder (str): Path to the folder containing the GeoTIFF files.
+        recursive (bool): Option to search for GeoTIFF files recursively in subdirectories. Default is False.
+
+    Returns:
+        list: Sorted list of GeoTIFF file paths.
+    """
+    geotiff_files = []
+    if recursive:
+        for dirpath, dirnames, filenames in os.walk(in_folder):
+            for filename in filenames:
+                if filename.endswith('.tif'):
+                    geotiff_files.append(os.path.join(dirpath, filename))
+    else:
+        geotiff_files = glob.glob(os.path.join(in_folder, '*.tif'))
+
+    return sorted(geotiff_files)
+
+
+def read_tile_header(file):
+    """
+    Read the georeferencing of a GeoTIFF without reading any of its pixel data.
+
+    Args:
+        file (str): Path to the GeoTIFF file.
+
+    Returns:
+        dict: The bounds, resolution, size, block size, band count, data type, nodata value and CRS of the file.
+    """
+    with rasterio.open(file) as src:
+        block_height, block_width = src.block_shapes[0]
+        return {
+            'path': os.path.abspath(file),
+            'bounds': tuple(src.bounds),
+            'res': src.res,
+            'width': src.width,
+            'height': src.height,
+            'block_width': block_width,
+            'block_height': block_height,
+            'count': src.count,
+            'dtype': src.dtypes[0],
+            'nodata': src.nodata,
+            'crs': src.crs,
+        }
+
+
+# Columns stored for every tile, in the order they appear in the tiles table
+_TILE_COLUMNS = ['path', 'mtime', 'size', 'min_x', 'min_y', 'max_x', 'max_y', 'res_x', 'res_y', 'width', 'height',
+                 'block_width', 'block_height', 'count', 'dtype', 'nodata', 'crs']
+
+
+def _connect_tile_index(index_file):
+    """
+    Open a tile index, creating its table if it does not exist yet.
+
+    Args:
+        index_file (str): Path to the SQLite tile index.
+
+    Returns:
+        sqlite3.Connection: Connection to the tile index.
+    """
+    connection = sqlite3.connect(index_file)
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS tiles (
+            path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+            min_x REAL, min_y REAL, max_x REAL, max_y REAL, res_x REAL, res_y REAL,
+            width INTEGER, height INTEGER, block_width INTEGER, block_height INTEGER,
+            count INTEGER, dtype TEXT, nodata REAL, crs TEXT
+        )"""
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS tiles_bounds ON tiles (min_x, max_x, min_y, max_y)")
+    return connection
+
+
+def _header_from_row(row):
+    """
+    Convert a row of the tiles table into a tile header as returned by read_tile_header.
+
+    Args:
+        row (tuple): Row of the tiles table, with the columns in _TILE_COLUMNS order.
+
+    Returns:
+        dict: The tile header.
+    """
+    record = dict(zip(_TILE_COLUMNS, row))
+    return {
+        'path': record['path'],
+        'bounds': (record['min_x'], record['min_y'], record['max_x'], record['max_y']),
+        'res': (record['res_x'], record['res_y']),
+        'width': record['width'],
+        'height': record['height'],
+        'block_width': record['block_width'],
+        'block_height': record['block_height'],
+        'count': record['count'],
+        'dtype': record['dtype'],
+        'nodata': record['nodata'],
+        'crs': record['crs'],
+    }
+
+
+def _in_folder(path, folder, recursive):
+    """
+    Check whether an indexed tile belongs to a folder.
+
+    Args:
+        path (str): Absolute path of the tile.
+        folder (str): Absolute path of the folder.
+        recursive (bool): Also accept tiles in subdirectories of the folder.
+
+    Returns:
+        bool: True when the tile is in the folder.
+    """
+    return path.startswith(folder + os.sep) and (recursive or os.path.dirname(path) == folder)
+
+
+def default_tile_index_path(in_folder):
+    """
+    Return the default location of the tile index for a folder.
+
+    Args:
+        in_folder (str): Path to the folder containing the GeoTIFF files.
+
+    Returns:
+        str: Path to the SQLite tile index inside the folder.
+    """
+    return os.path.join(in_folder, 'tile_index.sqlite')
+
+
+def update_tile_index(in_folder, index_file=None, recursive=False):
+    """
+    Create or refresh the tile index of a folder of GeoTIFF files.
+
+    Only tiles that are new or whose modification time or size has changed are opened, and tiles that have been
+    removed from the folder are dropped from the index.
+
+    Args:
+        in_folder (str): Path to the folder containing the GeoTIFF files.
+        index_file (str, optional): Path to the SQLite tile index. Defaults to 'tile_index.sqlite' in in_folder.
+        recursive (bool): Option to search for GeoTIFF files recursively in subdirectories. Default is False.
+
+    Returns:
+        str: Path to the tile index.
+    """
+    if index_file is None:
+        index_file = default_tile_index_path(in_folder)
+
+    folder = os.path.abspath(in_folder)
+    connection = _connect_tile_index(index_file)
+    try:
+        # Compare what is on disk with what was indexed last time
+        indexed = {
+            path: (mtime, size)
+            for path, mtime, size in connection.execute("SELECT path, mtime, size FROM tiles")
+            if _in_folder(path, folder, recursive)
+        }
+
+        rows = []
+        on_disk = set()
+        for file in find_geotiffs(in_folder, recursive=recursive):
+            path = os.path.abspath(file)
+            on_disk.add(path)
+            stat = os.stat(path)
+            if indexed.get(path) == (stat.st_mtime, stat.st_size):
+                continue
+
+            # Only new or modified tiles have their header read
+            header = read_tile_header(path)
+            crs = header['crs'].to_wkt() if header['crs'] is not None else None
+            rows.append((path, stat.st_mtime, stat.st_size, *header['bounds'], *header['res'], header['width'],
+                         header['height'], header['block_width'], header['block_height'], header['count'],
+                         header['dtype'], header['nodata'], crs))
+
+        removed = [(path,) for path in indexed if path not in on_disk]
+
+        with connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO tiles ({', '.join(_TILE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(_TILE_COLUMNS))})",
+                rows
+            )
+            connection.executemany("DELETE FROM tiles WHERE path = ?", removed)
+    finally:
+        connection.close()
+
+    report(f"Tile index {index_file}: {len(rows)} tiles added or updated, {len(removed)} removed")
+
+    return index_file
+
+
+def area_of_interest(bounds=None, geometry=None, crs=None):
+    """
+    Combine a bounding box and a geometry of interest into a single shapely geometry.
+
+    Args:
+        bounds (tuple, optional): Bounding box as (min_x, min_y, max_x, max_y).
+        geometry (optional): Shapely geometry, GeoSeries or GeoDataFrame of the area of interest.
+        crs (optional): CRS of the tiles. GeoSeries and GeoDataFrames with a different CRS are reprojected to it.
+
+    Returns:
+        shapely.geometry.base.BaseGeometry or None: The area of interest, or None if neither argument is given.
+    """
+    area = None
+    if geometry is not None:
+        if hasattr(geometry, 'geometry'):
+            geometry = geometry.geometry
+        if hasattr(geometry, 'to_crs'):
+            if crs is not None and geometry.crs is not None:
+                geometry = geometry.to_crs(crs)
+            geometry = geometry.union_all()
+        area = geometry
+    if bounds is not None:
+        area = box(*bounds) if area is None else area.intersection(box(*bounds))
+    return area
+
+
+def filter_tile_headers(headers, area):
+    """
+    Keep the tile headers whose footprint intersects an area of interest.
+
+    Args:
+        headers (list): Tile headers as returned by read_tile_header.
+        area (shapely.geometry.base.BaseGeometry): Area of interest.
+
+    Returns:
+        list: The tile headers that intersect the area.
+    """
+    if area is None or not headers:
+        return headers
+    footprints = shapely.box(*np.array([header['bounds'] for header in headers]).T)
+    keep = shapely.intersects(footprints, area)
+    return [header for header, selected in zip(headers, keep) if selected]
+
+
+def query_tile_index(index_file, bounds=None, geometry=None, in_folder=None, recursive=False):
+    """
+    Return the headers of the indexed tiles that intersect an area of interest.
+
+    The folder and the bounding box of the area are filtered in SQLite first, so only the candidate tiles are
+    compared with the geometry itself.
+
+    Args:
+        index_file (str): Path to the SQLite tile index.
+        bounds (tuple, optional): Bounding box as (min_x, min_y, max_x, max_y).
+        geometry (optional): Shapely geometry, GeoSeries or GeoDataFrame of the area of interest, in the CRS of the
+            tiles unless it carries its own CRS.
+        in_folder (str, optional): Only return the tiles in this folder. Defaults to every tile of the index.
+        recursive (bool): With in_folder, also return the tiles in its subdirectories. Default is False.
+
+    Returns:
+        list: Tile headers, in the same form as read_tile_header, sorted by path.
+    """
+    conditions, parameters = [], []
+    if in_folder is not None:
+        # Tiles under the folder, their depth is checked once the rows are read
+        folder = os.path.abspath(in_folder)
+        prefix = folder + os.sep
+        conditions.append("substr(path, 1, ?) = ?")
+        parameters += [len(prefix), prefix]
+
+    connection = _connect_tile_index(index_file)
+    try:
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        crs = connection.execute(f"SELECT crs FROM tiles{where} LIMIT 1", parameters).fetchone()
+        area = area_of_interest(bounds, geometry, crs[0] if crs else None)
+        if area is not None:
+            min_x, min_y, max_x, max_y = area.bounds
+            conditions.append("min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?")
+            parameters += [max_x, min_x, max_y, min_y]
+            where = f" WHERE {' AND '.join(conditions)}"
+        rows = connection.execute(f"SELECT {', '.join(_TILE_COLUMNS)} FROM tiles{where} ORDER BY path",
+                                  parameters).fetchall()
+    finally:
+        connection.close()
+
+    if in_folder is not None:
+        rows = [row for row in rows if _in_folder(row[0], folder, recursive)]
+    return filter_tile_headers([_header_from_row(row) for row in rows], area)
@@ -0,0 +1,10 @@
+'''
+Benchmarks of ForestOps and geoops, laid out like an airspeed velocity (asv) suite.
+
+Each bench_*.py module holds classes with optional params, param_names and setup, and methods whose prefix sets what
+is measured: time_* (wall time), peakmem_* (peak resident memory of a fresh process) and timeraw_* (wall time of the
+Python code returned by the method, run in a fresh interpreter). Run them with
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run compare base.json results.json
+'''
@@ -0,0 +1,31 @@
+import importlib
+
+
+'''
+Import time and memory of the packages, which every script and notebook pays before doing any work
+'''
+
+
+IMPORTS = [
+    'import ForestOps',
+    'import ForestOps.geo_ops',
+    'from ForestOps import merge_geotiffs',
+    'from ForestOps import GeospatialStatistics',
+    'import geoops',
+]
+
+
+class ImportTime:
+    params = IMPORTS
+    param_names = ['statement']
+
+    def timeraw_import(self, statement):
+        return statement
+
+
+class ImportMemory:
+    params = ['ForestOps', 'ForestOps.geo_ops.geo_funcs', 'ForestOps.geo_ops.raster_ops', 'geoops']
+    param_names = ['module']
+
+    def peakmem_import(self, module):
+        importlib.import_module(module)
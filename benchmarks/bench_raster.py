@@ -0,0 +1,115 @@
+import os
+import shutil
+from ForestOps.geo_ops import raster_cache, raster_ops, geo_stats
+from benchmarks.data import DEM_SCALES, cached_dem, random_parcels, random_points, scratch_folder, split_dem
+
+
+'''
+Raster entry points on synthetic DEMs
+'''
+
+
+class RasterCalculator:
+    params = [DEM_SCALES, ['add', 'divide']]
+    param_names = ['size', 'operation']
+
+    def setup(self, size, operation):
+        self.folder = scratch_folder()
+        self.dem1 = cached_dem(size, seed=0)
+        self.dem2 = cached_dem(size, seed=1)
+        self.output_file = os.path.join(self.folder, 'result.tif')
+
+    def teardown(self, size, operation):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_raster_calculator(self, size, operation):
+        raster_ops.raster_calculator(self.dem1, self.dem2, self.output_file, operation)
+
+    def peakmem_raster_calculator(self, size, operation):
+        raster_ops.raster_calculator(self.dem1, self.dem2, self.output_file, operation)
+
+
+class RasterSummary:
+    params = DEM_SCALES
+    param_names = ['size']
+
+    def setup(self, size):
+        self.dem = cached_dem(size)
+
+    def time_raster_summary_cold(self, size):
+        raster_cache.clear_raster_cache()
+        raster_ops.raster_summary(self.dem)
+
+    def time_raster_summary_warm(self, size):
+        # The band stays in the raster cache between repeats
+        raster_ops.raster_summary(self.dem)
+
+
+class SampleRaster:
+    params = [[10_000, 100_000], ['nearest', 'bilinear']]
+    param_names = ['points', 'method']
+
+    def setup(self, points, method):
+        size = DEM_SCALES[1]
+        self.dem = cached_dem(size)
+        # Points over the whole 5 m DEM
+        self.points = random_points(points, extent=size * 5.0)
+
+    def time_sample_raster(self, points, method):
+        raster_ops.sample_raster(self.points, self.dem, method=method)
+
+
+class PointsToRaster:
+    params = [[10_000, 100_000, 1_000_000], ['count', 'mean']]
+    param_names = ['points', 'aggregation']
+
+    def setup(self, points, aggregation):
+        self.folder = scratch_folder()
+        self.points = random_points(points)
+        self.output_file = os.path.join(self.folder, 'points.tif')
+
+    def teardown(self, points, aggregation):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_points_to_raster(self, points, aggregation):
+        value_column = None if aggregation == 'count' else 'height'
+        raster_ops.points_to_raster(self.points, 10, self.output_file, value_column=value_column,
+                                    aggregation=aggregation)
+
+
+class ZonalStatistics:
+    params = [[1_000, 10_000], [False, True]]
+    param_names = ['parcels', 'coverage']
+
+    def setup(self, parcels, coverage):
+        size = DEM_SCALES[1]
+        self.dem = cached_dem(size)
+        # Parcels spread over the whole 5 m DEM, so more parcels are smaller parcels
+        self.zones = random_parcels(parcels, parcel_size=size * 5.0 / parcels ** 0.5)
+
+    def time_zonal_statistics(self, parcels, coverage):
+        if coverage:
+            geo_stats.coverage_zonal_statistics(self.dem, self.zones, ['mean', 'max'])
+        else:
+            geo_stats.native_zonal_statistics(self.dem, self.zones, ['mean', 'max'])
+
+
+class MergeGeotiffs:
+    params = [DEM_SCALES[:2], ['merge', 'vrt']]
+    param_names = ['size', 'method']
+
+    def setup(self, size, method):
+        self.folder = scratch_folder()
+        self.tile_folder = os.path.join(self.folder, 'tiles')
+        self.out_folder = os.path.join(self.folder, 'out')
+        os.makedirs(self.out_folder)
+        split_dem(cached_dem(size), self.tile_folder)
+
+    def teardown(self, size, method):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_merge_geotiffs(self, size, method):
+        raster_ops.merge_geotiffs(self.tile_folder, self.out_folder, 'merged.tif', method=method)
+
+    def peakmem_merge_geotiffs(self, size, method):
+        raster_ops.merge_geotiffs(self.tile_folder, self.out_folder, 'merged.tif', method=method)
@@ -0,0 +1,159 @@
+import os
+import shutil
+from ForestOps.geo_ops import geo_funcs, geo_io
+from ForestOps.geo_ops.pipeline import Pipeline
+from ForestOps.geo_ops.sindex_cache import SpatialIndexCache, cached_index
+from geoops import ops, vector
+from benchmarks.data import VECTOR_SCALES, random_parcels, random_points, scratch_folder
+
+
+'''
+Vector entry points on random field parcels
+'''
+
+
+class FixInvalidGeometries:
+    params = VECTOR_SCALES
+    param_names = ['parcels']
+
+    def setup(self, parcels):
+        # One parcel in ten is a self-intersecting bow tie
+        self.gdf = random_parcels(parcels, invalid_fraction=0.1)
+
+    def time_fix_invalid_geometries(self, parcels):
+        geo_funcs.fix_invalid_geometries(self.gdf)
+
+    def peakmem_fix_invalid_geometries(self, parcels):
+        geo_funcs.fix_invalid_geometries(self.gdf)
+
+
+class ClipAndCombine:
+    params = VECTOR_SCALES
+    param_names = ['parcels']
+
+    def setup(self, parcels):
+        self.parcels = random_parcels(parcels)
+        # Fewer, larger woodland polygons over the same extent, like a woodland inventory against field parcels
+        self.woodland = random_parcels(max(parcels // 10, 1), seed=1, parcel_size=316.0)[['geometry']]
+
+    def time_clip_and_combine(self, parcels):
+        geo_funcs.clip_and_combine(self.parcels, self.woodland, 'woodland')
+
+    def peakmem_clip_and_combine(self, parcels):
+        geo_funcs.clip_and_combine(self.parcels, self.woodland, 'woodland')
+
+
+class ExplodeGeoDataFrame:
+    params = VECTOR_SCALES
+    param_names = ['parcels']
+
+    def setup(self, parcels):
+        self.gdf = random_parcels(parcels, multipart_fraction=0.3)
+
+    def time_explode_geodataframe(self, parcels):
+        geo_funcs.explode_geodataframe(self.gdf)
+
+    def time_explode_counts(self, parcels):
+        geo_funcs.explode_geodataframe(self.gdf, counts_only=True)
+
+
+class ReadData:
+    params = [VECTOR_SCALES, ['gpkg', 'geojson']]
+    param_names = ['parcels', 'format']
+
+    def setup(self, parcels, format):
+        self.folder = scratch_folder()
+        self.path = os.path.join(self.folder, f"parcels.{format}")
+        random_parcels(parcels).to_file(self.path)
+
+    def teardown(self, parcels, format):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_read_data(self, parcels, format):
+        geo_io.read_data(self.path)
+
+    def peakmem_read_data(self, parcels, format):
+        geo_io.read_data(self.path)
+
+
+class PipelineOverlay:
+    params = [VECTOR_SCALES, [1, 4]]
+    param_names = ['parcels', 'workers']
+
+    def setup(self, parcels, workers):
+        self.folder = scratch_folder()
+        self.path = os.path.join(self.folder, 'parcels.gpkg')
+        random_parcels(parcels, invalid_fraction=0.05).to_file(self.path)
+        self.woodland = random_parcels(max(parcels // 10, 1), seed=1, parcel_size=316.0)[['geometry']]
+
+    def teardown(self, parcels, workers):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _pipeline(self):
+        return Pipeline(self.path, chunk_size=10_000).fix_invalid().to_crs(27700).overlay(self.woodland)
+
+    def time_pipeline_overlay(self, parcels, workers):
+        self._pipeline().write(os.path.join(self.folder, 'out.gpkg'), workers=workers)
+
+    def peakmem_pipeline_overlay(self, parcels, workers):
+        self._pipeline().write(os.path.join(self.folder, 'out.gpkg'), workers=workers)
+
+
+class VectorisedPredicates:
+    params = [VECTOR_SCALES, [1, 4]]
+    param_names = ['parcels', 'workers']
+
+    def setup(self, parcels, workers):
+        self.parcels = random_parcels(parcels).geometry.values
+        self.points = random_points(parcels, seed=1).geometry.values
+
+    def time_intersects(self, parcels, workers):
+        vector.intersects(self.parcels, self.points, workers=workers)
+
+    def time_buffer(self, parcels, workers):
+        vector.buffer(self.parcels, 5.0, workers=workers)
+
+
+class SpatialJoin:
+    params = [VECTOR_SCALES, [1, 4]]
+    param_names = ['parcels', 'workers']
+
+    def setup(self, parcels, workers):
+        self.parcels = random_parcels(parcels)
+        self.woodland = random_parcels(max(parcels // 10, 1), seed=1, parcel_size=316.0)
+        self.points = random_points(parcels, seed=2)
+        # Joins reuse the index of the right layer, built here as a long-lived woodland layer would be
+        self.woodland.sindex
+
+    def time_spatial_join(self, parcels, workers):
+        ops.spatial_join(self.parcels, self.woodland, workers=workers)
+
+    def time_nearest_join(self, parcels, workers):
+        ops.nearest_join(self.points, self.woodland, max_distance=500.0, workers=workers)
+
+
+class CachedReferenceLayer:
+    params = VECTOR_SCALES
+    param_names = ['parcels']
+
+    def setup(self, parcels):
+        self.folder = scratch_folder()
+        # The parcels of one corner of the woodland layer, like a holding checked against a national layer
+        woodland = random_parcels(parcels, seed=1, parcel_size=316.0)[['geometry']]
+        minx, miny, maxx, maxy = woodland.total_bounds
+        self.parcels = random_parcels(parcels).cx[:minx + (maxx - minx) / 10, :miny + (maxy - miny) / 10]
+        self.woodland_file = os.path.join(self.folder, 'woodland.gpkg')
+        woodland.to_file(self.woodland_file)
+        # Save the indexed woodland layer once, as an earlier run would have
+        cached_index(self.woodland_file, cache=SpatialIndexCache(directory=self.folder))
+
+    def teardown(self, parcels):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def time_extract_overlapping_read(self, parcels):
+        geo_funcs.extract_overlapping_polygons(self.parcels, geo_io.read_data(self.woodland_file))
+
+    def time_extract_overlapping_saved(self, parcels):
+        # A new cache, so the layer is loaded from disk rather than found in memory
+        woodland = cached_index(self.woodland_file, cache=SpatialIndexCache(directory=self.folder))
+        geo_funcs.extract_overlapping_polygons(self.parcels, woodland)
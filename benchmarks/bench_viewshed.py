@@ -0,0 +1,45 @@
+import geopandas as gpd
+from shapely.geometry import Point
+import geoops
+from benchmarks.data import CRS, DEM_SCALES, ORIGIN, cached_dem, random_points
+
+
+'''
+Visibility entry points of geoops on synthetic DEMs
+'''
+
+
+def _observer(size, cell_size=5.0):
+    # An observer in the middle of the DEM
+    centre = (ORIGIN[0] + size * cell_size / 2, ORIGIN[1] + size * cell_size / 2)
+    return gpd.GeoDataFrame(geometry=[Point(centre)], crs=CRS)
+
+
+class LineOfSight:
+    params = [100, 1_000, 10_000]
+    param_names = ['targets']
+
+    def setup(self, targets):
+        size = DEM_SCALES[1]
+        self.dem = cached_dem(size)
+        self.observer = _observer(size)
+        self.targets = random_points(targets, seed=1, extent=size * 5.0)
+
+    def time_calculate_line_of_sight(self, targets):
+        geoops.calculate_line_of_sight(self.observer, self.targets, self.dem, observer_height=1.7, target_height=1.0)
+
+    def peakmem_calculate_line_of_sight(self, targets):
+        geoops.calculate_line_of_sight(self.observer, self.targets, self.dem, observer_height=1.7, target_height=1.0)
+
+
+class Viewshed:
+    params = [500.0, 2_000.0, 5_000.0]
+    param_names = ['max_distance']
+
+    def setup(self, max_distance):
+        size = DEM_SCALES[1]
+        self.dem = cached_dem(size)
+        self.observer = _observer(size)
+
+    def time_viewshed(self, max_distance):
+        geoops.viewshed(self.dem, self.observer, observer_height=1.7, max_distance=max_distance)
@@ -0,0 +1,199 @@
+import os
+import tempfile
+import numpy as np
+import geopandas as gpd
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+
+
+'''
+Synthetic data for the benchmarks: random parcels, point clouds and DEMs at several scales
+'''
+
+
+# Number of features of the vector benchmarks, and width in cells of the square DEMs, at each scale
+VECTOR_SCALES = [1_000, 10_000, 100_000]
+DEM_SCALES = [512, 2048, 8192]
+
+CRS = 27700
+# Bottom left corner of the synthetic data, in British National Grid
+ORIGIN = (400000.0, 300000.0)
+HABITATS = ['woodland', 'grassland', 'heath', 'bog', 'arable']
+
+
+def scratch_folder():
+    """
+    Create a temporary folder for benchmark files.
+
+    Returns:
+        str: Path to the folder.
+    """
+    return tempfile.mkdtemp(prefix='forestops_benchmark_')
+
+
+def random_parcels(n, seed=0, parcel_size=100.0, vertices=8, invalid_fraction=0.0, multipart_fraction=0.0,
+                   crs=CRS):
+    """
+    Generate random field parcels as irregular polygons scattered over a square extent.
+
+    Args:
+        n (int): Number of parcels.
+        seed (int): Seed of the random generator. Default is 0.
+        parcel_size (float): Typical width of a parcel in metres. Default is 100.
+        vertices (int): Number of vertices of each parcel. Default is 8.
+        invalid_fraction (float): Fraction of parcels turned into self-intersecting bow ties. Default is 0.
+        multipart_fraction (float): Fraction of parcels given a second, detached part. Default is 0.
+        crs: CRS of the parcels. Default is British National Grid.
+
+    Returns:
+        GeoDataFrame: The parcels, with parcel_id, habitat and height columns.
+    """
+    rng = np.random.default_rng(seed)
+    extent = np.sqrt(n) * parcel_size
+    centres = np.column_stack([rng.uniform(0, extent, n) + ORIGIN[0], rng.uniform(0, extent, n) + ORIGIN[1]])
+
+    # Irregular polygons from jittered radii around each centre
+    angles = np.sort(rng.uniform(0, 2 * np.pi, (n, vertices)), axis=1)
+    radii = parcel_size / 2 * rng.uniform(0.5, 1.0, (n, vertices))
+    coords = np.stack([centres[:, :1] + radii * np.cos(angles), centres[:, 1:] + radii * np.sin(angles)], axis=-1)
+
+    # Swapping two neighbouring vertices makes the ring cross itself
+    invalid = rng.random(n) < invalid_fraction
+    coords[invalid, 0], coords[invalid, 1] = coords[invalid, 1].copy(), coords[invalid, 0].copy()
+
+    geometries = shapely.polygons(coords)
+    multipart = np.flatnonzero(rng.random(n) < multipart_fraction)
+    if len(multipart):
+        offsets = shapely.transform(geometries[multipart], lambda xy: xy + parcel_size * 1.5)
+        geometries[multipart] = shapely.multipolygons(np.column_stack([geometries[multipart], offsets]))
+
+    return gpd.GeoDataFrame({
+        'parcel_id': np.arange(n),
+        'habitat': rng.choice(HABITATS, n),
+        'height': np.round(rng.lognormal(2.5, 0.5, n), 1),
+    }, geometry=geometries, crs=crs)
+
+
+def random_points(n, seed=0, extent=None, crs=CRS):
+    """
+    Generate a random point cloud, such as tree survey points.
+
+    Args:
+        n (int): Number of points.
+        seed (int): Seed of the random generator. Default is 0.
+        extent (float, optional): Width of the square extent in metres. Defaults to 10 m per point along each side
+            of a square holding n points.
+        crs: CRS of the points. Default is British National Grid.
+
+    Returns:
+        GeoDataFrame: The points, with a height column.
+    """
+    rng = np.random.default_rng(seed)
+    if extent is None:
+        extent = np.sqrt(n) * 10.0
+    x = rng.uniform(0, extent, n) + ORIGIN[0]
+    y = rng.uniform(0, extent, n) + ORIGIN[1]
+    return gpd.GeoDataFrame({'height': np.round(rng.lognormal(2.5, 0.5, n), 1)},
+                            geometry=gpd.points_from_xy(x, y), crs=crs)
+
+
+def synthetic_terrain(size, seed=0):
+    """
+    Generate a smooth, hilly elevation surface.
+
+    Args:
+        size (int): Width and height of the surface in cells.
+        seed (int): Seed of the random generator. Default is 0.
+
+    Returns:
+        numpy.ndarray: float32 elevations in metres.
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:size, 0:size] / size
+    terrain = np.zeros((size, size))
+    # Sum of randomly oriented waves, longer waves being taller
+    for wavelength in [1.0, 0.5, 0.25, 0.1, 0.05]:
+        angle = rng.uniform(0, np.pi)
+        phase = rng.uniform(0, 2 * np.pi)
+        terrain += 100 * wavelength * np.sin(2 * np.pi * (rows * np.sin(angle) + cols * np.cos(angle)) / wavelength
+                                             + phase)
+    terrain += rng.normal(0, 0.5, (size, size))
+    return (terrain - terrain.min() + 50).astype('float32')
+
+
+def synthetic_dem(size, path, seed=0, cell_size=5.0, nodata=-9999, tiled=True):
+    """
+    Write a synthetic DEM GeoTIFF.
+
+    Args:
+        size (int): Width and height of the DEM in cells.
+        path (str): Path of the GeoTIFF to write.
+        seed (int): Seed of the random generator. Default is 0.
+        cell_size (float): Cell size in metres. Default is 5.
+        nodata (float): Nodata value, also written to a small corner of the DEM. Default is -9999.
+        tiled (bool): Write 512 pixel deflate compressed tiles rather than strips. Default is True.
+
+    Returns:
+        str: The path of the DEM.
+    """
+    terrain = synthetic_terrain(size, seed)
+    terrain[:size // 50, :size // 50] = nodata
+    options = {'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate'} if tiled and size >= 512 \
+        else {}
+    transform = from_origin(ORIGIN[0], ORIGIN[1] + size * cell_size, cell_size, cell_size)
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=1, dtype='float32', crs=CRS,
+                       transform=transform, nodata=nodata, **options) as dst:
+        dst.write(terrain, 1)
+    return path
+
+
+def cached_dem(size, seed=0, cell_size=5.0):
+    """
+    Return a synthetic DEM, writing it on first use only, since the large DEMs take longer to build than to benchmark.
+
+    Args:
+        size (int): Width and height of the DEM in cells.
+        seed (int): Seed of the random generator. Default is 0.
+        cell_size (float): Cell size in metres. Default is 5.
+
+    Returns:
+        str: Path of the DEM.
+    """
+    folder = os.path.join(tempfile.gettempdir(), 'forestops_benchmark_data')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"dem_{size}_{seed}_{cell_size:g}.tif")
+    if not os.path.exists(path):
+        # Write under another name first, so a run that is interrupted never leaves a partial DEM behind
+        partial_path = f"{path}.{os.getpid()}.tif"
+        synthetic_dem(size, partial_path, seed=seed, cell_size=cell_size)
+        os.replace(partial_path, path)
+    return path
+
+
+def split_dem(path, folder, tiles=4):
+    """
+    Split a DEM into a grid of GeoTIFF tiles, like an Ordnance Survey or LiDAR tile delivery.
+
+    Args:
+        path (str): Path to the DEM.
+        folder (str): Folder to write the tiles to.
+        tiles (int): Number of tiles along each side. Default is 4.
+
+    Returns:
+        list: Paths of the tiles.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    with rasterio.open(path) as src:
+        tile_width, tile_height = src.width // tiles, src.height // tiles
+        for row in range(tiles):
+            for col in range(tiles):
+                window = rasterio.windows.Window(col * tile_width, row * tile_height, tile_width, tile_height)
+                profile = dict(src.profile, width=tile_width, height=tile_height,
+                               transform=src.window_transform(window))
+                tile_path = os.path.join(folder, f"tile_{row}_{col}.tif")
+                with rasterio.open(tile_path, 'w', **profile) as dst:
+                    dst.write(src.read(window=window))
+                paths.append(tile_path)
+    return paths
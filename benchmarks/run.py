@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import importlib
+import inspect
+import io
+import itertools
+import json
+import os
+import pkgutil
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+'''
+Runner of the benchmark suite, writing machine readable results and comparing the results of two versions
+'''
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREFIXES = {'time_': 'seconds', 'peakmem_': 'bytes', 'timeraw_': 'seconds'}
+# Packages whose versions are recorded with the results, since they change the timings as much as the code does
+DEPENDENCIES = ['numpy', 'pandas', 'shapely', 'geopandas', 'pyproj', 'pyogrio', 'rasterio']
+
+
+def _may_match(module_name, pattern):
+    # A pattern naming a module, such as 'bench_vector' or 'bench_vector.Explode', only matches that module's
+    # benchmarks, so the other modules need not be imported
+    if pattern is None or not pattern.startswith('bench_'):
+        return True
+    return f"{module_name}.".startswith(pattern) or pattern.startswith(f"{module_name}.")
+
+
+def benchmark_modules(names=None, pattern=None, errors=None):
+    """
+    Import the bench_*.py modules of the benchmarks package.
+
+    Args:
+        names (list, optional): Names of the modules to import. Defaults to every module.
+        pattern (str, optional): Skip the modules that cannot hold a benchmark whose name contains this text.
+        errors (dict, optional): Filled with the import error of each module that cannot be imported, such as one
+            needing an optional dependency. Defaults to None, which raises the error.
+
+    Returns:
+        list: The modules.
+    """
+    if names is None:
+        package = importlib.import_module('benchmarks')
+        names = [name for _, name, _ in pkgutil.iter_modules(package.__path__) if name.startswith('bench_')]
+    modules = []
+    for name in names:
+        if not _may_match(name, pattern):
+            continue
+        try:
+            modules.append(importlib.import_module(f"benchmarks.{name}"))
+        except ImportError as error:
+            if errors is None:
+                raise
+            errors[name] = error
+    return modules
+
+
+def parameter_sets(cls):
+    """
+    List the combinations of parameters of a benchmark class, as asv does.
+
+    Args:
+        cls (type): The benchmark class.
+
+    Returns:
+        list: One dict of parameter name to value per combination.
+    """
+    params = getattr(cls, 'params', [])
+    if not params:
+        return [{}]
+    # A list of lists holds one list of values per parameter, any other list the values of a single parameter
+    if not all(isinstance(values, list) for values in params):
+        params = [params]
+    names = list(getattr(cls, 'param_names', [])) or [f"param{i + 1}" for i in range(len(params))]
+    return [dict(zip(names, values)) for values in itertools.product(*params)]
+
+
+def benchmark_name(module, cls, method, params):
+    arguments = ', '.join(f"{name}={value!r}" for name, value in params.items())
+    return f"{module.__name__.split('.')[-1]}.{cls.__name__}.{method}({arguments})"
+
+
+def discover(pattern=None, quick=False, modules=None, errors=None):
+    """
+    Find the benchmarks, one per method and combination of parameters.
+
+    Args:
+        pattern (str, optional): Only keep the benchmarks whose name contains this text.
+        quick (bool): Only keep the first combination of parameters of each method. Default is False.
+        modules (list, optional): Names of the modules to search. Defaults to every module.
+        errors (dict, optional): Filled with the import errors of the modules that cannot be imported, see
+            benchmark_modules. Defaults to None, which raises them.
+
+    Returns:
+        list: (name, module, class, method, parameters) tuples.
+    """
+    benchmarks = []
+    for module in benchmark_modules(modules, pattern, errors):
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            methods = [name for name in dir(cls) if name.startswith(tuple(PREFIXES))]
+            combinations = parameter_sets(cls)
+            if quick:
+                combinations = combinations[:1]
+            for method in methods:
+                for params in combinations:
+                    name = benchmark_name(module, cls, method, params)
+                    if pattern is None or pattern in name:
+                        benchmarks.append((name, module, cls, method, params))
+    return benchmarks
+
+
+def _call(instance, method, params):
+    # The entry points print progress, which would drown the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        return getattr(instance, method)(**params)
+
+
+def _set_up(cls, params):
+    instance = cls()
+    if hasattr(instance, 'setup'):
+        _call(instance, 'setup', params)
+    return instance
+
+
+def _tear_down(instance, params):
+    if hasattr(instance, 'teardown'):
+        _call(instance, 'teardown', params)
+
+
+def peak_memory():
+    """
+    Return the peak resident memory of this process in bytes.
+    """
+    # On Linux ru_maxrss carries over the peak of the parent process across fork and exec, VmHWM does not
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes, other systems kilobytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+
+
+def _run_child(arguments):
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.run', *arguments], cwd=ROOT, capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else
+                           f"exit code {result.returncode}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def time_benchmark(cls, method, params, repeat, max_time):
+    """
+    Time a benchmark in this process, after one untimed call to warm up imports and caches.
+
+    Returns:
+        list: The wall times of each call in seconds.
+    """
+    instance = _set_up(cls, params)
+    try:
+        _call(instance, method, params)
+        samples = []
+        started = time.perf_counter()
+        while len(samples) < repeat and (not samples or time.perf_counter() - started < max_time):
+            start = time.perf_counter()
+            _call(instance, method, params)
+            samples.append(time.perf_counter() - start)
+        return samples
+    finally:
+        _tear_down(instance, params)
+
+
+def peakmem_benchmark(name, repeat):
+    """
+    Measure the peak memory of a benchmark, including its setup, in a fresh process for each sample.
+
+    Returns:
+        list: The peak resident memory of each process in bytes.
+    """
+    return [_run_child(['_peakmem', name])['peakmem'] for _ in range(repeat)]
+
+
+def timeraw_benchmark(cls, method, params, repeat):
+    """
+    Time the code returned by a benchmark in a fresh interpreter for each sample, so nothing is imported yet.
+
+    Returns:
+        list: The wall times of each run of the code in seconds.
+    """
+    code = _call(cls(), method, params)
+    return [_run_child(['_timeraw', code])['seconds'] for _ in range(repeat)]
+
+
+def machine_info():
+    """
+    Describe the machine, Python and dependency versions the results were measured with.
+    """
+    versions = {}
+    for package in DEPENDENCIES:
+        try:
+            versions[package] = importlib.import_module(package).__version__
+        except (ImportError, AttributeError):
+            versions[package] = None
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+                                         text=True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {'machine': platform.node(), 'platform': platform.platform(), 'processor': platform.machine(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'dependencies': versions,
+            'commit': commit}
+
+
+def run(pattern=None, quick=False, repeat=5, max_time=60.0, output=None):
+    """
+    Run the benchmarks and write their results as JSON.
+
+    Args:
+        pattern (str, optional): Only run the benchmarks whose name contains this text.
+        quick (bool): Run only the first combination of parameters of each benchmark, once. Default is False.
+        repeat (int): Number of samples of each benchmark. Default is 5.
+        max_time (float): Stop taking time samples of a benchmark after this many seconds. Default is 60.
+        output (str, optional): Path of the JSON results file.
+
+    Returns:
+        dict: The results, with the machine information.
+    """
+    if quick:
+        repeat = 1
+    results = {}
+    import_errors = {}
+    benchmarks = discover(pattern, quick, errors=import_errors)
+
+    # The benchmarks of a module that cannot be imported all fail, without stopping the others
+    for module_name, error in import_errors.items():
+        name = f"{module_name}.*"
+        results[name] = {'unit': None, 'error': f"{type(error).__name__}: {error}", 'params': {}}
+        print(f"{name:<100} {'failed':>12}  {results[name]['error']}")
+
+    for name, module, cls, method, params in benchmarks:
+        prefix = next(prefix for prefix in PREFIXES if method.startswith(prefix))
+        started = time.perf_counter()
+        try:
+            if prefix == 'time_':
+                samples = time_benchmark(cls, method, params, repeat, max_time)
+            elif prefix == 'peakmem_':
+                samples = peakmem_benchmark(name, repeat)
+            else:
+                samples = timeraw_benchmark(cls, method, params, repeat)
+            result = {'unit': PREFIXES[prefix], 'samples': samples, 'min': min(samples),
+                      'median': statistics.median(samples)}
+            print(f"{name:<100} {format_value(result['median'], result['unit']):>12}"
+                  f"  ({time.perf_counter() - started:.1f} s)")
+        except Exception as error:
+            result = {'unit': PREFIXES[prefix], 'error': f"{type(error).__name__}: {error}"}
+            print(f"{name:<100} {'failed':>12}  {result['error']}")
+        results[name] = dict(result, params={key: _json_value(value) for key, value in params.items()})
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), **machine_info(), 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+    return report
+
+
+def _json_value(value):
+    return value if isinstance(value, (bool, int, float, str)) or value is None else repr(value)
+
+
+def format_value(value, unit):
+    if unit == 'bytes':
+        return f"{value / 2 ** 20:.1f} MiB"
+    if value < 1e-3:
+        return f"{value * 1e6:.1f} us"
+    if value < 1:
+        return f"{value * 1e3:.1f} ms"
+    return f"{value:.2f} s"
+
+
+def compare(base_file, new_file, threshold=1.1):
+    """
+    Compare the median of each benchmark between two results files.
+
+    Args:
+        base_file (str): Results of the base version.
+        new_file (str): Results of the new version.
+        threshold (float): Ratio of new to base above which a benchmark counts as slower, and below the inverse of
+            which it counts as faster. Default is 1.1.
+
+    Returns:
+        list: Names of the benchmarks that got slower or started failing.
+    """
+    if threshold <= 1:
+        raise ValueError("threshold must be greater than 1")
+    with open(base_file) as f:
+        base = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    print(f"base: {base.get('commit')} ({base.get('timestamp')})\nnew:  {new.get('commit')} ({new.get('timestamp')})")
+    regressions = []
+    for name in sorted(set(base['results']) & set(new['results'])):
+        before, after = base['results'][name], new['results'][name]
+        if 'error' in after and 'error' not in before:
+            change, flag = 'failed', '!'
+            regressions.append(name)
+        elif 'error' in after or 'error' in before:
+            change, flag = 'n/a', ' '
+        else:
+            ratio = after['median'] / before['median'] if before['median'] else float('inf')
+            change = f"{format_value(before['median'], before['unit'])} -> " \
+                     f"{format_value(after['median'], after['unit'])} ({ratio:.2f}x)"
+            flag = '+' if ratio > threshold else '-' if ratio < 1 / threshold else ' '
+            if flag == '+':
+                regressions.append(name)
+        print(f"{flag} {name:<100} {change}")
+
+    for name in sorted(set(new['results']) - set(base['results'])):
+        print(f"  {name:<100} new")
+    print(f"{len(regressions)} benchmark(s) slower by more than {threshold:g}x or failing")
+    return regressions
+
+
+def _child_peakmem(name):
+    # Set up and run one benchmark in this fresh process, then report its peak memory. Only the module of the
+    # benchmark is imported, so the imports of the other modules do not count.
+    for benchmark_name_, module, cls, method, params in discover(name, modules=[name.split('.')[0]]):
+        if benchmark_name_ == name:
+            instance = _set_up(cls, params)
+            try:
+                _call(instance, method, params)
+            finally:
+                _tear_down(instance, params)
+            print(json.dumps({'peakmem': peak_memory()}))
+            return
+    raise ValueError(f"unknown benchmark {name}")
+
+
+def _child_timeraw(code):
+    compiled = compile(code, '<timeraw>', 'exec')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        exec(compiled, {'__name__': '__timeraw__'})
+    print(json.dumps({'seconds': time.perf_counter() - start}))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['_peakmem']:
+        return _child_peakmem(argv[1])
+    if argv[:1] == ['_timeraw']:
+        return _child_timeraw(argv[1])
+
+    if argv[:1] == ['compare']:
+        parser = argparse.ArgumentParser(prog='python -m benchmarks.run compare',
+                                         description='Compare the results of two benchmark runs.')
+        parser.add_argument('base', help='results JSON of the base version')
+        parser.add_argument('new', help='results JSON of the new version')
+        parser.add_argument('--threshold', type=float, default=1.1,
+                            help='ratio above which a benchmark counts as slower (default 1.1)')
+        args = parser.parse_args(argv[1:])
+        return 1 if compare(args.base, args.new, args.threshold) else 0
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Run the ForestOps and geoops benchmarks.')
+    parser.add_argument('-b', '--bench', default=None, help='only run benchmarks whose name contains this text')
+    parser.add_argument('--quick', action='store_true', help='run the first parameters of each benchmark once')
+    parser.add_argument('--repeat', type=int, default=5, help='samples per benchmark (default 5)')
+    parser.add_argument('--max-time', type=float, default=60.0, help='seconds of samples per benchmark (default 60)')
+    parser.add_argument('-o', '--output', default=None, help='path of the JSON results file')
+    args = parser.parse_args(argv)
+    run(args.bench, args.quick, args.repeat, args.max_time, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
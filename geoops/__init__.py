@@ -1,7 +1,9 @@
 # GeoOps/__init__.py
 
-from .geo_io import *
+from .io import *
 from .raster_ops import *
 from .viewshed import *
+from .raster_cache import *
+from .vector import *
 
 
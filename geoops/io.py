@@ -10,6 +10,8 @@ import numpy as np
 import fiona
 import rasterio
 import time
+from geoops.raster_profiles import open_raster_writer
+from geoops.raster_cache import get_raster_cache
 
 
 def get_record_limit(url):
@@ -89,41 +91,51 @@ def read_files(file_path, rows_per_request=0, offset=0, crs=27700, file=''):
         return None
 
 
-def read_raster_file(raster_file):
+def read_raster_file(raster_file, cache=False):
+    # Through the shared cache the band is only decoded once, and the array is read-only
+    if cache:
+        raster_cache = get_raster_cache()
+        return raster_cache.read(raster_file), raster_cache.profile(raster_file)
     with rasterio.open(raster_file) as raster:
         raster_array = raster.read(1)
         raster_profile = raster.profile
     return raster_array, raster_profile
 
 
-def write_raster(filename, data, transform, crs):
+def write_raster(filename, data, transform, crs, nodata=None, profile=None):
     """
     Write a GeoTIFF raster using the given data, transform, and CRS.
 
     Args:
         filename (str): Output file name.
-        data (numpy.ndarray): 2D numpy array of raster values.
+        data (numpy.ndarray): 2D numpy array of raster values, or 3D array of (bands, rows, columns) for a
+            multi-band raster.
         transform (affine.Affine): Affine transformation object.
         crs (rasterio.crs.CRS): CRS object.
+        nodata (float or int, optional): Nodata value of the raster. Defaults to None.
+        profile (str or dict, optional): Output profile such as 'tiled', 'zstd', 'lerc' or 'cog', or a profile
+            built with output_profile. Defaults to None, which writes a plain striped GeoTIFF.
 
     Returns:
         None.
     """
-    height, width = data.shape
-    count = 1
+    # Write a single band raster as a raster with one band
+    if data.ndim == 2:
+        data = data[np.newaxis, ...]
+    count, height, width = data.shape
     dtype = data.dtype
-    with rasterio.open(
+    with open_raster_writer(
         filename,
-        'w',
-        driver='GTiff',
-        height=height,
         width=width,
+        height=height,
         count=count,
         dtype=dtype,
         crs=crs,
-        transform=transform
+        transform=transform,
+        nodata=nodata,
+        profile=profile
     ) as dst:
-        dst.write(data, 1)
+        dst.write(data)
 
 
 # def to_arcgis_geodb(data, gdb_path, name, schema=None, overwrite=True):
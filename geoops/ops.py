@@ -1,11 +1,13 @@
 import geopandas as gpd
 from shapely.geometry import Point, LineString, Polygon, MultiPoint
-from shapely.ops import transform, unary_union, polygonize, cascaded_union
-from osgeo import gdal
+from shapely.ops import transform, unary_union, polygonize
 # import rasterstats
 import numpy as np
 from scipy.stats import skew, kurtosis
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import shapely
+from geoops import vector
 
 def filter_by_attribute(gdf, column, value):
     # TODO: write this function to handle various filtering methods
@@ -18,94 +20,254 @@ def filter_by_attribute(gdf, column, value):
 
 def buffer(geometry, distance):
     """
-    Applies a buffer of specified distance to all geometries in the list
-
-    Status: untested
+    Applies a buffer of specified distance to a geometry, or to every geometry of an array or GeoSeries,
+    see vector.buffer
     """
-    return geometry.buffer(distance)
+    return vector.buffer(geometry, distance)
 
 
 def intersect(geometry1, geometry2):
     """
-    Returns the intersection of two geometries.
-    Status: untested
+    Returns the intersection of two geometries, or of two arrays of geometries element by element,
+    see vector.intersection
     """
-    intersection = geometry1.intersection(geometry2)
-    return intersection
+    return vector.intersection(geometry1, geometry2)
 
 
-def union():
+def union(shapes):
     """
     Unions all shapes in the list and returns a single shape
     """
-    union = shapes[0]
-    for shape in shapes[1:]:
-        union = union.union(shape)
-    return union
+    return shapely.union_all(vector.as_geometry_array(shapes))
 
-def merge():
+def merge(shapes):
     """
-    Merges all shapes in the list and returns a single shape
+    Merges all GeoDataFrames in the list and returns a single GeoDataFrame
     """
     merged = gpd.GeoDataFrame(pd.concat(shapes, ignore_index=True), crs=shapes[0].crs)
     return merged
 
-def create_polygon(coordinates):
+def create_polygon(coordinates, crs=None):
     """
     Creates a polygon from a list of coordinates
     """
     polygon = Polygon(coordinates)
-    return gpd.GeoDataFrame(geometry=[polygon], crs=shapes[0].crs)
+    return gpd.GeoDataFrame(geometry=[polygon], crs=crs)
 
-def dissolve(by):
+def dissolve(shapes, by):
     """
-    Dissolves all shapes in the list by specified column(s)
+    Dissolves all GeoDataFrames in the list by specified column(s)
     """
     dissolved = gpd.GeoDataFrame(pd.concat(shapes, ignore_index=True), crs=shapes[0].crs)
     dissolved = dissolved.dissolve(by=by)
     return dissolved
 
-def spatial_join(other, how='inner', op='intersects'):
+# Predicates of spatial_join, tested as predicate(left geometry, right geometry)
+JOIN_PREDICATES = ['intersects', 'within', 'contains', 'contains_properly', 'overlaps', 'crosses', 'touches',
+                   'covers', 'covered_by', 'dwithin']
+
+# Rows kept by a join: 'inner' the matched pairs, 'left' also the unmatched left rows, 'right' the unmatched right rows
+JOIN_HOWS = ['inner', 'left', 'right']
+
+def _query_partitions(query, count, workers, chunk_size):
+    """
+    Run a spatial index query over partitions of the query geometries, on several threads when workers is more
+    than 1.
+
+    Args:
+        query (callable): Function taking the start and stop positions of a partition and returning (positions in
+            the partition, positions in the index, distances or None).
+        count (int): Number of query geometries.
+        workers (int): Number of threads.
+        chunk_size (int): Number of geometries in each partition.
+
+    Returns:
+        tuple: The positions of the query geometries, the positions of the matching indexed geometries and their
+            distances or None, each pair once.
     """
-    Spatially join all shapes in the list with another shapefile
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+
+    def query_partition(start):
+        query_positions, tree_positions, distances = query(start, min(start + chunk_size, count))
+        return query_positions + start, tree_positions, distances
+
+    starts = range(0, count, chunk_size)
+    if workers <= 1 or len(starts) <= 1:
+        results = [query_partition(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(query_partition, starts))
+    if not results:
+        return np.array([], dtype='intp'), np.array([], dtype='intp'), None
+    distances = None if results[0][2] is None else np.concatenate([result[2] for result in results])
+    return (np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results]),
+            distances)
+
+def _join_frame(left, right, left_positions, right_positions, how, lsuffix, rsuffix, distances=None,
+                distance_col=None):
+    """
+    Build the joined GeoDataFrame from the positions of the matched left and right rows.
+
+    The result keeps the geometry and index of the left layer, or of the right layer when how is 'right', followed
+    by the other columns of the other layer and its index labels in an 'index_right' (or 'index_left') column.
+    Columns in both layers get the suffixes.
+    """
+    if how == 'right':
+        base, other, base_positions, other_positions = right, left, right_positions, left_positions
+        base_suffix, other_suffix = rsuffix, lsuffix
+    else:
+        base, other, base_positions, other_positions = left, right, left_positions, right_positions
+        base_suffix, other_suffix = lsuffix, rsuffix
+
+    # Pairs in the order of the base rows, then of the other rows
+    order = np.lexsort((other_positions, base_positions))
+    base_positions, other_positions = base_positions[order], other_positions[order]
+    if distances is not None:
+        distances = distances[order]
+
+    other_columns = other.drop(columns=other.geometry.name)
+    shared = set(base.columns).intersection(other_columns.columns)
+    matched = base.iloc[base_positions].rename(columns={column: f'{column}_{base_suffix}' for column in shared})
+    other_rows = other_columns.iloc[other_positions].rename(
+        columns={column: f'{column}_{other_suffix}' for column in shared})
+    other_rows.insert(0, f'index_{other_suffix}', other_rows.index)
+    other_rows.index = matched.index
+    joined = pd.concat([matched, other_rows], axis=1)
+    if distance_col is not None:
+        joined[distance_col] = distances if distances is not None else np.nan
+
+    if how != 'inner':
+        # Unmatched rows of the base layer, with missing values for the other layer
+        unmatched = np.setdiff1d(np.arange(len(base)), base_positions)
+        if len(unmatched):
+            rest = base.iloc[unmatched].rename(columns={column: f'{column}_{base_suffix}' for column in shared})
+            joined = pd.concat([joined, rest])
+            positions = np.concatenate([base_positions, unmatched])
+            joined = joined.iloc[np.argsort(positions, kind='stable')]
+    return gpd.GeoDataFrame(joined, geometry=base.geometry.name, crs=base.crs)
+
+def _check_join(left, right, how):
+    if how not in JOIN_HOWS:
+        raise ValueError(f"Invalid how. Must be one of {JOIN_HOWS}.")
+    if left.crs is not None and right.crs is not None and left.crs != right.crs:
+        raise ValueError(f"The layers have different CRSs ({left.crs} and {right.crs}). Reproject one with to_crs "
+                         f"first.")
+
+def spatial_join(left, right, how='inner', predicate='intersects', distance=None, lsuffix='left', rsuffix='right',
+                 workers=1, chunk_size=100000):
+    """
+    Join the attributes of the right layer to the features of the left layer they are spatially related to.
+
+    The spatial index of the right layer is built once and kept with it, so joining several layers, or the chunks of
+    a large layer, to the same right layer reuses it. The left geometries are queried against it in bulk, partition
+    by partition, with the predicate tested in the index query itself on candidates whose bounding boxes match, so
+    only matching pairs are ever materialised. Index the smaller layer: pass it as right.
+
+    Args:
+        left (GeoDataFrame): The features the result is built from, such as field parcels.
+        right (GeoDataFrame): The features joined to them, such as woodland polygons.
+        how (str): 'inner' keeps matched pairs, 'left' also keeps unmatched left features and 'right' returns the
+            right features, with their geometry, joined to the left ones. Default is 'inner'.
+        predicate (str, optional): Relation of the left geometry to the right one, one of JOIN_PREDICATES, or None
+            to join on intersecting bounding boxes. 'dwithin' joins features within distance of each other. Default
+            is 'intersects'.
+        distance (float or array-like, optional): Distance of the 'dwithin' predicate, one for all left features or
+            one for each.
+        lsuffix (str): Suffix of left columns also in the right layer. Default is 'left'.
+        rsuffix (str): Suffix of right columns also in the left layer. Default is 'right'.
+        workers (int): Number of threads querying partitions. Default is 1.
+        chunk_size (int): Number of left features in each partition. Default is 100000.
+
+    Returns:
+        GeoDataFrame: One row for each matched pair, with the index labels of the other layer in an 'index_right'
+            (or 'index_left') column.
+    """
+    _check_join(left, right, how)
+    if predicate is not None and predicate not in JOIN_PREDICATES:
+        raise ValueError(f"Invalid predicate. Must be None or one of {JOIN_PREDICATES}.")
+    if (predicate == 'dwithin') != (distance is not None):
+        raise ValueError("distance is required by, and only used with, the 'dwithin' predicate.")
+
+    # Build the index before any thread queries it
+    sindex = right.sindex
+    geometries = np.asarray(left.geometry.values)
+    distances = np.broadcast_to(np.asarray(distance), len(geometries)) if distance is not None else None
+
+    def query(start, stop):
+        partition_distance = distances[start:stop] if distances is not None else None
+        positions = sindex.query(geometries[start:stop], predicate=predicate, distance=partition_distance)
+        return positions[0], positions[1], None
+
+    left_positions, right_positions, _ = _query_partitions(query, len(geometries), workers, chunk_size)
+    return _join_frame(left, right, left_positions, right_positions, how, lsuffix, rsuffix)
+
+def nearest_join(left, right, how='inner', max_distance=None, distance_col=None, all_matches=True,
+                 lsuffix='left', rsuffix='right', workers=1, chunk_size=100000):
+    """
+    Join the attributes of the nearest right feature to each left feature.
+
+    The spatial index of the right layer is built once and reused, as in spatial_join. Setting max_distance makes
+    the search much faster, since only right features within it are considered, and leaves left features with no
+    right feature that close unmatched.
+
+    Args:
+        left (GeoDataFrame): The features the result is built from.
+        right (GeoDataFrame): The features searched for the nearest one.
+        how (str): 'inner', 'left' or 'right', see spatial_join. Default is 'inner'.
+        max_distance (float, optional): Largest distance searched.
+        distance_col (str, optional): Name of a column added with the distance to the nearest feature.
+        all_matches (bool): Join every right feature at the nearest distance when there are ties, rather than
+            one of them. Default is True.
+        lsuffix (str): Suffix of left columns also in the right layer. Default is 'left'.
+        rsuffix (str): Suffix of right columns also in the left layer. Default is 'right'.
+        workers (int): Number of threads querying partitions. Default is 1.
+        chunk_size (int): Number of left features in each partition. Default is 100000.
+
+    Returns:
+        GeoDataFrame: One row for each left feature and its nearest right feature.
     """
-    joined = shapes[0].spatial.join(other, how=how, op=op)
-    for shape in shapes[1:]:
-        joined = joined.spatial.join(shape, how=how, op=op)
-    return joined
+    _check_join(left, right, how)
+    if max_distance is not None and max_distance <= 0:
+        raise ValueError("max_distance must be positive.")
+
+    # Build the index before any thread queries it
+    sindex = right.sindex
+
+    geometries = np.asarray(left.geometry.values)
+
+    def query(start, stop):
+        positions, distances = sindex.nearest(geometries[start:stop], return_all=all_matches,
+                                              max_distance=max_distance, return_distance=True)
+        return positions[0], positions[1], distances
 
-def centroid():
+    left_positions, right_positions, distances = _query_partitions(query, len(geometries), workers, chunk_size)
+    return _join_frame(left, right, left_positions, right_positions, how, lsuffix, rsuffix, distances,
+                       distance_col)
+
+def centroid(shapes):
     """
-    Computes the centroid of all shapes in the list and returns a single shape
+    Computes the centroid of each shape in the list, array or GeoSeries
     """
-    centroid = shapes[0].centroid
-    for shape in shapes[1:]:
-        centroid = centroid.append(shape.centroid)
-    return centroid
+    return vector.centroid(shapes)
 
-def line_to_point():
+def line_to_point(shapes):
     """
     Converts all LineString and MultiLineString geometries in the list to Point geometries
     """
-    points = []
-    for shape in shapes:
-        if shape.geom_type in ['LineString', 'MultiLineString']:
-            points.append(shape.centroid)
-        else:
-            points.append(shape)
-    return points
+    shapes = vector.as_geometry_array(shapes)
+    # LineString and MultiLineString type ids
+    lines = np.isin(shapely.get_type_id(shapes), [1, 5])
+    return np.where(lines, shapely.centroid(shapes), shapes)
 
-def polygon_to_line():
+def polygon_to_line(shapes):
     """
     Converts all Polygon and MultiPolygon geometries in the list to LineString geometries
     """
-    lines = []
-    for shape in shapes:
-        if shape.geom_type in ['Polygon', 'MultiPolygon']:
-            lines.append(shape.boundary)
-        else:
-            lines.append(shape)
-    return lines
+    shapes = vector.as_geometry_array(shapes)
+    # Polygon and MultiPolygon type ids
+    polygons = np.isin(shapely.get_type_id(shapes), [3, 6])
+    return np.where(polygons, shapely.boundary(shapes), shapes)
 
 def points_to_polygon(points):
     """
@@ -135,20 +297,23 @@ def concave_hull(points, alpha):
 def difference(geom1, geom2):
     """
     Computes the geometric difference between two geometries, returning a new geometry that represents the area of the first geometry minus the shared area with the second geometry.
+    Arrays and GeoSeries are differenced element by element, see vector.difference.
     """
-    return geom1.difference(geom2)
+    return vector.difference(geom1, geom2)
 
 def symmetric_difference(geometry1, geometry2):
     """
     Computes the geometric symmetric difference between two geometries, returning a new geometry that represents the area of the first geometry that is not shared with the second geometry, plus the area of the second geometry that is not shared with the first geometry.
+    Arrays and GeoSeries are compared element by element, see vector.symmetric_difference.
     """
-    return geometry1.symmetric_difference(geometry2)
+    return vector.symmetric_difference(geometry1, geometry2)
 
 def simplify(geometry, tolerance=0.001, preserve_topology=True):
     """
     Simplifies a geometry by removing vertices while preserving its shape and topology, based on a specified tolerance or distance.
+    Arrays and GeoSeries are simplified in one vectorised call, see vector.simplify.
     """
-    return geometry.simplify(tolerance, preserve_topology)
+    return vector.simplify(geometry, tolerance, preserve_topology)
 
 def affine_transform(geometry, matrix):
     """
@@ -163,26 +328,29 @@ def voronoi_diagram(points):
     voronoi_edges = polygonize(voronoi_diagram(points))
     return unary_union([edge.buffer(0.001) for edge in voronoi_edges if edge.length > 0])
 
+# Single geometries, arrays and GeoSeries are all accepted, arrays are compared element by element. The functions of
+# the vector module also compare every pair of two arrays (mode='pairwise') and split large inputs over threads.
+
 def distance(geometry1, geometry2):
-    return geometry1.distance(geometry2)
+    return vector.distance(geometry1, geometry2)
 
 def within(geometry1, geometry2):
-    return geometry1.within(geometry2)
+    return vector.within(geometry1, geometry2)
 
 def contains(geometry1, geometry2):
-    return geometry1.contains(geometry2)
+    return vector.contains(geometry1, geometry2)
 
 def crosses(geometry1, geometry2):
-    return geometry1.crosses(geometry2)
+    return vector.crosses(geometry1, geometry2)
 
 def intersects(geometry1, geometry2):
-    return geometry1.intersects(geometry2)
+    return vector.intersects(geometry1, geometry2)
 
 def overlaps(geometry1, geometry2):
-    return geometry1.overlaps(geometry2)
+    return vector.overlaps(geometry1, geometry2)
 
 def is_valid(geometry):
-    return geometry.is_valid
+    return vector.is_valid(geometry)
 
 def minimum_bounding_box(geometry):
     # Convert the input geometry into a MultiPoint object
@@ -223,6 +391,8 @@ def resample_raster(input_file, output_file, out_resolution):
     Returns:
         None
     """
+    from osgeo import gdal
+
     input_raster = gdal.Open(input_file)
     input_geotransform = input_raster.GetGeoTransform()
     input_projection = input_raster.GetProjection()
@@ -264,4 +434,7 @@ def clip_vector(input_file, clip_file, output_file):
 
 
 def polygon_in_polygon(geometry1, geometry2):
-
+    """
+    Returns whether the first polygons lie inside the second ones, see vector.within
+    """
+    return vector.within(geometry1, geometry2)
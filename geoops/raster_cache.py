@@ -0,0 +1,308 @@
+import os
+import glob
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+'''
+This module caches decoded raster data, so repeated terrain sampling, viewsheds, zonal statistics and summaries
+against the same DEM only pay the decode cost once
+'''
+
+
+def _file_version(path):
+    """
+    Return the modification time and size of a file, so cached data is dropped when the file changes.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        tuple: The modification time and size, or (None, None) for paths that are not local files.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return stat.st_mtime, stat.st_size
+
+
+def _window_key(window):
+    """
+    Return a hashable key for a window.
+
+    Args:
+        window (rasterio.windows.Window or None): The window, or None for the whole band.
+
+    Returns:
+        tuple or None: The column offset, row offset, width and height of the window.
+    """
+    if window is None:
+        return None
+    window = window.round_offsets().round_lengths()
+    return int(window.col_off), int(window.row_off), int(window.width), int(window.height)
+
+
+class RasterCache:
+    """
+    Least recently used cache of decoded raster windows, bounded by the number of bytes held.
+
+    Entries are keyed by (path, file version, band, window, overview) and are returned as read-only arrays shared by
+    every caller, so copy an array before modifying it. The cache is safe to use from several threads.
+
+    Args:
+        max_bytes (int): Maximum number of bytes of decoded data held. Default is 512 MB.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"RasterCache(max_bytes={self.max_bytes}, current_bytes={self.current_bytes}, "
+                f"entries={len(self._entries)}, hits={self.hits}, misses={self.misses})")
+
+    def _get(self, key):
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+            return array
+
+    def _evict(self):
+        # Drop the least recently used entries until the cache fits. The lock must be held.
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+
+    def _put(self, key, array):
+        array.flags.writeable = False
+        # Arrays larger than the whole cache are returned without being kept
+        if array.nbytes > self.max_bytes:
+            return array
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = array
+                self.current_bytes += array.nbytes
+            self._evict()
+            return self._entries.get(key, array)
+
+    def resize(self, max_bytes):
+        """
+        Change how many bytes of decoded data the cache may hold, evicting entries if needed.
+
+        Args:
+            max_bytes (int): Maximum number of bytes. 0 disables caching.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def read(self, path, band=1, window=None, overview=None):
+        """
+        Read a band, or a window of a band, through the cache.
+
+        A window is served from a cached copy of the whole band when there is one.
+
+        Args:
+            path (str): Path to the raster file.
+            band (int): Band number. Default is 1.
+            window (rasterio.windows.Window, optional): Window to read. Defaults to the whole band.
+            overview (int, optional): Overview level to read from. Defaults to the full resolution.
+
+        Returns:
+            numpy.ndarray: The read-only band data.
+        """
+        path = os.path.abspath(path) if os.path.exists(path) else path
+        version = _file_version(path)
+        window = _window_key(window)
+        key = (path, version, band, window, overview)
+
+        array = self._get(key)
+        if array is None and window is not None:
+            full = self._get((path, version, band, None, overview))
+            if full is not None:
+                col_off, row_off, width, height = window
+                if col_off >= 0 and row_off >= 0 and row_off + height <= full.shape[0] \
+                        and col_off + width <= full.shape[1]:
+                    array = full[row_off:row_off + height, col_off:col_off + width]
+        if array is not None:
+            self.hits += 1
+            return array
+
+        self.misses += 1
+        with rasterio.open(path, overview_level=overview) as src:
+            array = src.read(band, window=Window(*window) if window is not None else None)
+        return self._put(key, array)
+
+    def profile(self, path, overview=None):
+        """
+        Return the profile of a raster, reading its header only the first time.
+
+        Args:
+            path (str): Path to the raster file.
+            overview (int, optional): Overview level. Defaults to the full resolution.
+
+        Returns:
+            dict: A copy of the rasterio profile.
+        """
+        path = os.path.abspath(path) if os.path.exists(path) else path
+        key = (path, _file_version(path), overview)
+        with self._lock:
+            profile = self._profiles.get(key)
+        if profile is None:
+            with rasterio.open(path, overview_level=overview) as src:
+                profile = src.profile
+            with self._lock:
+                self._profiles[key] = profile
+        return profile.copy()
+
+    def clear(self):
+        """
+        Drop every cached entry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._profiles.clear()
+            self.current_bytes = 0
+
+
+# Cache shared by the viewshed, zonal and summary functions
+_DEFAULT_CACHE = RasterCache()
+
+
+def get_raster_cache():
+    """
+    Return the raster cache shared by the package.
+
+    Returns:
+        RasterCache: The shared cache.
+    """
+    return _DEFAULT_CACHE
+
+
+def set_raster_cache_size(max_bytes):
+    """
+    Change how many bytes of decoded data the shared raster cache may hold.
+
+    Args:
+        max_bytes (int): Maximum number of bytes. 0 disables caching.
+
+    Returns:
+        None
+    """
+    _DEFAULT_CACHE.resize(max_bytes)
+
+
+def clear_raster_cache(disk=False, directory=None):
+    """
+    Drop everything held by the shared raster cache.
+
+    Args:
+        disk (bool): Also delete the working copies made by memory_mapped_raster. Default is False.
+        directory (str, optional): Folder of the working copies. Defaults to the folder memory_mapped_raster uses.
+
+    Returns:
+        None
+    """
+    _DEFAULT_CACHE.clear()
+    if disk:
+        for copy_file in glob.glob(os.path.join(_working_copy_directory(directory), '*.npy')):
+            try:
+                os.remove(copy_file)
+            except OSError:
+                # Still mapped by another process on systems that do not allow it
+                pass
+
+
+def read_raster_cached(path, band=1, window=None, overview=None, cache=None):
+    """
+    Read a band, or a window of a band, through a raster cache.
+
+    Args:
+        path (str): Path to the raster file.
+        band (int): Band number. Default is 1.
+        window (rasterio.windows.Window, optional): Window to read. Defaults to the whole band.
+        overview (int, optional): Overview level to read from. Defaults to the full resolution.
+        cache (RasterCache, optional): Cache to use. Defaults to the shared cache.
+
+    Returns:
+        numpy.ndarray: The read-only band data.
+    """
+    return (cache or _DEFAULT_CACHE).read(path, band=band, window=window, overview=overview)
+
+
+def _working_copy_directory(directory=None):
+    """
+    Return the folder of the working copies made by memory_mapped_raster.
+
+    Args:
+        directory (str, optional): The folder. Defaults to a 'raster_cache' folder in the system temporary folder.
+
+    Returns:
+        str: The folder.
+    """
+    return directory or os.path.join(tempfile.gettempdir(), 'raster_cache')
+
+
+def memory_mapped_raster(path, band=1, directory=None):
+    """
+    Return a memory-mapped, uncompressed working copy of a raster band.
+
+    The band is decoded once into a .npy file, named after the path and version of the raster, and reused by later
+    calls and other processes. Random access sampling then only reads the pages it touches, without decoding
+    compressed blocks. Copies of earlier versions of the raster are deleted when a new one is made, and
+    clear_raster_cache(disk=True) deletes them all.
+
+    Args:
+        path (str): Path to the raster file.
+        band (int): Band number. Default is 1.
+        directory (str, optional): Folder holding the working copies. Defaults to a 'raster_cache' folder in the
+            system temporary folder.
+
+    Returns:
+        numpy.memmap: The read-only band data.
+    """
+    directory = _working_copy_directory(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    # Named after the path and band, then the version, so the copies of older versions can be found
+    path = os.path.abspath(path)
+    mtime, size = _file_version(path)
+    source = hashlib.sha1(f"{path}|{band}".encode()).hexdigest()
+    name = f"{source}_{hashlib.sha1(f'{mtime}|{size}'.encode()).hexdigest()}"
+    copy_file = os.path.join(directory, f"{name}.npy")
+
+    if not os.path.exists(copy_file):
+        with rasterio.open(path) as src:
+            # Decode the band block by block into the working copy, then move it into place in one step
+            partial_file = os.path.join(directory, f"{name}.{os.getpid()}.{threading.get_ident()}.partial")
+            copy = np.lib.format.open_memmap(partial_file, mode='w+', dtype=src.dtypes[band - 1],
+                                             shape=(src.height, src.width))
+            for _, window in src.block_windows(band):
+                copy[window.row_off:window.row_off + window.height,
+                     window.col_off:window.col_off + window.width] = src.read(band, window=window)
+            copy.flush()
+            del copy
+        os.replace(partial_file, copy_file)
+
+        # Copies of older versions of the raster are not needed any more
+        for old_file in glob.glob(os.path.join(directory, f"{source}_*.npy")):
+            if old_file != copy_file:
+                try:
+                    os.remove(old_file)
+                except OSError:
+                    # Still mapped by another process on systems that do not allow it
+                    pass
+
+    return np.load(copy_file, mmap_mode='r')
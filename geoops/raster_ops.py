@@ -2,8 +2,12 @@ import os
 import glob
 import rasterio
 from rasterio import merge
+from rasterio.windows import Window
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import time
+from geoops.raster_cache import get_raster_cache, read_raster_cached
 
 # from geoops.geo_io import time_recording
 
@@ -57,39 +61,39 @@ def raster_summary(raster_file, nodata=None, display_summary=False):
     Returns:
         dict: A dictionary containing the computed summary statistics, including nodata count.
     """
-    # Open raster dataset
-    with rasterio.open(raster_file) as src:
-        # Read raster data as a NumPy array
-        raster_data = src.read(1)
-
-        # Detect nodata value from raster metadata if not provided
-        if nodata is None:
-            nodata = src.nodata
-
-        # Mask nodata values
-        if nodata is not None:
-            raster_data = raster_data[raster_data != nodata]
-
-        # Compute summary statistics
-        min_value = raster_data.min()
-        max_value = raster_data.max()
-        mean_value = raster_data.mean()
-        std_value = raster_data.std()
-
-        # Count nodata values
-        nodata_count = 0
-        if nodata is not None:
-            nodata_count = (src.read(1) == nodata).sum()
-
-        # Create a dictionary to store the summary statistics
-        summary = {
-            'minimum': min_value,
-            'maximum': max_value,
-            'mean': mean_value,
-            'standard_deviation': std_value,
-            'nodata': nodata,
-            'nodata_count': nodata_count
-        }
+    # Read raster data as a NumPy array, through the shared cache so the band is only decoded once
+    band_data = read_raster_cached(raster_file)
+
+    # Detect nodata value from raster metadata if not provided
+    if nodata is None:
+        nodata = get_raster_cache().profile(raster_file)['nodata']
+
+    # Mask nodata values
+    raster_data = band_data
+    if nodata is not None:
+        nodata_mask = band_data == nodata
+        raster_data = band_data[~nodata_mask]
+
+    # Compute summary statistics
+    min_value = raster_data.min()
+    max_value = raster_data.max()
+    mean_value = raster_data.mean()
+    std_value = raster_data.std()
+
+    # Count nodata values
+    nodata_count = 0
+    if nodata is not None:
+        nodata_count = nodata_mask.sum()
+
+    # Create a dictionary to store the summary statistics
+    summary = {
+        'minimum': min_value,
+        'maximum': max_value,
+        'mean': mean_value,
+        'standard_deviation': std_value,
+        'nodata': nodata,
+        'nodata_count': nodata_count
+    }
     if display_summary:
         print("Summary statistics for raster file:", raster_file)
         print("Minimum value:", summary['minimum'])
@@ -287,3 +291,114 @@ def raster_calculator(raster1, raster2, output_path, operation):
 
 
 
+
+
+# Methods supported by sample_raster
+SAMPLE_METHODS = ['nearest', 'bilinear']
+
+
+def sample_raster(points_gdf, raster, bands=None, method='nearest', block_size=512):
+    """
+    Sample the values of a raster at many points.
+
+    Points are grouped by the block of the raster they fall in, each block is read once for all the requested bands,
+    and the values of its points are picked out with vectorised indexing, instead of asking GDAL point by point.
+
+    Args:
+        points_gdf (GeoDataFrame): The points to sample, reprojected to the CRS of the raster when both have a CRS.
+        raster (str or rasterio.io.DatasetReader): Path to the raster, or an open raster dataset.
+        bands (int or list, optional): Band or bands to sample. Defaults to every band.
+        method (str): 'nearest' for the value of the cell containing each point, or 'bilinear' to interpolate
+            between the four nearest cell centres. Default is 'nearest'.
+        block_size (int): Minimum size in pixels of the blocks points are grouped by. Smaller native blocks, such
+            as the single row strips of a striped GeoTIFF, are combined up to this size. Default is 512.
+
+    Returns:
+        pandas.DataFrame: The sampled values, with a band_<n> column for each band, aligned to the index of
+        points_gdf. Points outside the raster or on nodata cells are NaN.
+    """
+    if method not in SAMPLE_METHODS:
+        raise ValueError(f"Invalid method. Must be one of {', '.join(SAMPLE_METHODS)}.")
+
+    if isinstance(raster, str):
+        with rasterio.open(raster) as src:
+            return sample_raster(points_gdf, src, bands=bands, method=method, block_size=block_size)
+    src = raster
+
+    if bands is None:
+        bands = list(range(1, src.count + 1))
+    elif isinstance(bands, int):
+        bands = [bands]
+    else:
+        bands = list(bands)
+
+    points = points_gdf
+    if points.crs is not None and src.crs is not None and points.crs != src.crs:
+        points = points.to_crs(src.crs)
+
+    values = np.full((len(points), len(bands)), np.nan)
+    columns = [f"band_{band}" for band in bands]
+
+    # Fractional column and row of every point. Bilinear interpolation works between cell centres.
+    col_f, row_f = ~src.transform * (points.geometry.x.to_numpy(), points.geometry.y.to_numpy())
+    if method == 'bilinear':
+        col_f, row_f = col_f - 0.5, row_f - 0.5
+        inside = (col_f >= -0.5) & (col_f <= src.width - 0.5) & (row_f >= -0.5) & (row_f <= src.height - 0.5)
+    else:
+        inside = (col_f >= 0) & (col_f < src.width) & (row_f >= 0) & (row_f < src.height)
+
+    indices = np.flatnonzero(inside)
+    if len(indices) == 0:
+        return pd.DataFrame(values, index=points_gdf.index, columns=columns)
+
+    col0 = np.floor(col_f[indices]).astype(np.int64)
+    row0 = np.floor(row_f[indices]).astype(np.int64)
+
+    # Group the points by block, with native blocks combined up to block_size
+    native_height, native_width = src.block_shapes[0]
+    block_height = native_height * max(1, -(-block_size // native_height))
+    block_width = native_width * max(1, -(-block_size // native_width))
+    blocks_x = -(-src.width // block_width)
+    block_ids = (np.clip(row0, 0, None) // block_height) * blocks_x + np.clip(col0, 0, None) // block_width
+
+    order = np.argsort(block_ids, kind='stable')
+    sorted_ids = block_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    # Bilinear interpolation also needs the row and column after the block
+    halo = 1 if method == 'bilinear' else 0
+
+    for start, end in zip(starts, ends):
+        members = order[start:end]
+        block_row, block_col = divmod(int(sorted_ids[start]), blocks_x)
+        row_off, col_off = block_row * block_height, block_col * block_width
+        window = Window(col_off, row_off, min(block_width + halo, src.width - col_off),
+                        min(block_height + halo, src.height - row_off))
+
+        # Read the block once for every band, with nodata cells as NaN
+        data = src.read(bands, window=window).astype(np.float64)
+        for position, band in enumerate(bands):
+            nodata = src.nodatavals[band - 1]
+            if nodata is not None:
+                data[position][data[position] == nodata] = np.nan
+
+        rows, cols = row0[members], col0[members]
+        if method == 'nearest':
+            values[indices[members]] = data[:, rows - row_off, cols - col_off].T
+            continue
+
+        # Points within half a cell of the edge take the edge cells as their missing neighbours
+        row_a = np.clip(rows, 0, src.height - 1) - row_off
+        row_b = np.clip(rows + 1, 0, src.height - 1) - row_off
+        col_a = np.clip(cols, 0, src.width - 1) - col_off
+        col_b = np.clip(cols + 1, 0, src.width - 1) - col_off
+        weight_row = row_f[indices[members]] - rows
+        weight_col = col_f[indices[members]] - cols
+        values[indices[members]] = (
+            data[:, row_a, col_a] * (1 - weight_row) * (1 - weight_col)
+            + data[:, row_a, col_b] * (1 - weight_row) * weight_col
+            + data[:, row_b, col_a] * weight_row * (1 - weight_col)
+            + data[:, row_b, col_b] * weight_row * weight_col
+        ).T
+
+    return pd.DataFrame(values, index=points_gdf.index, columns=columns)
@@ -5,6 +5,7 @@ from osgeo import gdal
 import rasterstats
 import numpy as np
 from scipy.stats import skew, kurtosis
+from geoops.raster_cache import get_raster_cache
 
 class GeospatialStatistics:
 
@@ -26,7 +27,11 @@ class GeospatialStatistics:
         """
         if stats is None:
             stats = ['min', 'mean', 'max', 'count', 'sum', 'std', 'median', 'majority']
-        stats_dict = rasterstats.zonal_stats(vector_file, raster_file, stats=stats, nodata=-999)
+        # Pass the band from the shared raster cache, so repeated runs against the same raster do not decode it again
+        raster_cache = get_raster_cache()
+        raster_array = raster_cache.read(raster_file)
+        affine = raster_cache.profile(raster_file)['transform']
+        stats_dict = rasterstats.zonal_stats(vector_file, raster_array, affine=affine, stats=stats, nodata=-999)
 
         return stats_dict
 
@@ -0,0 +1,363 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+
+'''
+Vectorised geometry operations over arrays of geometries.
+
+Each function takes shapely geometries, NumPy arrays of them, GeoSeries or GeoDataFrames and runs the matching
+shapely 2 ufunc over the whole array in compiled code, instead of calling a method of each geometry in a Python loop.
+Inputs broadcast like NumPy arrays, so one geometry can be compared with many, and binary operations either pair the
+geometries element by element ('aligned') or compare every geometry of the first input with every geometry of the
+second ('pairwise'). Large inputs can be split into chunks processed on several threads, since shapely releases the
+GIL while it works.
+'''
+
+
+# How the geometries of the two inputs of a binary operation are paired
+VECTOR_MODES = ['aligned', 'pairwise']
+
+# Number of results computed by each chunk when work is spread over threads
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def as_geometry_array(geometries):
+    """
+    Return the geometries of a GeoSeries, GeoDataFrame, list or array as a NumPy object array.
+
+    Args:
+        geometries: A shapely geometry, a sequence of them, a GeoSeries or a GeoDataFrame.
+
+    Returns:
+        numpy.ndarray: The geometries, 0-dimensional for a single geometry.
+    """
+    if isinstance(geometries, gpd.GeoDataFrame):
+        geometries = geometries.geometry
+    if isinstance(geometries, (gpd.GeoSeries, pd.Series)):
+        geometries = geometries.values
+    return np.asarray(geometries, dtype=object)
+
+
+def _template(*inputs):
+    # The first GeoSeries or GeoDataFrame among the inputs, whose index and CRS the result takes
+    for value in inputs:
+        if isinstance(value, gpd.GeoDataFrame):
+            return value.geometry
+        if isinstance(value, gpd.GeoSeries):
+            return value
+    return None
+
+
+def _check_crs(geometry1, geometry2):
+    crs1, crs2 = getattr(geometry1, 'crs', None), getattr(geometry2, 'crs', None)
+    if crs1 is not None and crs2 is not None and crs1 != crs2:
+        raise ValueError(f"The geometries have different CRSs ({crs1} and {crs2}). Reproject one with to_crs first.")
+
+
+def _wrap(result, template):
+    # Return 1D results of a GeoSeries input as a Series with its index, and geometries as a GeoSeries with its CRS
+    if template is None or np.ndim(result) != 1 or len(result) != len(template):
+        return result
+    if result.dtype == object:
+        return gpd.GeoSeries(result, index=template.index, crs=template.crs)
+    return pd.Series(result, index=template.index)
+
+
+def _run(function, arrays, kwargs, workers, chunk_size):
+    """
+    Run a shapely ufunc over broadcast arrays, in chunks of rows on several threads when the input is large.
+
+    Args:
+        function (callable): The shapely ufunc.
+        arrays (list): Its array arguments, broadcast against each other.
+        kwargs (dict): Its other arguments.
+        workers (int): Number of threads.
+        chunk_size (int): Number of results computed by each chunk.
+
+    Returns:
+        The result of the ufunc.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    arrays = np.broadcast_arrays(*arrays)
+    shape = arrays[0].shape
+    if not shape:
+        return function(*arrays, **kwargs)
+
+    # Chunks are whole rows, with about chunk_size results each
+    rows = max(chunk_size // max(int(np.prod(shape[1:])), 1), 1)
+    if workers <= 1 or shape[0] <= rows:
+        return function(*arrays, **kwargs)
+
+    def run_chunk(start):
+        return function(*[array[start:start + rows] for array in arrays], **kwargs)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.concatenate(list(executor.map(run_chunk, range(0, shape[0], rows))))
+
+
+def _unary(function, geometry, args=(), kwargs=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Apply a ufunc of one geometry array and optional array arguments, such as buffer distances
+    arrays = [as_geometry_array(geometry)] + [np.asarray(arg) for arg in args]
+    result = _run(function, arrays, kwargs or {}, workers, chunk_size)
+    return _wrap(result, _template(geometry))
+
+
+def _binary(function, geometry1, geometry2, mode='aligned', kwargs=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Apply a ufunc of two geometry arrays.
+
+    Args:
+        function (callable): The shapely ufunc.
+        geometry1: The first geometries.
+        geometry2: The second geometries.
+        mode (str): 'aligned' pairs the geometries by position, broadcasting a single geometry or arrays of
+            compatible shapes, and returns a GeoSeries or Series with the index of a GeoSeries input. 'pairwise'
+            compares every first geometry with every second one and returns an array of shape (len(geometry1),
+            len(geometry2)).
+        kwargs (dict, optional): Other arguments of the ufunc.
+        workers (int): Number of threads.
+        chunk_size (int): Number of results computed by each chunk.
+
+    Returns:
+        The result of the ufunc.
+    """
+    if mode not in VECTOR_MODES:
+        raise ValueError(f"Invalid mode. Must be one of {VECTOR_MODES}.")
+    _check_crs(geometry1, geometry2)
+    array1, array2 = as_geometry_array(geometry1), as_geometry_array(geometry2)
+    if mode == 'pairwise':
+        if array1.ndim > 1 or array2.ndim > 1:
+            raise ValueError("Pairwise operations take one-dimensional inputs.")
+        return _run(function, [np.atleast_1d(array1)[:, np.newaxis], np.atleast_1d(array2)[np.newaxis, :]],
+                    kwargs or {}, workers, chunk_size)
+    if array1.ndim == 1 and array2.ndim == 1 and len(array1) != len(array2) and 1 not in (len(array1), len(array2)):
+        raise ValueError(f"Aligned operations need inputs of the same length, not {len(array1)} and {len(array2)}. "
+                         f"Use mode='pairwise' to compare every geometry with every other.")
+    result = _run(function, [array1, array2], kwargs or {}, workers, chunk_size)
+    return _wrap(result, _template(geometry1, geometry2))
+
+
+'''
+Constructive operations
+'''
+
+def buffer(geometry, distance, quad_segs=8, cap_style='round', join_style='round', mitre_limit=5.0,
+           workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Buffer geometries by a distance, one for all geometries or one for each.
+
+    Args:
+        geometry: The geometries.
+        distance (float or array-like): Buffer distance, negative to shrink polygons.
+        quad_segs (int): Number of segments in a quarter circle. Default is 8.
+        cap_style (str): 'round', 'flat' or 'square'. Default is 'round'.
+        join_style (str): 'round', 'mitre' or 'bevel'. Default is 'round'.
+        mitre_limit (float): Limit of mitre joins. Default is 5.
+        workers (int): Number of threads. Default is 1.
+        chunk_size (int): Number of geometries buffered by each thread at a time. Default is 100000.
+
+    Returns:
+        The buffered geometries.
+    """
+    return _unary(shapely.buffer, geometry, (distance,), {'quad_segs': quad_segs, 'cap_style': cap_style,
+                                                          'join_style': join_style, 'mitre_limit': mitre_limit},
+                  workers, chunk_size)
+
+
+def simplify(geometry, tolerance=0.001, preserve_topology=True, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Simplify geometries, removing vertices closer than tolerance to the simplified shape.
+
+    Args:
+        geometry: The geometries.
+        tolerance (float or array-like): Distance tolerance. Default is 0.001.
+        preserve_topology (bool): Keep the geometries valid, more slowly. Default is True.
+        workers (int): Number of threads. Default is 1.
+        chunk_size (int): Number of geometries simplified by each thread at a time. Default is 100000.
+
+    Returns:
+        The simplified geometries.
+    """
+    return _unary(shapely.simplify, geometry, (tolerance,), {'preserve_topology': preserve_topology}, workers,
+                  chunk_size)
+
+
+def make_valid(geometry, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Repair invalid geometries, leaving valid ones unchanged.
+    """
+    return _unary(shapely.make_valid, geometry, workers=workers, chunk_size=chunk_size)
+
+
+def centroid(geometry, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the centroid of each geometry.
+    """
+    return _unary(shapely.centroid, geometry, workers=workers, chunk_size=chunk_size)
+
+
+def intersection(geometry1, geometry2, mode='aligned', grid_size=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the intersections of two sets of geometries.
+
+    Args:
+        geometry1: The first geometries.
+        geometry2: The second geometries.
+        mode (str): 'aligned' or 'pairwise', see VECTOR_MODES. Default is 'aligned'.
+        grid_size (float, optional): Precision grid the result is snapped to.
+        workers (int): Number of threads. Default is 1.
+        chunk_size (int): Number of results computed by each thread at a time. Default is 100000.
+
+    Returns:
+        The intersections.
+    """
+    return _binary(shapely.intersection, geometry1, geometry2, mode, {'grid_size': grid_size}, workers, chunk_size)
+
+
+def union(geometry1, geometry2, mode='aligned', grid_size=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the unions of two sets of geometries, see intersection for the arguments.
+    """
+    return _binary(shapely.union, geometry1, geometry2, mode, {'grid_size': grid_size}, workers, chunk_size)
+
+
+def difference(geometry1, geometry2, mode='aligned', grid_size=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the parts of the first geometries outside the second ones, see intersection for the arguments.
+    """
+    return _binary(shapely.difference, geometry1, geometry2, mode, {'grid_size': grid_size}, workers, chunk_size)
+
+
+def symmetric_difference(geometry1, geometry2, mode='aligned', grid_size=None, workers=1,
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the parts of either geometry outside the other, see intersection for the arguments.
+    """
+    return _binary(shapely.symmetric_difference, geometry1, geometry2, mode, {'grid_size': grid_size}, workers,
+                   chunk_size)
+
+
+'''
+Measurements
+'''
+
+def area(geometry, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the area of each geometry.
+    """
+    return _unary(shapely.area, geometry, workers=workers, chunk_size=chunk_size)
+
+
+def length(geometry, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the length, or perimeter, of each geometry.
+    """
+    return _unary(shapely.length, geometry, workers=workers, chunk_size=chunk_size)
+
+
+def distance(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the distances between two sets of geometries, NaN where either is missing or empty.
+
+    Args:
+        geometry1: The first geometries.
+        geometry2: The second geometries.
+        mode (str): 'aligned' or 'pairwise', see VECTOR_MODES. Default is 'aligned'.
+        workers (int): Number of threads. Default is 1.
+        chunk_size (int): Number of distances computed by each thread at a time. Default is 100000.
+
+    Returns:
+        The distances.
+    """
+    return _binary(shapely.distance, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+'''
+Predicates
+
+Missing geometries are False for every predicate. For pairwise predicates between large layers, where most pairs are
+False, a spatial index query is much faster than the full matrix.
+'''
+
+def is_valid(geometry, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether each geometry is valid.
+    """
+    return _unary(shapely.is_valid, geometry, workers=workers, chunk_size=chunk_size)
+
+
+def intersects(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the geometries share any point.
+
+    Args:
+        geometry1: The first geometries.
+        geometry2: The second geometries.
+        mode (str): 'aligned' or 'pairwise', see VECTOR_MODES. Default is 'aligned'.
+        workers (int): Number of threads. Default is 1.
+        chunk_size (int): Number of pairs tested by each thread at a time. Default is 100000.
+
+    Returns:
+        The boolean results.
+    """
+    return _binary(shapely.intersects, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def within(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the first geometries lie within the second ones, see intersects for the arguments.
+    """
+    return _binary(shapely.within, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def contains(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the first geometries contain the second ones, see intersects for the arguments.
+    """
+    return _binary(shapely.contains, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def covers(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether no point of the second geometries lies outside the first ones, see intersects for the arguments.
+    """
+    return _binary(shapely.covers, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def covered_by(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether no point of the first geometries lies outside the second ones, see intersects for the arguments.
+    """
+    return _binary(shapely.covered_by, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def crosses(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the geometries cross, see intersects for the arguments.
+    """
+    return _binary(shapely.crosses, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def overlaps(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the geometries overlap, see intersects for the arguments.
+    """
+    return _binary(shapely.overlaps, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def touches(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the geometries touch only at their boundaries, see intersects for the arguments.
+    """
+    return _binary(shapely.touches, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
+
+
+def disjoint(geometry1, geometry2, mode='aligned', workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return whether the geometries share no point, see intersects for the arguments.
+    """
+    return _binary(shapely.disjoint, geometry1, geometry2, mode, workers=workers, chunk_size=chunk_size)
@@ -1,3 +1,9 @@
+import functools
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import rasterio
 import numpy as np
 from pyproj import Proj, transform
@@ -12,7 +18,8 @@ import numpy as np
 import rasterio
 from shapely.geometry import Point, LineString
 
-from geoops.geo_io import read_raster_file
+from geoops.io import read_raster_file, write_raster
+from geoops.raster_cache import memory_mapped_raster, read_raster_cached
 
 
 import geopandas as gpd
@@ -24,18 +31,249 @@ import rasterio as rio
 from shapely.geometry import Point, LineString, MultiLineString
 
 import rasterio as rio
+import rasterio.transform
 import geopandas as gpd
+import pandas as pd
+import shapely
+from rasterio.windows import Window, from_bounds
 from shapely.geometry import LineString
 
-def calculate_line_of_sight(obs_point_gdf, tgt_points_gdf, raster_file):
+# Mean radius of the earth in metres and the standard coefficient of atmospheric refraction
+EARTH_RADIUS = 6371008.8
+REFRACTION_COEFFICIENT = 0.13
+
+
+class SightModel:
+    """
+    The heights of the observer and targets above the terrain, and the correction for earth curvature and
+    atmospheric refraction applied along sightlines.
+
+    Over a distance d the terrain drops below the observer's horizontal plane by d**2 / (2 * R), and refraction
+    bends the sightline down by k times that, so the terrain is lowered by d**2 * (1 - k) / (2 * R). This matters for
+    sightlines longer than a few kilometres.
+
+    Args:
+        observer_height (float): Height of the observer's eye above the terrain. Default is 0.
+        target_height (float): Height of the targets above the terrain. Default is 0.
+        curvature (bool): Apply the earth curvature and refraction correction. Default is True.
+        refraction (float): Coefficient of atmospheric refraction k. Default is 0.13.
+        earth_radius (float): Radius of the earth R in CRS units. Default is 6,371,008.8 metres.
+    """
+
+    def __init__(self, observer_height=0.0, target_height=0.0, curvature=True, refraction=REFRACTION_COEFFICIENT,
+                 earth_radius=EARTH_RADIUS):
+        self.observer_height = observer_height
+        self.target_height = target_height
+        self.curvature = curvature
+        self.refraction = refraction
+        self.earth_radius = earth_radius
+
+    def __repr__(self):
+        return (f"SightModel(observer_height={self.observer_height}, target_height={self.target_height}, "
+                f"curvature={self.curvature}, refraction={self.refraction}, earth_radius={self.earth_radius})")
+
+    @property
+    def coefficient(self):
+        """The factor (1 - k) / (2 * R) that multiplies the squared distance, 0 without curvature."""
+        if not self.curvature:
+            return 0.0
+        return (1 - self.refraction) / (2 * self.earth_radius)
+
+    def with_observer_height(self, observer_height):
+        """Return a copy of the model with a different observer height."""
+        return SightModel(observer_height, self.target_height, self.curvature, self.refraction, self.earth_radius)
+
+    def correction(self, distance):
+        """
+        Return how far the terrain is lowered at the given distances from the observer.
+
+        Args:
+            distance (numpy.ndarray): Distances from the observer in CRS units.
+
+        Returns:
+            numpy.ndarray: The curvature and refraction correction at each distance.
+        """
+        return self.coefficient * np.square(distance)
+
+
+def sight_model_from_heights(sight_model, observer_height, target_height):
+    """
+    Return the sight model to use, building one without curvature from the heights if none is given.
+
+    Args:
+        sight_model (SightModel or None): The sight model passed to a visibility function.
+        observer_height (float): Height of the observer above the terrain.
+        target_height (float): Height of the targets above the terrain.
+
+    Returns:
+        SightModel: The sight model.
+    """
+    if sight_model is not None:
+        return sight_model
+    return SightModel(observer_height, target_height, curvature=False)
+
+
+def read_dem_window(dem, bounds, pad=2):
+    """
+    Read the part of a DEM covering a bounding box into a float array, with nodata cells set to NaN.
+
+    The window is read through the shared raster cache, so repeated queries over the same area do not decode the
+    DEM again.
+
+    Args:
+        dem (rasterio.io.DatasetReader): Open DEM dataset.
+        bounds (tuple): Bounding box as (min_x, min_y, max_x, max_y) in the CRS of the DEM.
+        pad (int): Number of cells added around the bounding box, so interpolation at its edges has neighbours.
+            Default is 2.
+
+    Returns:
+        tuple: The DEM array and its affine transform.
+    """
+    window = from_bounds(*bounds, transform=dem.transform)
+    window = Window(window.col_off - pad, window.row_off - pad, window.width + 2 * pad, window.height + 2 * pad)
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    window = window.intersection(Window(0, 0, dem.width, dem.height))
+
+    dem_array = read_raster_cached(dem.name, window=window).astype(np.float64)
+    if dem.nodata is not None:
+        dem_array[dem_array == dem.nodata] = np.nan
+
+    return dem_array, dem.window_transform(window)
+
+
+def bilinear_sample(dem_array, transform, x, y):
     """
-    Return a MultiLineString representing the line of sight between the observer and target points, with a
-    "visible" column indicating whether each target point is visible from the observer point.
+    Interpolate a DEM array bilinearly between cell centres at many coordinates at once.
+
+    Args:
+        dem_array (numpy.ndarray): 2D float DEM array, with nodata as NaN.
+        transform (affine.Affine): Affine transform of the DEM array.
+        x (numpy.ndarray): X coordinates, of any shape.
+        y (numpy.ndarray): Y coordinates, of the same shape as x.
+
+    Returns:
+        numpy.ndarray: Interpolated elevations, NaN outside the array or next to nodata cells.
+    """
+    height, width = dem_array.shape
+    inverse = ~transform
+    # Fractional pixel coordinates, measured from the centre of the top left cell
+    cols = inverse.a * x + inverse.b * y + inverse.c - 0.5
+    rows = inverse.d * x + inverse.e * y + inverse.f - 0.5
+
+    outside = (cols < -0.5) | (cols > width - 0.5) | (rows < -0.5) | (rows > height - 0.5)
+
+    col0 = np.clip(np.floor(cols), 0, max(width - 2, 0)).astype(np.intp)
+    row0 = np.clip(np.floor(rows), 0, max(height - 2, 0)).astype(np.intp)
+    col1 = np.minimum(col0 + 1, width - 1)
+    row1 = np.minimum(row0 + 1, height - 1)
+    fx = np.clip(cols - col0, 0, 1)
+    fy = np.clip(rows - row0, 0, 1)
+
+    top = dem_array[row0, col0] * (1 - fx) + dem_array[row0, col1] * fx
+    bottom = dem_array[row1, col0] * (1 - fx) + dem_array[row1, col1] * fx
+    elevation = top * (1 - fy) + bottom * fy
+    elevation[outside] = np.nan
+
+    return elevation
+
+
+def line_of_sight(dem_array, transform, observer_xy, target_x, target_y, observer_height=0.0, target_height=0.0,
+                  max_samples=4_000_000, sight_model=None):
+    """
+    Test whether targets are visible from an observer across a DEM array.
+
+    Every sightline is sampled at cell resolution, all sightlines at once, and the interpolated terrain at each
+    sample is compared with the height of the straight sight ray between the observer and the target, so the
+    terrain between them, not just at the two ends, decides visibility. With a sight model that applies curvature,
+    the terrain at every sample and the target are lowered by the correction for their distance, as whole arrays.
+
+    Args:
+        dem_array (numpy.ndarray): 2D float DEM array, with nodata as NaN. Nodata samples never block a sightline.
+        transform (affine.Affine): Affine transform of the DEM array.
+        observer_xy (tuple): Observer coordinates as (x, y).
+        target_x (numpy.ndarray): X coordinates of the targets.
+        target_y (numpy.ndarray): Y coordinates of the targets.
+        observer_height (float): Height of the observer above the terrain. Default is 0.
+        target_height (float or numpy.ndarray): Height of the targets above the terrain. Default is 0.
+        max_samples (int): Maximum number of terrain samples held in memory at once. Default is 4,000,000.
+        sight_model (SightModel, optional): Observer height, curvature and refraction. Overrides observer_height,
+            and target_height unless target_height is an array. Defaults to the given heights without curvature.
+
+    Returns:
+        numpy.ndarray: Boolean array, True where the target is visible. Targets outside the DEM are not visible.
+    """
+    if sight_model is not None:
+        observer_height = sight_model.observer_height
+        if np.ndim(target_height) == 0:
+            target_height = sight_model.target_height
+    sight_model = sight_model_from_heights(sight_model, observer_height, target_height)
+    coefficient = sight_model.coefficient
+
+    target_x = np.asarray(target_x, dtype=np.float64)
+    target_y = np.asarray(target_y, dtype=np.float64)
+    target_height = np.broadcast_to(np.asarray(target_height, dtype=np.float64), target_x.shape)
+    observer_x, observer_y = observer_xy
+
+    # Heights of the two ends of every sight ray
+    observer_z = bilinear_sample(dem_array, transform, np.array([observer_x]), np.array([observer_y]))[0]
+    observer_z += observer_height
+    dx = target_x - observer_x
+    dy = target_y - observer_y
+    distance = np.hypot(dx, dy)
+    target_z = bilinear_sample(dem_array, transform, target_x, target_y) + target_height
+    target_z -= coefficient * np.square(distance)
+
+    cell_size = min(abs(transform.a), abs(transform.e))
+    steps = np.maximum(np.ceil(distance / cell_size), 1).astype(np.int64)
+
+    visible = np.isfinite(target_z) & np.isfinite(observer_z)
+
+    # Process the targets from the shortest to the longest sightline, in chunks of similar length
+    order = np.argsort(steps, kind='stable')
+    start = 0
+    while start < len(order):
+        end = start + 1
+        while end < len(order) and (end - start + 1) * steps[order[end]] <= max_samples:
+            end += 1
+        chunk = order[start:end]
+        chunk_steps = steps[chunk[-1]]
+
+        # Fractions along each sightline of its intermediate samples, the ends themselves are excluded
+        fractions = np.arange(1, chunk_steps)[np.newaxis, :] / steps[chunk][:, np.newaxis]
+        inside = fractions < 1
+
+        terrain = bilinear_sample(dem_array, transform,
+                                  observer_x + fractions * dx[chunk][:, np.newaxis],
+                                  observer_y + fractions * dy[chunk][:, np.newaxis])
+        if coefficient:
+            terrain -= coefficient * np.square(fractions * distance[chunk][:, np.newaxis])
+        ray = observer_z + fractions * (target_z[chunk] - observer_z)[:, np.newaxis]
+
+        blocked = (terrain > ray) & inside
+        visible[chunk] &= ~blocked.any(axis=1)
+        start = end
+
+    return visible
+
+
+def calculate_line_of_sight(obs_point_gdf, tgt_points_gdf, raster_file, observer_height=0.0, target_height=0.0,
+                            sight_model=None):
+    """
+    Return the sightlines between the observer and target points, with a "visible" column indicating whether each
+    target point is visible from the observer point.
+
+    The DEM is read once, for the window covering the observer and targets, and every sightline is checked against
+    the terrain along its whole length at cell resolution.
 
     Parameters:
         obs_point_gdf (GeoDataFrame): A GeoDataFrame containing the observer point.
         tgt_points_gdf (GeoDataFrame): A GeoDataFrame containing the target points.
         raster_file (str): A string representing the path to the DEM raster file.
+        observer_height (float): Height of the observer's eye above the terrain. Default is 0.
+        target_height (float or str): Height of the targets above the terrain, or the name of a column of
+            tgt_points_gdf holding it. Default is 0.
+        sight_model (SightModel, optional): Observer and target heights with the earth curvature and refraction
+            correction. A column name in target_height still sets the height of each target.
 
     Returns:
         sightlines_gdf (GeoDataFrame): A GeoDataFrame containing the sightlines between the observer and target points,
@@ -47,39 +285,431 @@ def calculate_line_of_sight(obs_point_gdf, tgt_points_gdf, raster_file):
         obs_point_proj = obs_point_gdf.to_crs(dem.crs)
         tgt_points_proj = tgt_points_gdf.to_crs(dem.crs)
 
-        # Extract the elevation value for the observer point
-        obs_point_elev = float(next(rio.sample([(obs_point_proj.geometry.x[0], obs_point_proj.geometry.y[0])], dem)))
-
-        # Calculate the line of sight between the observer and target points
-        sightlines = []
-        visible = []
-        for i, tgt_point in tgt_points_proj.iterrows():
-            # Extract the elevation value for the target point
-            tgt_point_elev = float(next(rio.sample([(tgt_point.geometry.x, tgt_point.geometry.y)], dem)))
-
-            # Calculate the line of sight between the observer and target points
-            line = LineString([(obs_point_proj.geometry.x[0], obs_point_proj.geometry.y[0]),
-                               (tgt_point.geometry.x, tgt_point.geometry.y)])
-
-            # Sample the elevation values along the line of sight
-            for point in rio.sample(list(line.coords), dem):
-                if point[0] > obs_point_elev and point[0] > tgt_point_elev:
-                    # If the elevation of the point is greater than the elevations of both the observer and target,
-                    # then the target is visible
-                    visible.append(1)
-                    break
-            else:
-                # If the loop completes without finding a visible point, the target is not visible
-                visible.append(0)
-
-            # Add the sightline to the list of sightlines
-            sightlines.append(line)
-
-        # Create a GeoDataFrame from the sightlines and visible columns
-        sightlines_gdf = gpd.GeoDataFrame(geometry=sightlines)
-        sightlines_gdf["visible"] = visible
-
-        return sightlines_gdf
+        observer = obs_point_proj.geometry.iloc[0]
+        target_x = tgt_points_proj.geometry.x.to_numpy()
+        target_y = tgt_points_proj.geometry.y.to_numpy()
+
+        # Read the part of the DEM covering the observer and all targets once
+        bounds = (min(observer.x, target_x.min()), min(observer.y, target_y.min()),
+                  max(observer.x, target_x.max()), max(observer.y, target_y.max()))
+        dem_array, transform = read_dem_window(dem, bounds)
+        crs = dem.crs
+
+    if isinstance(target_height, str):
+        target_height = tgt_points_proj[target_height].to_numpy()
+
+    visible = line_of_sight(dem_array, transform, (observer.x, observer.y), target_x, target_y,
+                            observer_height=observer_height, target_height=target_height, sight_model=sight_model)
+
+    # Create the sightlines between the observer and every target
+    sightlines = shapely.linestrings(
+        np.stack([
+            np.column_stack([np.full(len(target_x), observer.x), target_x]),
+            np.column_stack([np.full(len(target_y), observer.y), target_y]),
+        ], axis=-1)
+    )
+
+    # Create a GeoDataFrame from the sightlines and visible columns
+    sightlines_gdf = gpd.GeoDataFrame({'visible': visible.astype(int)}, geometry=sightlines, crs=crs,
+                                      index=tgt_points_gdf.index)
+
+    return sightlines_gdf
+
+
+# Values of the visibility raster written by viewshed
+VISIBLE = 1
+NOT_VISIBLE = 0
+OUTSIDE = 255
+
+
+@functools.lru_cache(maxsize=16)
+def radial_rays(radius):
+    """
+    Return the cell offsets of the rays swept from an observer to every cell on the edge of a square of the given
+    radius.
+
+    Each ray steps one cell at a time along its major axis, so the rays to the 8 * radius edge cells pass through
+    every cell of the square. The offsets only depend on the radius and are cached between calls.
+
+    Args:
+        radius (int): Radius of the sweep in cells.
+
+    Returns:
+        tuple: Row and column offsets, both of shape (8 * radius, radius), read-only.
+    """
+    edge = np.arange(-radius, radius)
+    # Edge cells of the square, walking clockwise round it from the top left corner so each side starts at a
+    # corner and stops one cell short of the next, and each of the 8 * radius cells appears exactly once
+    end_rows = np.concatenate([np.full(2 * radius, -radius), edge, np.full(2 * radius, radius), -edge])
+    end_cols = np.concatenate([edge, np.full(2 * radius, radius), -edge, np.full(2 * radius, -radius)])
+
+    steps = np.arange(1, radius + 1) / radius
+    ray_rows = np.rint(end_rows[:, np.newaxis] * steps).astype(np.intp)
+    ray_cols = np.rint(end_cols[:, np.newaxis] * steps).astype(np.intp)
+    ray_rows.flags.writeable = False
+    ray_cols.flags.writeable = False
+
+    return ray_rows, ray_cols
+
+
+@functools.lru_cache(maxsize=16)
+def radial_ray_distances(radius, cell_x, cell_y, coefficient=0.0):
+    """
+    Return the distance of every sample of the radial rays from the observer, and the curvature correction at it.
+
+    Both only depend on the radius, the cell size and the sight model, so they are computed once and cached, and a
+    sweep with curvature costs one array subtraction per chunk of rays.
+
+    Args:
+        radius (int): Radius of the sweep in cells.
+        cell_x (float): Cell width in CRS units.
+        cell_y (float): Cell height in CRS units.
+        coefficient (float): Curvature coefficient of the sight model, see SightModel.coefficient. Default is 0.
+
+    Returns:
+        tuple: Distances and corrections, both of shape (8 * radius, radius), read-only.
+    """
+    ray_rows, ray_cols = radial_rays(radius)
+    distances = np.hypot(ray_rows * cell_y, ray_cols * cell_x)
+    corrections = coefficient * np.square(distances)
+    distances.flags.writeable = False
+    corrections.flags.writeable = False
+
+    return distances, corrections
+
+
+def viewshed_array(dem_array, row, col, cell_size, observer_height=0.0, target_height=0.0, radius=None,
+                   max_samples=4_000_000, sight_model=None):
+    """
+    Compute the cells of a DEM array visible from an observer cell with a radial sweep.
+
+    Rays are swept from the observer to every cell on the edge of the square of the given radius. Along each ray the
+    running maximum of the terrain slope seen from the observer is the horizon, and a cell is visible when the slope
+    to its target height is not below the horizon of the cells before it. A cell crossed by several rays is visible
+    if any of them sees it. This is the R2/R3 family of approximations: one pass over every ray instead of a separate
+    line of sight to every cell.
+
+    Args:
+        dem_array (numpy.ndarray): 2D float DEM array, with nodata as NaN. Nodata cells never block a ray and are
+            never visible.
+        row (int): Row of the observer cell.
+        col (int): Column of the observer cell.
+        cell_size (tuple): Cell width and height in CRS units.
+        observer_height (float): Height of the observer above the terrain. Default is 0.
+        target_height (float): Height above the terrain at which cells are tested. Default is 0.
+        radius (float, optional): Maximum distance from the observer in CRS units. Defaults to the whole array.
+        max_samples (int): Maximum number of ray samples held in memory at once. Default is 4,000,000.
+        sight_model (SightModel, optional): Observer and target heights with the earth curvature and refraction
+            correction. Overrides observer_height and target_height.
+
+    Returns:
+        numpy.ndarray: uint8 array of the DEM shape, VISIBLE, NOT_VISIBLE, or OUTSIDE beyond the radius.
+    """
+    sight_model = sight_model_from_heights(sight_model, observer_height, target_height)
+    observer_height, target_height = sight_model.observer_height, sight_model.target_height
+
+    height, width = dem_array.shape
+    cell_x, cell_y = abs(cell_size[0]), abs(cell_size[1])
+
+    if radius is None:
+        radius_cells = max(row, col, height - 1 - row, width - 1 - col, 1)
+    else:
+        radius_cells = max(int(np.ceil(radius / min(cell_x, cell_y))), 1)
+
+    visibility = np.full(dem_array.shape, OUTSIDE, dtype=np.uint8)
+
+    # Cells within the radius start as not visible, the sweep marks the ones it can see
+    rows, cols = np.ogrid[:height, :width]
+    distance = np.hypot((rows - row) * cell_y, (cols - col) * cell_x)
+    within = distance <= radius if radius is not None else np.ones(dem_array.shape, dtype=bool)
+    visibility[within] = NOT_VISIBLE
+
+    observer_z = dem_array[row, col] + observer_height
+    if not np.isfinite(observer_z):
+        return visibility
+    visibility[row, col] = VISIBLE
+
+    ray_rows, ray_cols = radial_rays(radius_cells)
+    ray_distances, ray_corrections = radial_ray_distances(radius_cells, cell_x, cell_y, sight_model.coefficient)
+    rays_per_chunk = max(max_samples // radius_cells, 1)
+
+    for start in range(0, len(ray_rows), rays_per_chunk):
+        offset_rows = ray_rows[start:start + rays_per_chunk]
+        offset_cols = ray_cols[start:start + rays_per_chunk]
+        cell_rows = row + offset_rows
+        cell_cols = col + offset_cols
+
+        # Samples outside the array read as nodata
+        inside = (cell_rows >= 0) & (cell_rows < height) & (cell_cols >= 0) & (cell_cols < width)
+        terrain = np.full(cell_rows.shape, np.nan)
+        terrain[inside] = dem_array[cell_rows[inside], cell_cols[inside]]
+
+        ray_distance = ray_distances[start:start + rays_per_chunk]
+        if sight_model.curvature:
+            terrain -= ray_corrections[start:start + rays_per_chunk]
+        terrain_slope = (terrain - observer_z) / ray_distance
+
+        # The horizon of each sample is the steepest terrain slope of the samples before it on the ray
+        horizon = np.maximum.accumulate(np.where(np.isfinite(terrain_slope), terrain_slope, -np.inf), axis=1)
+        horizon = np.concatenate([np.full((len(horizon), 1), -np.inf), horizon[:, :-1]], axis=1)
+
+        target_slope = (terrain + target_height - observer_z) / ray_distance
+        seen = (target_slope >= horizon) & inside & np.isfinite(terrain)
+        if radius is not None:
+            seen &= ray_distance <= radius
+
+        visibility[cell_rows[seen], cell_cols[seen]] = VISIBLE
+
+    return visibility
+
+
+def viewshed(raster_file, observer, observer_height=0.0, target_height=0.0, max_distance=None, output_file=None,
+             profile=None, sight_model=None):
+    """
+    Compute the visibility raster of an observer over a DEM.
+
+    Only the window of the DEM within max_distance of the observer is read, and the output covers that window.
+
+    Parameters:
+        raster_file (str): Path to the DEM raster file.
+        observer (GeoDataFrame, GeoSeries or tuple): The observer point, as the first point of a GeoDataFrame or
+            GeoSeries, which is reprojected to the DEM, or as (x, y) in the CRS of the DEM. It must lie within
+            the DEM.
+        observer_height (float): Height of the observer's eye above the terrain. Default is 0.
+        target_height (float): Height above the terrain at which cells are tested. Default is 0.
+        max_distance (float, optional): Maximum distance from the observer in CRS units. Defaults to the whole DEM.
+        output_file (str, optional): Path of a GeoTIFF to write the visibility raster to.
+        profile (str or dict, optional): Output profile for output_file, see output_profile.
+        sight_model (SightModel, optional): Observer and target heights with the earth curvature and refraction
+            correction. Overrides observer_height and target_height.
+
+    Returns:
+        tuple: The uint8 visibility array (1 visible, 0 not visible, 255 outside max_distance) and its profile.
+    """
+    with rio.open(raster_file) as dem:
+        observer_x, observer_y = observer_coordinates(observer, dem.crs)
+        observer_row, observer_col = dem.index(observer_x, observer_y)
+        if not (0 <= observer_row < dem.height and 0 <= observer_col < dem.width):
+            raise ValueError(f"The observer ({observer_x}, {observer_y}) is outside the DEM {raster_file}.")
+
+        if max_distance is None:
+            window = Window(0, 0, dem.width, dem.height)
+        else:
+            # Read a square window centred on the observer cell, padded with nodata beyond the edges of the DEM
+            radius_cells = int(np.ceil(max_distance / min(abs(dem.res[0]), abs(dem.res[1]))))
+            window = Window(observer_col - radius_cells, observer_row - radius_cells,
+                            2 * radius_cells + 1, 2 * radius_cells + 1)
+
+        # Cells beyond the edges of the DEM are left as NaN
+        dem_array = np.full((int(window.height), int(window.width)), np.nan)
+        extent = Window(0, 0, dem.width, dem.height)
+        if rio.windows.intersect([window, extent]):
+            inside = window.intersection(extent)
+            data = read_raster_cached(dem.name, window=inside).astype(np.float64)
+            if dem.nodata is not None:
+                data[data == dem.nodata] = np.nan
+            row_off, col_off = int(inside.row_off - window.row_off), int(inside.col_off - window.col_off)
+            dem_array[row_off:row_off + data.shape[0], col_off:col_off + data.shape[1]] = data
+
+        transform = dem.window_transform(window)
+        crs = dem.crs
+        res = dem.res
+
+    visibility = viewshed_array(dem_array, observer_row - int(window.row_off), observer_col - int(window.col_off),
+                                res, observer_height=observer_height, target_height=target_height,
+                                radius=max_distance, sight_model=sight_model)
+
+    visibility_profile = {'driver': 'GTiff', 'dtype': 'uint8', 'nodata': OUTSIDE, 'width': visibility.shape[1],
+                          'height': visibility.shape[0], 'count': 1, 'crs': crs, 'transform': transform}
+    if output_file is not None:
+        write_raster(output_file, visibility, transform, crs, nodata=OUTSIDE, profile=profile)
+
+    return visibility, visibility_profile
+
+
+def observer_coordinates(observer, crs):
+    """
+    Return the coordinates of an observer in the CRS of a DEM.
+
+    Args:
+        observer (GeoDataFrame, GeoSeries or tuple): The observer point, as the first point of a GeoDataFrame or
+            GeoSeries, or as (x, y) already in the CRS of the DEM.
+        crs: CRS of the DEM.
+
+    Returns:
+        tuple: The observer coordinates as (x, y).
+    """
+    if isinstance(observer, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        point = observer.to_crs(crs).geometry.iloc[0] if isinstance(observer, gpd.GeoDataFrame) \
+            else observer.to_crs(crs).iloc[0]
+        return point.x, point.y
+    return observer
+
+
+# DEMs opened by the current process, keyed by path, so each worker maps a DEM only once
+_MAPPED_DEMS = {}
+
+
+def _observer_viewshed(dem_file, nodata, index, row, col, cell_size, sight_model, max_distance):
+    """
+    Compute the viewshed of one observer from a memory-mapped copy of a DEM, in a worker process.
+
+    Args:
+        dem_file (str): Path of the DEM band saved as a .npy file, or the key of a DEM array already in
+            _MAPPED_DEMS.
+        nodata (float or None): Nodata value of the DEM.
+        index (int): Position of the observer in the observer GeoDataFrame.
+        row (int): Row of the observer cell.
+        col (int): Column of the observer cell.
+        cell_size (tuple): Cell width and height in CRS units.
+        sight_model (SightModel): Observer and target heights, curvature and refraction.
+        max_distance (float or None): Maximum distance from the observer in CRS units.
+
+    Returns:
+        tuple: The observer position, the row and column offsets and shape of the window, the visible cells of the
+        window packed into bits, and the seconds taken.
+    """
+    start = time.perf_counter()
+    if dem_file not in _MAPPED_DEMS:
+        _MAPPED_DEMS[dem_file] = np.load(dem_file, mmap_mode='r')
+    dem = _MAPPED_DEMS[dem_file]
+
+    # Only the pages of the window within max_distance are read from the mapped file
+    if max_distance is None:
+        row_off, col_off = 0, 0
+        window = np.array(dem, dtype=np.float64)
+    else:
+        radius_cells = int(np.ceil(max_distance / min(abs(cell_size[0]), abs(cell_size[1]))))
+        row_off, col_off = max(row - radius_cells, 0), max(col - radius_cells, 0)
+        window = np.array(dem[row_off:row + radius_cells + 1, col_off:col + radius_cells + 1], dtype=np.float64)
+    if nodata is not None:
+        window[window == nodata] = np.nan
+
+    visibility = viewshed_array(window, row - row_off, col - col_off, cell_size, radius=max_distance,
+                                sight_model=sight_model)
+
+    return index, row_off, col_off, visibility.shape, np.packbits(visibility == VISIBLE), time.perf_counter() - start
+
+
+def cumulative_viewshed(raster_file, observers_gdf, observer_height=0.0, target_height=0.0, max_distance=None,
+                        workers=None, count_file=None, bitmask_file=None, return_bitmask=False, progress=None,
+                        profile=None, sight_model=None, working_copy=False, working_copy_dir=None):
+    """
+    Compute the cumulative visibility of many observers over a DEM, spreading the observers over a process pool.
+
+    The DEM is read once and saved as a temporary memory-mapped file that every worker shares, so only the window
+    within max_distance of each observer is read by the worker computing it. With working_copy the file is instead
+    the working copy made by memory_mapped_raster, which later runs reuse. With a single worker and no working copy
+    the DEM is kept in memory. The per-observer visibility is reduced into a count raster of how many observers see
+    each cell and, optionally, a bitmask raster recording which observers see it: bit j of band b is set when
+    observer 8 * b + j sees the cell.
+
+    Parameters:
+        raster_file (str): Path to the DEM raster file.
+        observers_gdf (GeoDataFrame): The observer points. They are reprojected to the DEM.
+        observer_height (float or str): Height of the observers' eyes above the terrain, or the name of a column of
+            observers_gdf holding it. Default is 0.
+        target_height (float): Height above the terrain at which cells are tested. Default is 0.
+        max_distance (float, optional): Maximum distance from each observer in CRS units. Defaults to the whole DEM.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs. With 1 the viewsheds
+            are computed in the calling process.
+        count_file (str, optional): Path of a GeoTIFF to write the count raster to.
+        bitmask_file (str, optional): Path of a GeoTIFF to write the bitmask raster to, one band per 8 observers.
+        return_bitmask (bool): Also build and return the bitmask when no bitmask_file is given. Default is False.
+        progress (callable, optional): Called as progress(done, total, index, seconds) after each observer.
+            Defaults to None, which reports nothing.
+        profile (str or dict, optional): Output profile for count_file and bitmask_file, see output_profile.
+        sight_model (SightModel, optional): Observer and target heights with the earth curvature and refraction
+            correction. Overrides observer_height and target_height, except that a column name in observer_height
+            still sets the height of each observer.
+        working_copy (bool): Decode the DEM into a persistent working copy, see memory_mapped_raster, which later
+            runs over the same DEM reuse. Delete the copies with clear_raster_cache(disk=True). Default is False,
+            which keeps the DEM in memory, or in a temporary file removed at the end for several workers.
+        working_copy_dir (str, optional): Folder of the working copy. Defaults to the folder memory_mapped_raster
+            uses.
+
+    Returns:
+        tuple: The count array, the bitmask array (or None), the profile of the arrays, and a DataFrame with the
+        row, column, number of visible cells and seconds taken for each observer.
+    """
+    with rio.open(raster_file) as dem:
+        observers = observers_gdf.to_crs(dem.crs)
+        rows, cols = rio.transform.rowcol(dem.transform, observers.geometry.x.to_numpy(),
+                                          observers.geometry.y.to_numpy())
+        transform, crs, res, nodata = dem.transform, dem.crs, dem.res, dem.nodata
+        height, width = dem.height, dem.width
+
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    total = len(observers)
+
+    if isinstance(observer_height, str):
+        observer_heights = observers[observer_height].to_numpy(dtype=np.float64)
+        sight_model = sight_model_from_heights(sight_model, 0.0, target_height)
+    else:
+        sight_model = sight_model_from_heights(sight_model, observer_height, target_height)
+        observer_heights = np.full(total, sight_model.observer_height, dtype=np.float64)
+
+    count = np.zeros((height, width), dtype=np.uint16 if total < 2 ** 16 else np.uint32)
+    build_bitmask = bitmask_file is not None or return_bitmask
+    bitmask = np.zeros(((total + 7) // 8, height, width), dtype=np.uint8) if build_bitmask else None
+
+    timings = pd.DataFrame({'row': rows, 'col': cols, 'visible_cells': 0, 'seconds': np.nan},
+                           index=observers_gdf.index)
+
+    # Observers outside the DEM are skipped
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    tasks = [(int(i), int(rows[i]), int(cols[i]), res, sight_model.with_observer_height(observer_heights[i]),
+              max_distance)
+             for i in np.flatnonzero(inside)]
+
+    # Give the workers a DEM to map: the persistent working copy, the array itself in this process or a temporary copy
+    temporary_dir = None
+    if working_copy:
+        dem_file = memory_mapped_raster(raster_file, directory=working_copy_dir).filename
+    elif workers == 1:
+        dem_file = os.path.abspath(raster_file)
+        _MAPPED_DEMS[dem_file] = read_raster_cached(raster_file)
+    else:
+        temporary_dir = tempfile.mkdtemp()
+        dem_file = os.path.join(temporary_dir, 'dem.npy')
+        np.save(dem_file, read_raster_cached(raster_file))
+
+    executor = None
+    try:
+        if workers == 1:
+            results = (_observer_viewshed(dem_file, nodata, *task) for task in tasks)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            futures = [executor.submit(_observer_viewshed, dem_file, nodata, *task) for task in tasks]
+            results = (future.result() for future in as_completed(futures))
+
+        for done, (index, row_off, col_off, shape, packed, seconds) in enumerate(results, start=1):
+            # Reduce the observer's visibility into the count and bitmask rasters
+            visible = np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+            window = (slice(row_off, row_off + shape[0]), slice(col_off, col_off + shape[1]))
+            count[window] += visible
+            if bitmask is not None:
+                bitmask[(index // 8,) + window] |= visible.astype(np.uint8) * np.uint8(1 << (index % 8))
+
+            timings.iloc[index, timings.columns.get_loc('visible_cells')] = int(visible.sum())
+            timings.iloc[index, timings.columns.get_loc('seconds')] = seconds
+            if progress is not None:
+                progress(done, len(tasks), index, seconds)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        _MAPPED_DEMS.pop(dem_file, None)
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+    count_profile = {'driver': 'GTiff', 'dtype': count.dtype.name, 'nodata': None, 'width': width, 'height': height,
+                     'count': 1, 'crs': crs, 'transform': transform}
+    if count_file is not None:
+        write_raster(count_file, count, transform, crs, profile=profile)
+    if bitmask_file is not None:
+        write_raster(bitmask_file, bitmask, transform, crs, profile=profile)
+
+    return count, bitmask, count_profile, timings
 
 
 #
@@ -0,0 +1,325 @@
+import os
+import threading
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import shapely
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+from shapely.geometry import MultiPolygon, Point, Polygon, box
+
+from ForestOps.geo_ops.crs_cache import reproject
+from ForestOps.geo_ops.geo_funcs import explode_geodataframe, extract_overlapping_polygons, fix_invalid_geometries
+from ForestOps.geo_ops.geo_io import read_attribute_chunks
+from ForestOps.geo_ops.geo_stats import native_zonal_statistics
+from ForestOps.geo_ops.instrumentation import StageCollector, get_collector, set_collector, stage
+from ForestOps.geo_ops.pipeline import Pipeline
+from ForestOps.geo_ops.raster_ops import points_to_raster
+from ForestOps.geo_ops.sindex_cache import SpatialIndexCache, cached_index
+from ForestOps.geo_ops.tile_index import query_tile_index, update_tile_index
+from geoops.io import read_raster_file, write_raster
+from geoops.ops import nearest_join, spatial_join
+from geoops.raster_cache import clear_raster_cache
+from geoops.viewshed import OUTSIDE, VISIBLE, cumulative_viewshed, radial_rays, viewshed, viewshed_array
+
+
+def test_radial_rays_end_on_every_edge_cell_once():
+    radius = 5
+    ray_rows, ray_cols = radial_rays(radius)
+    ends = set(zip(ray_rows[:, -1].tolist(), ray_cols[:, -1].tolist()))
+    assert len(ends) == len(ray_rows) == 8 * radius
+    assert all(max(abs(row), abs(col)) == radius for row, col in ends)
+
+
+def test_viewshed_array_flat_dem_is_all_visible():
+    dem = np.zeros((201, 201))
+    visibility = viewshed_array(dem, 100, 100, (1.0, 1.0))
+    assert (visibility == VISIBLE).all()
+
+    visibility = viewshed_array(dem, 100, 100, (1.0, 1.0), radius=100)
+    rows, cols = np.indices(dem.shape)
+    within = np.hypot(rows - 100, cols - 100) <= 100
+    assert (visibility[within] == VISIBLE).all()
+    assert (visibility[~within] == OUTSIDE).all()
+
+
+@pytest.mark.parametrize('observer', [(-5.0, 5.0), (5.0, 15.0), (25.0, 5.0), (5.0, -5.0)])
+@pytest.mark.parametrize('max_distance', [None, 5.0])
+def test_viewshed_rejects_observer_outside_dem(tmp_path, observer, max_distance):
+    dem_file = str(tmp_path / 'dem.tif')
+    write_raster(dem_file, np.zeros((10, 20), dtype=np.float32), from_origin(0, 10, 1, 1), 'EPSG:27700')
+    with pytest.raises(ValueError, match='outside the DEM'):
+        viewshed(dem_file, observer, max_distance=max_distance)
+    visibility, _ = viewshed(dem_file, (5.0, 5.0), max_distance=max_distance)
+    assert (visibility == VISIBLE).any()
+
+
+def test_extract_overlapping_polygons_sees_edits_in_place():
+    outer = box(0, 0, 10, 10)
+    reference = gpd.GeoDataFrame(geometry=[outer, box(20, 20, 30, 30)], crs='EPSG:27700')
+    points = gpd.GeoDataFrame(geometry=[Point(5, 5)], crs='EPSG:27700')
+    assert len(extract_overlapping_polygons(points, reference)) == 1
+
+    # The hole keeps the bounds of the polygon but no longer covers the point
+    reference.loc[0, 'geometry'] = outer.difference(box(2, 2, 8, 8))
+    assert len(extract_overlapping_polygons(points, reference)) == len(gpd.sjoin(points, reference)) == 0
+
+
+def test_read_raster_file_returns_writable_array(tmp_path):
+    raster_file = str(tmp_path / 'raster.tif')
+    write_raster(raster_file, np.arange(12, dtype=np.float32).reshape(3, 4), from_origin(0, 3, 1, 1), 'EPSG:27700')
+    array, _ = read_raster_file(raster_file)
+    array[0, 0] = -1
+    assert read_raster_file(raster_file)[0][0, 0] == 0
+
+
+def test_cumulative_viewshed_counts_flat_dem(tmp_path, capsys):
+    dem_file = str(tmp_path / 'dem.tif')
+    dem = np.zeros((10, 20), dtype=np.float32)
+    dem[0, 0] = -9999
+    write_raster(dem_file, dem, from_origin(0, 10, 1, 1), 'EPSG:27700', nodata=-9999)
+    observers = gpd.GeoDataFrame(geometry=[Point(5.5, 5.5), Point(15.5, 2.5)], crs='EPSG:27700')
+    count, bitmask, _, timings = cumulative_viewshed(dem_file, observers, workers=1, return_bitmask=True)
+    assert capsys.readouterr().out == ''
+    assert count[0, 0] == 0
+    assert (count.ravel()[1:] == 2).all()
+    assert (bitmask[0].ravel()[1:] == 3).all()
+    assert timings['visible_cells'].tolist() == [199, 199]
+
+
+@pytest.mark.parametrize('copy', [True, False])
+def test_fix_invalid_geometries_with_duplicate_labels(copy):
+    bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1)])
+    gdf = gpd.GeoDataFrame({'value': [1, 2, 3]}, geometry=[None, bowtie, box(0, 0, 1, 1)], index=[0, 0, 1])
+    fixed = fix_invalid_geometries(gdf, copy=copy)
+    assert fixed.index.tolist() == [0, 1]
+    assert fixed['value'].tolist() == [2, 3]
+    assert fixed.geometry.is_valid.all()
+    assert (fixed is gdf) != copy
+
+
+def test_pipeline_write_replaces_output_when_nothing_is_left(tmp_path):
+    output_file = str(tmp_path / 'output.gpkg')
+    parcels = gpd.GeoDataFrame({'area': [1, 4]}, geometry=[box(0, 0, 1, 1), box(0, 0, 2, 2)], crs='EPSG:27700')
+    assert Pipeline(parcels, chunk_size=1).write(output_file) == 2
+
+    pipeline = Pipeline(parcels, chunk_size=1).filter(lambda chunk: chunk['area'] > 10)
+    assert pipeline.write(output_file) == 0
+    written = gpd.read_file(output_file)
+    assert len(written) == 0
+    assert 'area' in written.columns
+
+
+def test_query_tile_index_keeps_tiles_of_folder(tmp_path):
+    index_file = str(tmp_path / 'tiles.sqlite')
+    for folder, name, x in [('a', 'tile1.tif', 0), ('a/nested', 'tile2.tif', 10), ('b', 'tile3.tif', 20)]:
+        (tmp_path / folder).mkdir(parents=True, exist_ok=True)
+        write_raster(str(tmp_path / folder / name), np.zeros((10, 10), dtype=np.float32), from_origin(x, 10, 1, 1),
+                     'EPSG:27700')
+    update_tile_index(str(tmp_path / 'a'), index_file, recursive=True)
+    update_tile_index(str(tmp_path / 'b'), index_file)
+
+    def names(headers):
+        return sorted(os.path.basename(header['path']) for header in headers)
+
+    assert names(query_tile_index(index_file)) == ['tile1.tif', 'tile2.tif', 'tile3.tif']
+    assert names(query_tile_index(index_file, in_folder=str(tmp_path / 'a'))) == ['tile1.tif']
+    assert names(query_tile_index(index_file, in_folder=str(tmp_path / 'a'), recursive=True)) == ['tile1.tif',
+                                                                                                  'tile2.tif']
+    assert names(query_tile_index(index_file, bounds=(5, 0, 15, 10), in_folder=str(tmp_path / 'a'),
+                                  recursive=True)) == ['tile1.tif', 'tile2.tif']
+    assert names(query_tile_index(index_file, bounds=(15, 0, 25, 10), in_folder=str(tmp_path / 'a'))) == []
+
+
+@pytest.mark.parametrize('dtype, expected', [('int8', -128), ('int16', -32768), ('uint8', 255), ('float32', -9999)])
+def test_points_to_raster_default_nodata_fits_dtype(tmp_path, dtype, expected):
+    output_file = str(tmp_path / 'points.tif')
+    points = gpd.GeoDataFrame({'value': [3, 5]}, geometry=[Point(0.5, 0.5), Point(2.5, 0.5)], crs='EPSG:27700')
+    points_to_raster(points, 1, output_file, value_column='value', aggregation='max', dtype=dtype,
+                     bounds=(0, 0, 3, 1))
+    with rasterio.open(output_file) as src:
+        assert src.nodata == expected
+        assert src.read(1).tolist() == [[3, expected, 5]]
+
+
+def test_points_to_raster_rejects_nodata_outside_dtype(tmp_path):
+    points = gpd.GeoDataFrame({'value': [3]}, geometry=[Point(0.5, 0.5)], crs='EPSG:27700')
+    with pytest.raises(ValueError, match='does not fit'):
+        points_to_raster(points, 1, str(tmp_path / 'points.tif'), value_column='value', aggregation='max',
+                         dtype='int8', nodata=-9999)
+
+
+def test_reproject_matches_to_crs():
+    parcels = gpd.GeoDataFrame({'name': ['a', 'b']}, geometry=[box(400000, 100000, 400100, 100100),
+                                                               Point(530000, 180000)], crs='EPSG:27700')
+    assert reproject(parcels, 'epsg:27700') is parcels
+    result = reproject(parcels, 4326)
+    expected = parcels.to_crs(4326)
+    assert result.crs == expected.crs
+    assert result['name'].tolist() == ['a', 'b']
+    assert all(result.geometry.geom_equals_exact(expected.geometry, tolerance=1e-9))
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_explode_geodataframe_matches_geopandas(workers):
+    gdf = gpd.GeoDataFrame({'value': [1, 2, 3]},
+                           geometry=[MultiPolygon([box(0, 0, 1, 1), box(2, 2, 3, 3)]), box(5, 5, 6, 6),
+                                     MultiPolygon([box(0, 0, 1, 1), box(2, 0, 3, 1), box(4, 0, 5, 1)])],
+                           index=[10, 20, 10], crs='EPSG:27700')
+    result = explode_geodataframe(gdf, workers=workers, chunk_size=1)
+    expected = gdf.explode(index_parts=True)
+    assert result.index.tolist() == expected.index.tolist()
+    assert result['value'].tolist() == expected['value'].tolist()
+    assert all(result.geometry.geom_equals(expected.geometry))
+    assert explode_geodataframe(gdf, counts_only=True).tolist() == [2, 1, 3]
+
+
+@pytest.mark.parametrize('columns', [None, ['name', 'value']])
+@pytest.mark.parametrize('read_geometry', [False, True])
+def test_read_attribute_chunks_matches_read_file(tmp_path, columns, read_geometry):
+    vector_file = str(tmp_path / 'points.geojson')
+    points = gpd.GeoDataFrame({'value': np.arange(25), 'name': [f'p{i}' for i in range(25)]},
+                              geometry=[Point(i, i) for i in range(25)], crs='EPSG:27700')
+    points.to_file(vector_file)
+
+    chunks = list(read_attribute_chunks(vector_file, columns, chunk_size=10, read_geometry=read_geometry))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    result = pd.concat(chunks, ignore_index=True)
+    expected = gpd.read_file(vector_file)
+    expected_columns = columns or ['value', 'name']
+    assert list(result.columns) == expected_columns + (['geometry'] if read_geometry else [])
+    pd.testing.assert_frame_equal(pd.DataFrame(result[expected_columns]), pd.DataFrame(expected[expected_columns]))
+    if read_geometry:
+        assert result.crs == expected.crs
+        assert all(result.geometry.geom_equals(expected.geometry))
+
+
+def test_stage_records_cpu_of_its_own_thread():
+    previous = set_collector(StageCollector())
+    try:
+        stop = threading.Event()
+
+        def spin():
+            while not stop.is_set():
+                pass
+
+        busy = threading.Thread(target=spin)
+        busy.start()
+        try:
+            with stage('sleeping'):
+                time.sleep(0.3)
+        finally:
+            stop.set()
+            busy.join()
+
+        record, = get_collector().records('sleeping')
+        assert record['cpu'] < 0.1
+        assert record['peak_rss_growth'] is None or 0 <= record['peak_rss_growth'] <= record['process_peak_rss']
+    finally:
+        set_collector(previous)
+
+
+def test_cumulative_viewshed_working_copies(tmp_path):
+    dem_file = str(tmp_path / 'dem.tif')
+    copies = tmp_path / 'copies'
+    dem = np.random.default_rng(0).random((30, 40)).astype(np.float32) * 10
+    write_raster(dem_file, dem, from_origin(0, 30, 1, 1), 'EPSG:27700')
+    observers = gpd.GeoDataFrame(geometry=[Point(5.5, 5.5), Point(25.5, 20.5), Point(35.5, 10.5)],
+                                 crs='EPSG:27700')
+
+    in_memory = cumulative_viewshed(dem_file, observers, max_distance=10, workers=1)[0]
+    temporary = cumulative_viewshed(dem_file, observers, max_distance=10, workers=2)[0]
+    working = cumulative_viewshed(dem_file, observers, max_distance=10, workers=1, working_copy=True,
+                                  working_copy_dir=str(copies))[0]
+    assert (in_memory == temporary).all() and (in_memory == working).all()
+    first_copy, = copies.glob('*.npy')
+
+    # A new version of the DEM replaces the copy of the old one
+    write_raster(dem_file, dem + 1, from_origin(0, 30, 1, 1), 'EPSG:27700')
+    os.utime(dem_file, (1, 1))
+    cumulative_viewshed(dem_file, observers, max_distance=10, workers=1, working_copy=True,
+                        working_copy_dir=str(copies))
+    second_copy, = copies.glob('*.npy')
+    assert second_copy != first_copy
+
+    clear_raster_cache(disk=True, directory=str(copies))
+    assert list(copies.glob('*.npy')) == []
+
+
+def test_cached_index_with_key_sees_changed_layer(tmp_path):
+    points = gpd.GeoDataFrame(geometry=[Point(5, 5), Point(25, 25)], crs='EPSG:27700')
+    woodland = gpd.GeoDataFrame(geometry=[box(0, 0, 10, 10)], crs='EPSG:27700')
+    indexed = cached_index(woodland, key='woodland', cache=SpatialIndexCache(directory=str(tmp_path)))
+    assert len(extract_overlapping_polygons(points, indexed)) == 1
+
+    # A later run with the layer changed under the same key, without a version
+    woodland = gpd.GeoDataFrame(geometry=[box(0, 0, 10, 10), box(20, 20, 30, 30)], crs='EPSG:27700')
+    cache = SpatialIndexCache(directory=str(tmp_path))
+    indexed = cached_index(woodland, key='woodland', cache=cache)
+    assert len(indexed) == 2
+    assert len(extract_overlapping_polygons(points, indexed)) == 2
+    assert cached_index(woodland, key='woodland', cache=cache) is indexed
+
+
+def _join_layers():
+    rng = np.random.default_rng(1)
+    left = gpd.GeoDataFrame({'name': [f'l{i}' for i in range(40)], 'value': rng.integers(0, 9, 40)},
+                            geometry=shapely.buffer(shapely.points(rng.random((40, 2)) * 100), 4),
+                            index=rng.permutation(40) + 100, crs='EPSG:27700')
+    right = gpd.GeoDataFrame({'value': rng.integers(0, 9, 25), 'kind': list('abcde') * 5},
+                             geometry=shapely.buffer(shapely.points(rng.random((25, 2)) * 100), 6), crs='EPSG:27700')
+    return left, right
+
+
+def _assert_same_join(result, expected, other_index):
+    # Compare as sets of rows, the order within each group of matches is not part of the result
+    assert sorted(result.columns) == sorted(expected.columns)
+    result = result[expected.columns].reset_index().sort_values(['index', other_index], kind='stable')
+    expected = expected.reset_index().sort_values(['index', other_index], kind='stable')
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.parametrize('how', ['inner', 'left', 'right'])
+def test_spatial_join_matches_geopandas(how):
+    left, right = _join_layers()
+    result = spatial_join(left, right, how=how, workers=3, chunk_size=7)
+    expected = gpd.sjoin(left, right, how=how)
+    _assert_same_join(result, expected, 'index_left' if how == 'right' else 'index_right')
+
+
+@pytest.mark.parametrize('how', ['inner', 'left'])
+def test_nearest_join_matches_geopandas(how):
+    left, right = _join_layers()
+    result = nearest_join(left, right, how=how, max_distance=5, distance_col='distance', workers=3, chunk_size=7)
+    expected = gpd.sjoin_nearest(left, right, how=how, max_distance=5, distance_col='distance')
+    _assert_same_join(result, expected, 'index_right')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_native_zonal_statistics_matches_per_zone_masks(tmp_path, workers):
+    raster_file = str(tmp_path / 'raster.tif')
+    rng = np.random.default_rng(2)
+    data = rng.integers(0, 6, (50, 70)).astype(np.float32)
+    data[rng.random(data.shape) < 0.1] = -1
+    transform = from_origin(0, 50, 1, 1)
+    write_raster(raster_file, data, transform, 'EPSG:27700', nodata=-1)
+    zones = gpd.GeoDataFrame(geometry=[box(3, 4, 40, 30), box(20, 10, 65, 45), Point(30, 25).buffer(12),
+                                       box(0.2, 0.2, 0.6, 0.6), box(100, 100, 110, 110)], crs='EPSG:27700')
+
+    result = native_zonal_statistics(raster_file, zones, block_size=16, workers=workers)
+
+    for zone, stats in zip(zones.geometry, result):
+        inside = geometry_mask([zone], out_shape=data.shape, transform=transform, invert=True)
+        values = data[inside & (data != -1)].astype(np.float64)
+        assert stats['count'] == len(values)
+        if not len(values):
+            assert stats['mean'] is None and stats['majority'] is None
+            continue
+        uniques, counts = np.unique(values, return_counts=True)
+        expected = {'min': values.min(), 'max': values.max(), 'sum': values.sum(), 'mean': values.mean(),
+                    'std': values.std(), 'median': np.median(values), 'majority': uniques[np.argmax(counts)]}
+        assert stats == pytest.approx({'count': len(values), **expected})